@@ -0,0 +1,40 @@
+"""Memory per queued track, for the track records alone and once queued in a Playlist with its indexes.
+    Run from src: python benchmarks/track_memory.py"""
+import os
+import sys
+import tracemalloc
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cogs.music.ytdl import BasicMetadata
+from cogs.music.player import Playlist
+
+SIZES = (1000, 10000, 100000)
+
+def make_tracks(count: int):
+    # A playlist import shares one context, like YTDLExtractorFlat does
+    ctx = SimpleNamespace(author = SimpleNamespace(id = 200000000000000001), channel = SimpleNamespace(id = 300000000000000001))
+    return [BasicMetadata(ctx, url = f"https://www.youtube.com/watch?v={i:011d}",
+                          title = f"Artist {i % 997} - Song title number {i}", length = 180 + i % 240)
+            for i in range(count)]
+
+def traced(build):
+    """Bytes still allocated by build() once it returns, along with its result"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return allocated, kept
+
+def main():
+    print(f"{'tracks':>8} {'records B/track':>16} {'queued B/track':>15}")
+    for count in SIZES:
+        records, tracks = traced(lambda: make_tracks(count))
+        playlist = Playlist()
+        queued, _ = traced(lambda: playlist.songs.extend(tracks))   # What push_entry does with a playlist
+        print(f"{count:>8} {records / count:>16.1f} {(records + queued) / count:>15.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""Runs the bot as several processes, each owning a contiguous range of shards, and restarts the ones that crash.
+    Every process has its own players, caches and log file (logs/cluster-N.log).
+    Run from src: python cluster.py --processes 4 [--shards 16]"""
+import sys
+import time
+import signal
+import asyncio
+import argparse
+import logging
+import logging.handlers
+
+import aiohttp
+from async_timeout import timeout
+
+logger = logging.getLogger('cluster')
+logger.setLevel(logging.INFO)
+
+handler = logging.handlers.RotatingFileHandler(
+    filename='logs/cluster.log',
+    encoding='utf-8',
+    maxBytes=16 * 1024 * 1024,  # 16 MiB
+    backupCount=3,  # Rotate through 3 files
+)
+dt_fmt = '%Y-%m-%d %H:%M:%S'
+formatter = logging.Formatter('[{asctime}] [{levelname:<8}] {name}: {message}', dt_fmt, style='{')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.addHandler(logging.StreamHandler())
+
+restart_delay = 5           # seconds before a crashed process is started again, doubled for every crash in a row
+restart_delay_max = 300
+stable_after = 600          # seconds a process has to stay up for its earlier crashes to be forgotten
+identify_interval = 5       # seconds Discord wants between the logins of two shards
+
+async def recommended_shards(token: str):
+    """Shard count Discord recommends for the bot"""
+    async with aiohttp.ClientSession() as session:
+        async with session.get('https://discord.com/api/v10/gateway/bot',
+                               headers={'Authorization': f'Bot {token}'}) as response:
+            response.raise_for_status()
+            return (await response.json())['shards']
+
+def shard_ranges(shard_count: int, processes: int):
+    """Split the shards into contiguous (first, last) ranges, one per process"""
+    processes = max(1, min(processes, shard_count))
+    size, extra = divmod(shard_count, processes)
+    ranges = []
+    first = 0
+    for i in range(processes):
+        last = first + size + (i < extra) - 1
+        ranges.append((first, last))
+        first = last + 1
+    return ranges
+
+async def wait_or_stop(stopping: asyncio.Event, delay: float):
+    """Sleep for delay seconds, returns True if the cluster was stopped meanwhile"""
+    try:
+        async with timeout(delay):
+            await stopping.wait()
+    except asyncio.TimeoutError:
+        pass
+    return stopping.is_set()
+
+class ShardProcess():
+    """A bot process running a range of shards, started again whenever it crashes"""
+    def __init__(self, cluster: int, first: int, last: int, shard_count: int):
+        self.cluster = cluster
+        self.first = first
+        self.last = last
+        self.shard_count = shard_count
+        self.process = None
+        self.restarts = 0
+
+    def __str__(self):
+        return f"Cluster {self.cluster} (shards {self.first}-{self.last})"
+
+    async def run(self, start_delay: float, stopping: asyncio.Event):
+        if await wait_or_stop(stopping, start_delay):
+            return
+        delay = restart_delay
+        while not stopping.is_set():
+            started = time.monotonic()
+            self.process = await asyncio.create_subprocess_exec(
+                sys.executable, 'goplay-music.py',
+                '--shard-ids', f'{self.first}-{self.last}',
+                '--shard-count', str(self.shard_count),
+                '--cluster', str(self.cluster))
+            logger.info(f"{self} started as pid {self.process.pid}")
+            code = await self.process.wait()
+            if stopping.is_set():
+                break
+            if code == 0:
+                logger.info(f"{self} exited cleanly, not restarting it")
+                break
+
+            if time.monotonic() - started > stable_after:
+                delay = restart_delay
+            self.restarts += 1
+            logger.warning(f"{self} exited with code {code}, restarting it in {delay}s")
+            if await wait_or_stop(stopping, delay):
+                break
+            delay = min(delay * 2, restart_delay_max)
+
+    def terminate(self):
+        if self.process is not None and self.process.returncode is None:
+            self.process.terminate()
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--processes', type=int, default=1, help="number of bot processes")
+    parser.add_argument('--shards', type=int, help="total number of shards, Discord's recommendation by default")
+    args = parser.parse_args()
+
+    shard_count = args.shards
+    if shard_count is None:
+        with open("txts/token.txt","r") as f:
+            token = f.read().strip()
+        shard_count = await recommended_shards(token)
+
+    processes = [ShardProcess(i, first, last, shard_count)
+                 for i, (first, last) in enumerate(shard_ranges(shard_count, args.processes))]
+    logger.info(f"Running {shard_count} shards in {len(processes)} processes")
+
+    stopping = asyncio.Event()
+    def stop():
+        logger.info("Stopping the cluster")
+        stopping.set()
+        for process in processes:
+            process.terminate()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop)
+
+    # Processes log in one after the other, each of their shards waits its turn to identify
+    await asyncio.gather(*(process.run(process.first * identify_interval, stopping) for process in processes))
+
+asyncio.run(main())
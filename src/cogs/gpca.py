@@ -4,6 +4,7 @@ import logging
 from typing import Optional
 from discord import app_commands
 from discord.ext import commands
+from .outbox import outbox_for
 
 logger = logging.getLogger('discord.' + __name__)
 logger.setLevel(logging.DEBUG)
@@ -611,6 +612,7 @@ class Nominee(Entry):
 class Gpca(commands.Cog):
     def __init__(self, bot: commands.Bot) -> None:
         self.bot = bot
+        self.outbox = outbox_for(bot)   # The listings are many messages, the outbox merges them and paces them
 
     gpca_group = app_commands.Group(name = "gpca",
                                     description = "GPCA Commands")
@@ -690,9 +692,10 @@ class Gpca(commands.Cog):
                     await interaction.response.defer(ephemeral = False, thinking = True)
                     #await channel.send(f"GPCA 2023")
                     for message in message_list:
-                        await channel.send(f"{message.text}")
+                        self.outbox.send(channel.id, f"{message.text}")
                         if message.image != "":
-                            await channel.send(f"{message.image}")
+                            self.outbox.send(channel.id, f"{message.image}", merge = False)
+                    await self.outbox.flush(channel.id)
                     await interaction.followup.send("GPCA 2023 Award Groups", ephemeral = False)
                 else:
                     return await interaction.response.send_message(f"[Error] No entries found.")
@@ -725,13 +728,14 @@ class Gpca(commands.Cog):
                     #await channel.send(f"GPCA 2023")
                     for message in message_list:
                         logger.debug(f"[gpca list award] Sending award group text: {message.text}")
-                        await channel.send(message.text)
+                        self.outbox.send(channel.id, message.text)
                         if message.image != "":
                             logger.debug(f"[gpca list award] Sending award group image: {message.image}")
-                            await channel.send(message.image)
+                            self.outbox.send(channel.id, message.image, merge = False)
                         if message.text_after_image != "":
                             logger.debug(f"[gpca list award] Sending award text: {message.text_after_image}")
-                            await channel.send(message.text_after_image)
+                            self.outbox.send(channel.id, message.text_after_image)
+                    await self.outbox.flush(channel.id)
                     await interaction.followup.send("GPCA 2023 Awards", ephemeral = False)
                 else:
                     return await interaction.response.send_message(f"[Error] No entries found.")
@@ -786,14 +790,15 @@ class Gpca(commands.Cog):
                 #await channel.send(f"GPCA 2023")
                 for message in message_list:
                     logger.debug(f"[gpca tree] Sending award group text: {message.group_text}")
-                    await channel.send(f"{message.group_text}")
+                    self.outbox.send(channel.id, f"{message.group_text}")
                     if message.image != "":
                         logger.debug(f"[gpca tree] Sending award group image: {message.image}")
-                        await channel.send(f"{message.image}")
+                        self.outbox.send(channel.id, f"{message.image}", merge = False)
                     for award_message in message.award_texts_list:
                         logger.debug(f"[gpca tree] Sending award/nominee text: {award_message}")
-                        msg_handle = await channel.send(f"{award_message}")
-                        await msg_handle.edit(suppress=True)
+                        # Sent with the link previews suppressed instead of editing every message afterwards
+                        self.outbox.send(channel.id, f"{award_message}", suppress_embeds = True)
+                await self.outbox.flush(channel.id)
                 await interaction.followup.send("GPCA 2023", ephemeral = False)
             else:
                 logger.error("_list_all: There is no entry to show")
@@ -0,0 +1,70 @@
+"""sqlite databases of the music cog. Every connection lives on one database thread, so sqlite never
+    blocks the event loop and the writes run in the order they were made."""
+import os
+import sqlite3
+import asyncio
+import logging
+import concurrent.futures
+
+logger = logging.getLogger('discord.' + __name__)
+logger.setLevel(logging.DEBUG)
+
+db_thread = concurrent.futures.ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'music-db')
+
+class Database():
+    """Connection to a database file, shared by everything using that file and opened on the database thread.
+        Functions given to submit() and run() are called there with the connection as first argument.
+        Writes are submitted and return right away, reads are awaited with run()."""
+    _shared = {}    # path -> Database
+
+    def __init__(self, path: str, name: str):
+        self.path = path
+        self.name = name
+        self.conn = None
+        self.users = 0
+
+    @classmethod
+    def acquire(cls, path: str, schema: str, name: str, setup = None):
+        """The connection to path, opened with the schema the first time. setup(conn) runs before the schema"""
+        db = cls._shared.get(path)
+        if db is None:
+            db = cls._shared[path] = cls(path, name)
+            db.submit(db._open, schema, setup)
+        db.users += 1
+        return db
+
+    def release(self):
+        """Close the connection once nothing uses it anymore"""
+        self.users -= 1
+        if self.users == 0:
+            if self._shared.get(self.path) is self:
+                del self._shared[self.path]
+            self.submit(self._close)
+
+    def _open(self, conn, schema: str, setup):
+        if self.path != ':memory:':
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok = True)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        if setup is not None:
+            setup(self.conn)
+        self.conn.executescript(schema)
+
+    def _close(self, conn):
+        conn.close()
+        self.conn = None
+
+    def _call(self, function, args):
+        return function(self.conn, *args)
+
+    def submit(self, function, *args):
+        future = db_thread.submit(self._call, function, args)
+        future.add_done_callback(self._log_error)
+        return future
+
+    def _log_error(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"{self.name} error: {future.exception()}")
+
+    async def run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(db_thread, self._call, function, args)
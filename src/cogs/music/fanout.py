@@ -0,0 +1,156 @@
+import collections
+import threading
+import logging
+
+import discord
+
+logger = logging.getLogger('discord.' + __name__)
+logger.setLevel(logging.DEBUG)
+
+STREAM_LOOKAHEAD = 250     # frames (5 seconds) ffmpeg may run ahead of the furthest reader
+STREAM_CAPACITY = 1750     # frames kept in the ring buffer, guilds can join a stream until it overflows
+
+class SharedStream():
+    """A single ffmpeg process whose opus frames are read by several voice clients.
+        Frames live in a ring buffer, every reader keeps its own cursor into it."""
+    def __init__(self, registry, key: tuple, original: discord.AudioSource):
+        self.registry = registry
+        self.key = key
+        self.original = original
+
+        self.frames = collections.deque()
+        self.base = 0           # Absolute frame number of frames[0]
+        self.produced = 0       # Absolute frame number of the next frame ffmpeg gives us
+        self.finished = False
+        self.closed = False
+        self.readers = set()
+        self.cond = threading.Condition()
+        self.producer = threading.Thread(target = self._produce, daemon = True, name = f"shared-stream:{key}")
+
+    @property
+    def joinable(self):
+        """New readers start from the first frame, so they can only join while it is still buffered"""
+        return self.base == 0 and not self.finished and not self.closed
+
+    def start(self):
+        self.producer.start()
+
+    def attach(self):
+        with self.cond:
+            reader = SharedStreamReader(self)
+            self.readers.add(reader)
+        logger.debug(f"Reader attached to {self.key}, {len(self.readers)} readers")
+        return reader
+
+    def detach(self, reader):
+        with self.cond:
+            self.readers.discard(reader)
+            last_reader = len(self.readers) == 0
+            self.cond.notify_all()
+        logger.debug(f"Reader detached from {self.key}, {len(self.readers)} readers")
+        if last_reader:
+            self.close()
+
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify_all()
+        self.registry.discard(self)
+        self.original.cleanup()
+
+    def _produce(self):
+        while True:
+            with self.cond:
+                while not self.closed and self.readers and \
+                        self.produced - max(r.cursor for r in self.readers) >= STREAM_LOOKAHEAD:
+                    self.cond.wait()
+                if self.closed:
+                    return
+
+            try:
+                data = self.original.read()
+            except Exception as e:
+                logger.error(f"Shared stream {self.key} failed: {e}")
+                data = b''
+
+            with self.cond:
+                if not data:
+                    self.finished = True
+                    self.cond.notify_all()
+                    return
+
+                self.frames.append(data)
+                self.produced += 1
+                slowest = min((r.cursor for r in self.readers), default = self.produced)
+                # Past the join window nobody needs frames behind the slowest reader,
+                # and the buffer never grows past its capacity (lagging readers skip ahead)
+                while self.frames and (len(self.frames) > STREAM_CAPACITY or (0 < self.base < slowest)):
+                    self.frames.popleft()
+                    self.base += 1
+                self.cond.notify_all()
+
+class SharedStreamReader(discord.AudioSource):
+    """Per guild cursor over a shared stream"""
+    def __init__(self, stream: SharedStream):
+        self.stream = stream
+        self.cursor = stream.base
+        self.detached = False
+
+    def read(self):
+        stream = self.stream
+        with stream.cond:
+            while self.cursor >= stream.produced and not (stream.finished or stream.closed or self.detached):
+                stream.cond.wait()
+            if self.detached or stream.closed:
+                return b''
+            if self.cursor < stream.base:   # Fell behind the ring buffer
+                self.cursor = stream.base
+            if self.cursor >= stream.produced:
+                return b''
+
+            data = stream.frames[self.cursor - stream.base]
+            self.cursor += 1
+            stream.cond.notify_all()
+            return data
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        """Called by the voice client on skip/stop/seek, lets the stream go once nobody reads it"""
+        if not self.detached:
+            self.detached = True
+            self.stream.detach(self)
+
+class SharedStreamRegistry():
+    """Registry of running shared streams keyed by (extractor, video id, start offset)"""
+    def __init__(self):
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._streams)
+
+    async def open(self, key: tuple, factory):
+        """Attach to a running stream for the key or start a new one using the async factory"""
+        with self._lock:
+            stream = self._streams.get(key)
+        if stream is not None and stream.joinable:
+            logger.debug(f"Sharing the running stream for {key}")
+            return stream.attach()
+
+        stream = SharedStream(self, key, await factory())
+        reader = stream.attach()    # Attach before starting so the producer doesn't see an empty stream
+        with self._lock:
+            self._streams[key] = stream
+        stream.start()
+        return reader
+
+    def discard(self, stream: SharedStream):
+        with self._lock:
+            if self._streams.get(stream.key) is stream:
+                del self._streams[stream.key]
+
+shared_streams = SharedStreamRegistry()
@@ -0,0 +1,102 @@
+import time
+import logging
+
+from .database import Database
+from .indexes import title_tokens
+
+logger = logging.getLogger('discord.' + __name__)
+logger.setLevel(logging.DEBUG)
+
+history_path = 'db/history.db'
+
+def like_escape(text: str):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+class HistoryStore():
+    """Played songs of a guild that were moved out of memory, kept in play order in sqlite.
+        Records are the same dicts the queue journal writes, positions start at 0 with the oldest song.
+        The guilds share one connection to the database. Writes return right away, reads are awaited."""
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS history (
+            guild_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            url TEXT NOT NULL,
+            title TEXT,
+            length REAL,
+            requester INTEGER,
+            channel INTEGER,
+            PRIMARY KEY (guild_id, position)
+        ) WITHOUT ROWID;
+    '''
+
+    def __init__(self, guild_id: int, path: str = None):
+        self.guild_id = guild_id
+        self._len = 0
+        self.db = Database.acquire(path or history_path, self.SCHEMA, "History store", self._setup)
+        self.db.submit(self._clear)     # A new player starts with an empty history
+
+    def __len__(self):
+        return self._len
+
+    @staticmethod
+    def _setup(conn):
+        conn.create_function('casefold', 1, lambda text: text.casefold() if text else text, deterministic = True)
+
+    def append(self, records):
+        rows = [(self.guild_id, self._len + i, r['u'], r['t'], r['d'], r['r'], r['c']) for i, r in enumerate(records)]
+        self._len += len(rows)
+        self.db.submit(self._insert, rows)
+
+    def _insert(self, conn, rows):
+        start = time.perf_counter_ns()
+        with conn:
+            conn.executemany('INSERT INTO history VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        logger.debug(f"[{self.guild_id}] Took [{time.perf_counter_ns() - start}] nanoseconds to spill {len(rows)} songs")
+
+    async def window(self, start: int, stop: int):
+        """Records [start, stop)"""
+        return await self.db.run(self._window, start, stop)
+
+    def _window(self, conn, start: int, stop: int):
+        cursor = conn.execute('SELECT url, title, length, requester, channel FROM history '
+                              'WHERE guild_id = ? AND position >= ? AND position < ? ORDER BY position',
+                              (self.guild_id, max(0, start), stop))
+        return [{'u': u, 't': t, 'd': d, 'r': r, 'c': c} for u, t, d, r, c in cursor]
+
+    async def record(self, index: int):
+        if not 0 <= index < self._len:
+            raise IndexError()
+        return (await self.window(index, index + 1))[0]
+
+    async def search(self, query: str):
+        """Position of the latest record whose title contains every word of the query, None if none does.
+            Only whole words match, the typo tolerant trigram search covers the songs in memory alone"""
+        words = set(title_tokens(query))
+        if not words:
+            return None
+        return await self.db.run(self._search, words)
+
+    def _search(self, conn, words):
+        start = time.perf_counter_ns()
+        # LIKE narrows the rows down to titles containing the words, the tokens are compared after
+        cursor = conn.execute('SELECT position, title FROM history WHERE guild_id = ? '
+                              + ''.join(" AND casefold(title) LIKE ? ESCAPE '\\'" for _ in words)
+                              + ' ORDER BY position DESC',
+                              (self.guild_id, *(f"%{like_escape(word)}%" for word in words)))
+        position = next((p for p, title in cursor if words <= set(title_tokens(title))), None)
+        logger.debug(f"[{self.guild_id}] Took [{time.perf_counter_ns() - start}] nanoseconds to search the history")
+        return position
+
+    def clear(self):
+        self._len = 0
+        if self.db is not None:     # None once closed
+            self.db.submit(self._clear)
+
+    def _clear(self, conn):
+        with conn:
+            conn.execute('DELETE FROM history WHERE guild_id = ?', (self.guild_id, ))
+
+    def close(self):
+        self.clear()
+        self.db.release()
+        self.db = None
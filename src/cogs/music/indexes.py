@@ -0,0 +1,408 @@
+import re
+import math
+import urllib.parse
+
+from .sequence import BlockList
+
+def requester_id(entry):
+    return entry.requester_id
+
+def canonical_id(url: str):
+    """Video id of youtube links (so watch, youtu.be and shorts links of a video match), the url otherwise"""
+    parsed = urllib.parse.urlparse(url)
+    host = parsed.netloc.lower()
+    if host.endswith('youtu.be'):
+        return parsed.path.strip('/') or url
+    if host.endswith('youtube.com') or host.endswith('youtube-nocookie.com'):
+        video = urllib.parse.parse_qs(parsed.query).get('v')
+        if video:
+            return video[0]
+        for prefix in ('/shorts/', '/embed/', '/live/'):
+            if parsed.path.startswith(prefix):
+                return parsed.path[len(prefix):].strip('/')
+    return url
+
+def title_tokens(title: str):
+    """Casefolded words of a title"""
+    return re.findall(r'\w+', title.casefold()) if title else []
+
+def trigrams(token: str):
+    padded = f" {token} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class EntryIndex():
+    """Base for the indexes a SongQueue keeps up to date as entries are added and removed.
+        Indexes that care about entries crossing the nowplaying cursor set tracks_cursor,
+        the others don't pay for the cursor jumps."""
+    tracks_cursor = False
+
+    def added(self, entry, upcoming: bool):
+        pass
+
+    def removed(self, entry, upcoming: bool):
+        pass
+
+    def played(self, entries):
+        """Entries moved behind the cursor into history"""
+        pass
+
+    def unplayed(self, entries):
+        """Entries moved from history back into the upcoming songs"""
+        pass
+
+    def cleared(self):
+        pass
+
+class RequesterIndex(EntryIndex):
+    """Requester id -> entries of that requester, along with their count of upcoming songs"""
+    tracks_cursor = True
+
+    def __init__(self):
+        self._entries = {}      # requester id -> {entry: None}, a dict is used as an insertion ordered set
+        self._upcoming = {}     # requester id -> number of upcoming songs
+
+    def __contains__(self, requester: int):
+        return requester in self._entries
+
+    def requesters(self):
+        return list(self._entries.keys())
+
+    def entries(self, requester: int):
+        return list(self._entries.get(requester, ()))
+
+    def upcoming_count(self, requester: int):
+        return self._upcoming.get(requester, 0)
+
+    def _count(self, entry, delta: int):
+        rid = requester_id(entry)
+        count = self._upcoming.get(rid, 0) + delta
+        if count > 0:
+            self._upcoming[rid] = count
+        else:
+            self._upcoming.pop(rid, None)
+
+    def added(self, entry, upcoming: bool):
+        rid = requester_id(entry)
+        entries = self._entries.get(rid)
+        if entries is None:
+            entries = self._entries[rid] = {}
+        entries[entry] = None
+        if upcoming:
+            self._count(entry, 1)
+
+    def removed(self, entry, upcoming: bool):
+        rid = requester_id(entry)
+        entries = self._entries.get(rid)
+        if entries is not None:
+            entries.pop(entry, None)
+            if not entries:
+                del self._entries[rid]
+        if upcoming:
+            self._count(entry, -1)
+
+    def played(self, entries):
+        for entry in entries:
+            self._count(entry, -1)
+
+    def unplayed(self, entries):
+        for entry in entries:
+            self._count(entry, 1)
+
+    def cleared(self):
+        self._entries.clear()
+        self._upcoming.clear()
+
+class DuplicateIndex(EntryIndex):
+    """Canonical id -> entries with that id, plus the set of ids queued more than once"""
+    def __init__(self):
+        self._entries = {}      # canonical id -> {entry: None}
+        self._duplicated = set()
+
+    def __contains__(self, entry):
+        return canonical_id(entry.url) in self._entries
+
+    def count(self, entry):
+        return len(self._entries.get(canonical_id(entry.url), ()))
+
+    def duplicates(self):
+        """Lists of entries sharing a canonical id, only for the ids queued more than once"""
+        return [list(self._entries[cid]) for cid in self._duplicated]
+
+    def added(self, entry, upcoming: bool):
+        cid = canonical_id(entry.url)
+        entries = self._entries.get(cid)
+        if entries is None:
+            entries = self._entries[cid] = {}
+        entries[entry] = None
+        if len(entries) > 1:
+            self._duplicated.add(cid)
+
+    def removed(self, entry, upcoming: bool):
+        cid = canonical_id(entry.url)
+        entries = self._entries.get(cid)
+        if entries is None:
+            return
+        entries.pop(entry, None)
+        if len(entries) < 2:
+            self._duplicated.discard(cid)
+        if not entries:
+            del self._entries[cid]
+
+    def cleared(self):
+        self._entries.clear()
+        self._duplicated.clear()
+
+class ShuffleIndex(EntryIndex):
+    """Remembers the order of the upcoming songs from before the first shuffle, so it can be restored.
+        Songs added while shuffled go to the end of that order, played or removed songs leave it."""
+    tracks_cursor = True
+
+    def __init__(self):
+        self.natural = None     # BlockList of the upcoming entries in unshuffled order, None when not shuffled
+
+    @property
+    def active(self):
+        return self.natural is not None
+
+    def start(self, upcoming):
+        if self.natural is None:
+            self.natural = BlockList(upcoming)
+
+    def stop(self):
+        """Return the upcoming entries in unshuffled order and forget it"""
+        natural, self.natural = self.natural, None
+        return list(natural) if natural is not None else None
+
+    def added(self, entry, upcoming: bool):
+        if self.natural is not None and upcoming:
+            self.natural.append(entry)
+
+    def removed(self, entry, upcoming: bool):
+        if self.natural is not None and entry in self.natural:
+            self.natural.remove(entry)
+
+    def played(self, entries):
+        if self.natural is not None:
+            for entry in entries:
+                if entry in self.natural:
+                    self.natural.remove(entry)
+
+    def unplayed(self, entries):
+        if self.natural is not None:
+            self.natural.insert_many(0, list(entries))
+
+    def cleared(self):
+        self.natural = None
+
+class TitleIndex(EntryIndex):
+    """Word and trigram postings over the queued titles, to find songs by a part of their title.
+        Queries whose words all appear in a title match on the words alone, otherwise the titles
+        sharing enough trigrams with the query match, which covers typos and partial words."""
+    min_similarity = 0.5    # share of the query trigrams a title needs for a fuzzy match
+
+    def __init__(self):
+        self._words = {}        # word -> {entry: None}
+        self._trigrams = {}     # trigram -> {entry: None}
+
+    @staticmethod
+    def _keys(entry):
+        words = set(title_tokens(entry.title))
+        return words, {gram for word in words for gram in trigrams(word)}
+
+    def added(self, entry, upcoming: bool):
+        words, grams = self._keys(entry)
+        for postings, keys in ((self._words, words), (self._trigrams, grams)):
+            for key in keys:
+                try:
+                    postings[key][entry] = None
+                except KeyError:
+                    postings[key] = {entry: None}
+
+    def removed(self, entry, upcoming: bool):
+        words, grams = self._keys(entry)
+        for postings, keys in ((self._words, words), (self._trigrams, grams)):
+            for key in keys:
+                entries = postings.get(key)
+                if entries is None:
+                    continue
+                entries.pop(entry, None)
+                if not entries:
+                    del postings[key]
+
+    def cleared(self):
+        self._words.clear()
+        self._trigrams.clear()
+
+    def search(self, query: str, fuzzy: bool = True):
+        """Entries best matching the query, all of them when several match equally well.
+            Without fuzzy only the titles containing every word of the query match"""
+        words = set(title_tokens(query))
+        if not words:
+            return ()
+
+        postings = sorted((self._words.get(word, {}) for word in words), key = len)
+        if len(postings) == 1 or not postings[0]:
+            matches = postings[0]
+        else:
+            matches = {entry: None for entry in postings[0] if all(entry in p for p in postings[1:])}
+        if matches or not fuzzy:
+            return matches
+
+        grams = {gram for word in words for gram in trigrams(word)}
+        postings = sorted((self._trigrams.get(gram, {}) for gram in grams), key = len)
+        # Scan the rarest postings first. Entries not seen after k postings share at most
+        # len - k trigrams with the query, so the scan stops once nothing unseen can beat the best
+        best, matches, seen = max(1, math.ceil(self.min_similarity * len(grams))), {}, set()
+        for k, p in enumerate(postings):
+            if best > len(postings) - k:
+                break
+            for entry in p:
+                if entry in seen:
+                    continue
+                seen.add(entry)
+                score = sum(1 for q in postings if entry in q)
+                if score > best:
+                    best, matches = score, {entry: None}
+                elif score == best:
+                    matches[entry] = None
+        return matches
+
+class FairIndex(EntryIndex):
+    """Rounds of the upcoming songs in fair mode, which keeps them in round robin order by requester.
+        Every requester has a round counter, their next song goes in the round after their last one,
+        or in the round playing now if they have had no turn in it. The queue is sorted by round and inside
+        a round songs play in the order they were queued, so a song goes right after the last song of its round.
+        Each round and requester keeps its songs in a FIFO, the hooks and the slot of a song are O(1)
+        apart from skipping rounds emptied by removals.
+        Songs added by hand (playtop, move, seeking back) can land anywhere, they make the rounds stale and
+        the next songs queued in fair mode tag the upcoming songs again in queue order. So explicit moves stick."""
+    tracks_cursor = True
+
+    def __init__(self):
+        self._round = {}        # upcoming entry -> its round
+        self._rounds = {}       # round -> {entry: None} in queue order
+        self._queues = {}       # requester id -> {entry: None} of their upcoming songs in queue order
+        self._played = {}       # requester id -> round of their last played song
+        self.floor = 0          # round of the last played song
+        self._top = 0           # no round above it has songs
+        self.stale = False
+
+    def _tag(self, entry, r: int):
+        self._round[entry] = r
+        try:
+            self._rounds[r][entry] = None
+        except KeyError:
+            self._rounds[r] = {entry: None}
+        rid = requester_id(entry)
+        try:
+            self._queues[rid][entry] = None
+        except KeyError:
+            self._queues[rid] = {entry: None}
+        self._top = max(self._top, r)
+
+    def _untag(self, entry):
+        r = self._round.pop(entry, None)
+        if r is None:
+            return None
+        members = self._rounds[r]
+        del members[entry]
+        if not members:
+            del self._rounds[r]
+            while self._top > self.floor and self._top not in self._rounds:
+                self._top -= 1
+        rid = requester_id(entry)
+        entries = self._queues[rid]
+        del entries[entry]
+        if not entries:
+            del self._queues[rid]
+        return r
+
+    def _forget(self):
+        self._round.clear()
+        self._rounds.clear()
+        self._queues.clear()
+        self._top = self.floor
+
+    def _start(self, requester: int):
+        """Round of the next song of a requester"""
+        entries = self._queues.get(requester)
+        if entries:
+            return self._round[next(reversed(entries))] + 1
+        played = self._played.get(requester)
+        return self.floor if played is None else max(self.floor, played + 1)
+
+    def added(self, entry, upcoming: bool):
+        if upcoming and entry not in self._round:
+            self.stale = True
+
+    def removed(self, entry, upcoming: bool):
+        if upcoming:
+            self._untag(entry)
+
+    def played(self, entries):
+        for entry in entries:
+            r = self._untag(entry)
+            if r is None:
+                r = self.floor
+            self.floor = max(self.floor, r)
+            self._played[requester_id(entry)] = r
+        self._top = max(self._top, self.floor)
+
+    def unplayed(self, entries):
+        self.stale = True
+
+    def cleared(self):
+        self._forget()
+        self._played.clear()
+        self.floor = self._top = 0
+        self.stale = False
+
+    def order(self, upcoming):
+        """The upcoming entries in round robin order, which the rounds then follow"""
+        self._forget()
+        rounds = {}     # requester id -> round of their next song
+        keyed = []
+        for entry in upcoming:
+            rid = requester_id(entry)
+            r = rounds.get(rid)
+            if r is None:
+                r = self._start(rid)
+            rounds[rid] = r + 1
+            keyed.append((r, entry))
+        keyed.sort(key = lambda pair: pair[0])     # Stable, so a round keeps the queue order
+        for r, entry in keyed:
+            self._tag(entry, r)
+        self.stale = False
+        return [entry for r, entry in keyed]
+
+    def _retag(self, upcoming):
+        """Tag the upcoming entries again in queue order. Rounds never go down along the queue,
+            so a song moved up by hand pushes the songs after it into its round"""
+        self._forget()
+        r = self.floor
+        for entry in upcoming:
+            r = max(r, self._start(requester_id(entry)))
+            self._tag(entry, r)
+        self.stale = False
+
+    def _end_of(self, songs, r: int):
+        """Index of songs right after the last upcoming song of round r or below"""
+        for r in range(min(r, self._top), self.floor - 1, -1):
+            members = self._rounds.get(r)
+            if members:
+                return songs.index(next(reversed(members))) + 1
+        return songs.cursor
+
+    def slots(self, songs, items: list):
+        """Absolute indexes of songs where songs of one requester go, in order, and tag them with their rounds.
+            Songs going in past the last round are appended without any lookup"""
+        if self.stale:
+            self._retag(songs.upcoming())
+        start = self._start(requester_id(items[0]))
+        positions = []
+        for i, entry in enumerate(items):
+            r = start + i
+            positions.append((len(songs) if r > self._top else self._end_of(songs, r)) + i)
+        for i, entry in enumerate(items):
+            self._tag(entry, start + i)
+        return positions
@@ -0,0 +1,263 @@
+import os
+import json
+import asyncio
+import logging
+import concurrent.futures
+
+logger = logging.getLogger('discord.' + __name__)
+logger.setLevel(logging.DEBUG)
+
+journal_dir = 'db/queues'
+compact_after = 1000    # journal lines written before the queue is compacted into a snapshot
+
+# The journal files are written, synced and compacted on this thread, so the disk never blocks the event loop.
+# A single thread keeps the writes of every guild in the order they were made
+writer_thread = concurrent.futures.ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'queue-journal')
+
+async def after_writes(function, *args):
+    """Run function on the writer thread, once the journal writes made so far reached the files"""
+    return await asyncio.get_running_loop().run_in_executor(writer_thread, function, *args)
+
+def entry_record(entry):
+    """The bits of an entry needed to queue it again without asking yt-dlp"""
+    return {'u': entry.url, 't': entry.title, 'd': entry.length, 'r': entry.requester_id, 'c': entry.channel_id}
+
+class QueueState():
+    """Queue of a guild as rebuilt from its snapshot and journal"""
+    def __init__(self, guild_id: int):
+        self.guild_id = guild_id
+        self.seq = 0
+        self.entries = []       # entry records
+        self.cursor = 0
+        self.offset = None      # seconds into the song before the cursor, None when nothing was playing
+        self.voice_channel = None
+        self.text_channel = None
+
+    def apply(self, op: dict):
+        """Replay a journal line, mirrors what SongQueue does to its cursor"""
+        match op['op']:
+            case 'add':
+                at = op['at']
+                self.entries[at:at] = op['entries']
+                if at < self.cursor:
+                    self.cursor += len(op['entries'])
+            case 'add_at':
+                for at, entry in zip(op['at'], op['entries']):
+                    self.entries.insert(at, entry)
+                    if at < self.cursor:
+                        self.cursor += 1
+            case 'remove':
+                at = op['at']
+                del self.entries[at]
+                if at < self.cursor:
+                    self.cursor -= 1
+            case 'remove_range':
+                at, count = op['at'], op['count']
+                del self.entries[at:at + count]
+                self.cursor -= max(0, min(at + count, self.cursor) - at)
+            case 'set':
+                self.entries[op['at']] = op['entry']
+            case 'seek':
+                self.cursor = op['cursor']
+                self.offset = 0
+            case 'clear':
+                self.entries = []
+                self.cursor = 0
+                self.offset = None
+            case 'clear_upcoming':
+                del self.entries[self.cursor:]
+            case 'drop_history':
+                del self.entries[:op['count']]
+                self.cursor = max(0, self.cursor - op['count'])
+            case 'permute':
+                start = op['start']
+                upcoming = self.entries[start:]
+                self.entries[start:] = [upcoming[i] for i in op['order']]
+            case 'offset':
+                self.offset = op['position']
+            case 'voice':
+                self.voice_channel = op['channel']
+                self.text_channel = op['text']
+        self.seq = op['s']
+
+class QueueJournal():
+    """Append-only journal of the queue mutations of a guild.
+        Every line is a json object with a sequence number, once the journal gets long the whole
+        queue is written to a snapshot and the journal starts over. Lines already in the snapshot
+        are skipped on replay, so a crash between the two steps doesn't apply anything twice.
+        The lines and the snapshot are built on the event loop and written by the writer thread."""
+    def __init__(self, guild_id: int, directory: str = None, seq: int = 0):
+        directory = directory or journal_dir
+        self.guild_id = guild_id
+        self.path = os.path.join(directory, f"{guild_id}.journal")
+        self.snapshot_path = os.path.join(directory, f"{guild_id}.snapshot")
+        self.seq = seq
+        self.lines = 0
+        self._file = None
+        self._offset = None     # last offset and voice channels written, the checkpoints skip unchanged ones
+        self._voice = None
+
+    def _submit(self, function, *args):
+        writer_thread.submit(function, *args).add_done_callback(self._log_error)
+
+    def _log_error(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"[{self.guild_id}] Queue journal error: {future.exception()}")
+
+    def _write(self, op: str, **fields):
+        self.seq += 1
+        self.lines += 1
+        self._submit(self._append, json.dumps({'s': self.seq, 'op': op, **fields}, separators = (',', ':')) + '\n')
+
+    def _append(self, line: str):
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok = True)
+            self._file = open(self.path, 'a', encoding = 'utf-8')
+        self._file.write(line)
+        self._file.flush()  # Survives the process crashing, sync() also makes it survive the host going down
+
+    def add(self, at: int, entries):
+        self._write('add', at = at, entries = [entry_record(e) for e in entries])
+
+    def add_at(self, positions: list, entries):
+        self._write('add_at', at = positions, entries = [entry_record(e) for e in entries])
+
+    def remove(self, at: int):
+        self._write('remove', at = at)
+
+    def remove_range(self, at: int, count: int):
+        self._write('remove_range', at = at, count = count)
+
+    def set(self, at: int, entry):
+        self._write('set', at = at, entry = entry_record(entry))
+
+    def seek(self, cursor: int):
+        self._offset = 0
+        self._write('seek', cursor = cursor)
+
+    def clear(self):
+        self._offset = None
+        self._write('clear')
+
+    def clear_upcoming(self):
+        self._write('clear_upcoming')
+
+    def drop_history(self, count: int):
+        self._write('drop_history', count = count)
+
+    def permute(self, start: int, order: list):
+        self._write('permute', start = start, order = order)
+
+    def offset(self, position: float):
+        position = round(position, 2) if position is not None else None
+        if position != self._offset:
+            self._offset = position
+            self._write('offset', position = position)
+
+    def voice(self, channel: int, text: int):
+        if (channel, text) != self._voice:
+            self._voice = (channel, text)
+            self._write('voice', channel = channel, text = text)
+
+    @property
+    def needs_compaction(self):
+        return self.lines >= compact_after
+
+    def snapshot(self, entries, cursor: int, offset: float, voice_channel: int, text_channel: int):
+        """Write the whole queue to the snapshot and start a new journal"""
+        self._offset = round(offset, 2) if offset is not None else None
+        self._voice = (voice_channel, text_channel)
+        state = {'s': self.seq, 'cursor': cursor, 'offset': self._offset,
+                 'voice': voice_channel, 'text': text_channel,
+                 'entries': [entry_record(e) for e in entries]}
+        self.lines = 0
+        self._submit(self._write_snapshot, state)
+
+    def _write_snapshot(self, state: dict):
+        os.makedirs(os.path.dirname(self.snapshot_path), exist_ok = True)
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w', encoding = 'utf-8') as f:
+            json.dump(state, f, separators = (',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.path, 'w', encoding = 'utf-8')
+        logger.debug(f"[{self.guild_id}] Compacted the queue journal at seq {state['s']}")
+
+    def sync(self):
+        self._submit(self._sync)
+
+    def _sync(self):
+        if self._file is not None:
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._submit(self._close)
+
+    def _close(self):
+        if self._file is not None:
+            self._sync()
+            self._file.close()
+            self._file = None
+
+    def discard(self):
+        """The queue ended on purpose, nothing to restore"""
+        self._submit(self._discard)
+
+    def _discard(self):
+        self._close()
+        for path in (self.path, self.snapshot_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    @classmethod
+    def saved_guilds(cls, directory: str = None):
+        directory = directory or journal_dir
+        try:
+            files = os.listdir(directory)
+        except FileNotFoundError:
+            return []
+        guilds = set()
+        for name in files:
+            guild_id, _, ext = name.partition('.')
+            if ext in ('journal', 'snapshot') and guild_id.isdigit():
+                guilds.add(int(guild_id))
+        return sorted(guilds)
+
+    @classmethod
+    def load(cls, guild_id: int, directory: str = None):
+        """Rebuild the queue state of a guild from its snapshot and journal"""
+        journal = cls(guild_id, directory)
+        state = QueueState(guild_id)
+        try:
+            with open(journal.snapshot_path, 'r', encoding = 'utf-8') as f:
+                snapshot = json.load(f)
+            state.seq = snapshot['s']
+            state.entries = snapshot['entries']
+            state.cursor = snapshot['cursor']
+            state.offset = snapshot['offset']
+            state.voice_channel = snapshot['voice']
+            state.text_channel = snapshot['text']
+        except FileNotFoundError:
+            pass
+
+        try:
+            with open(journal.path, 'r', encoding = 'utf-8') as f:
+                for line in f:
+                    try:
+                        op = json.loads(line)
+                    except json.JSONDecodeError:
+                        logger.warning(f"[{guild_id}] Dropping a torn line at the end of the queue journal")
+                        break
+                    if op['s'] > state.seq:
+                        state.apply(op)
+        except FileNotFoundError:
+            pass
+
+        state.cursor = max(0, min(state.cursor, len(state.entries)))
+        return state
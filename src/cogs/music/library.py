@@ -0,0 +1,115 @@
+import time
+import logging
+
+from .database import Database
+from .indexes import canonical_id
+
+logger = logging.getLogger('discord.' + __name__)
+logger.setLevel(logging.DEBUG)
+
+library_path = 'db/playlists.db'
+GUILD_OWNER = 0     # owner id of the playlists shared by the whole guild
+
+class SavedTrack():
+    """A track of a saved playlist, everything needed to queue it again"""
+    __slots__ = ('url', 'title', 'length', 'canonical_id')
+
+    def __init__(self, url: str, title: str, length: float, canonical_id: str):
+        self.url = url
+        self.title = title
+        self.length = length
+        self.canonical_id = canonical_id
+
+class PlaylistLibrary():
+    """Named playlists saved per guild and per user in sqlite, with the metadata of their tracks.
+        Loading one only reads the database, the tracks are queued without asking yt-dlp again.
+        The queries run on the database thread of the music cog and are awaited."""
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS playlists (
+            id INTEGER PRIMARY KEY,
+            guild_id INTEGER NOT NULL,
+            owner_id INTEGER NOT NULL,
+            name TEXT NOT NULL COLLATE NOCASE,
+            saved_at REAL NOT NULL,
+            UNIQUE (guild_id, owner_id, name)
+        );
+        CREATE TABLE IF NOT EXISTS tracks (
+            playlist_id INTEGER NOT NULL REFERENCES playlists(id) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            url TEXT NOT NULL,
+            title TEXT,
+            length REAL,
+            canonical_id TEXT NOT NULL,
+            PRIMARY KEY (playlist_id, position)
+        ) WITHOUT ROWID;
+    '''
+
+    def __init__(self, path: str = None):
+        self.db = Database.acquire(path or library_path, self.SCHEMA, "Playlist library", self._setup)
+
+    @staticmethod
+    def _setup(conn):
+        conn.execute('PRAGMA foreign_keys = ON')
+
+    def close(self):
+        self.db.release()
+
+    async def save(self, guild_id: int, owner_id: int, name: str, entries):
+        """Save entries under a name, replacing a playlist of the same name. Returns the number of tracks"""
+        rows = [(e.url, e.title, e.length, canonical_id(e.url)) for e in entries]
+        return await self.db.run(self._save, guild_id, owner_id, name, rows)
+
+    def _save(self, conn, guild_id: int, owner_id: int, name: str, rows):
+        start = time.perf_counter_ns()
+        with conn:
+            conn.execute('DELETE FROM playlists WHERE guild_id = ? AND owner_id = ? AND name = ?',
+                         (guild_id, owner_id, name))
+            playlist_id = conn.execute('INSERT INTO playlists (guild_id, owner_id, name, saved_at) VALUES (?, ?, ?, ?)',
+                                       (guild_id, owner_id, name, time.time())).lastrowid
+            conn.executemany('INSERT INTO tracks (playlist_id, position, url, title, length, canonical_id) '
+                             'VALUES (?, ?, ?, ?, ?, ?)',
+                             ((playlist_id, i, *row) for i, row in enumerate(rows)))
+        logger.debug(f"Took [{time.perf_counter_ns() - start}] nanoseconds to save {len(rows)} tracks as '{name}'")
+        return len(rows)
+
+    def _find(self, conn, guild_id: int, owner_id: int, name: str):
+        """Id of the playlist of the user with that name, or else the guild one"""
+        row = conn.execute('SELECT id FROM playlists WHERE guild_id = ? AND owner_id IN (?, ?) AND name = ? '
+                           'ORDER BY owner_id = ? LIMIT 1',
+                           (guild_id, owner_id, GUILD_OWNER, name, GUILD_OWNER)).fetchone()
+        return row[0] if row else None
+
+    async def load(self, guild_id: int, owner_id: int, name: str):
+        """Tracks of a saved playlist in order, None if there is no playlist with that name"""
+        return await self.db.run(self._load, guild_id, owner_id, name)
+
+    def _load(self, conn, guild_id: int, owner_id: int, name: str):
+        start = time.perf_counter_ns()
+        playlist_id = self._find(conn, guild_id, owner_id, name)
+        if playlist_id is None:
+            return None
+        tracks = [SavedTrack(*row) for row in
+                  conn.execute('SELECT url, title, length, canonical_id FROM tracks '
+                               'WHERE playlist_id = ? ORDER BY position', (playlist_id, ))]
+        logger.debug(f"Took [{time.perf_counter_ns() - start}] nanoseconds to load {len(tracks)} tracks of '{name}'")
+        return tracks
+
+    async def delete(self, guild_id: int, owner_id: int, name: str):
+        return await self.db.run(self._delete, guild_id, owner_id, name)
+
+    def _delete(self, conn, guild_id: int, owner_id: int, name: str):
+        with conn:
+            cursor = conn.execute('DELETE FROM playlists WHERE guild_id = ? AND owner_id = ? AND name = ?',
+                                  (guild_id, owner_id, name))
+        return cursor.rowcount > 0
+
+    async def playlists(self, guild_id: int, owner_id: int):
+        """(name, owner id, track count) of the playlists of a user and of the guild"""
+        return await self.db.run(self._playlists, guild_id, owner_id)
+
+    def _playlists(self, conn, guild_id: int, owner_id: int):
+        return conn.execute('SELECT p.name, p.owner_id, COUNT(t.position) FROM playlists p '
+                            'LEFT JOIN tracks t ON t.playlist_id = p.id '
+                            'WHERE p.guild_id = ? AND p.owner_id IN (?, ?) '
+                            'GROUP BY p.id ORDER BY p.owner_id = ?, p.name',
+                            (guild_id, owner_id, GUILD_OWNER, GUILD_OWNER)).fetchall()
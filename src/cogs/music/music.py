@@ -2,23 +2,61 @@ import asyncio
 import discord
 import math
 import re
+import time
 import logging
 
-from discord.ext import commands
-from .ytdl import YTDLError, YTDLExtractorFlat, YTDLExtractorNonFlat, YTDLMetadata
+from discord.ext import commands, tasks
+from .ytdl import YTDLError, YTDLExtractorFlat, YTDLExtractorNonFlat, YTDLMetadata, BasicMetadata, format_length, parse_length
 from .player import VoiceState
+from .telemetry import Telemetry, TrackTelemetry
+from .journal import QueueJournal, after_writes
+from .library import PlaylistLibrary, GUILD_OWNER
+from .views import Paginator
+from .scheduler import PlayerScheduler
+from .workers import WorkerPool
+from .standby import Heartbeat, heartbeat_interval, owns_guild
+from ..outbox import outbox_for
 
 logger = logging.getLogger('discord.' + __name__)
 logger.setLevel(logging.DEBUG)
 
 error_message_lifetime = None
 info_message_lifetime = None
+queue_checkpoint_interval = 15  # seconds between the play offset checkpoints of the queue journals
+audio_workers = 0   # processes running yt-dlp and ffmpeg for the players, 0 runs them in the bot process
+handover_timeout = 10   # seconds the players of an unloaded cog wait for a reloaded one before they are torn down
+
+class Handover():
+    """The live players of an unloaded Music cog, left on the bot for the instance a reload loads next.
+        The voice clients keep playing through the reload, the new cog adopts the players with everything they hold."""
+    def __init__(self, cog):
+        self.voice_states = cog.voice_states
+        self.telemetry = cog.telemetry
+        self.library = cog.library
+        self.scheduler = cog.scheduler
+        self.audio_workers = cog.audio_workers
+        self.started = time.perf_counter_ns()
+        self.claimed = False
 
 class Music(commands.Cog):
+    # Commands that don't need a player, these never create a voice state
+    stateless_commands = ['playstats', 'schedstats', 'playlists', 'delplaylist', 'delguildplaylist']
+    
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.voice_states = {}
         self.error_count = 0
+        self.outbox = outbox_for(bot)
+        self._heartbeat = Heartbeat(shard_ids = getattr(bot, 'shard_ids', None))
+        handover = getattr(bot, 'music_handover', None)
+        bot.music_handover = None
+        if handover is not None:
+            self.adopt(handover)
+        else:
+            self.voice_states = {}
+            self.telemetry = Telemetry()
+            self.library = PlaylistLibrary()
+            self.scheduler = PlayerScheduler()
+            self.audio_workers = WorkerPool(audio_workers) if audio_workers > 0 else None
         
         self.regex = re.compile(
         r'^(?:http|ftp)s?://' # http:// or https://
@@ -31,17 +69,161 @@ class Music(commands.Cog):
     def validate_url(self, string: str):
         return re.match(self.regex, string) is not None
     
+    def owns_guild(self, guild_id: int):
+        """Whether the guild is on a shard of this process, when the bot runs as several processes"""
+        return owns_guild(guild_id, getattr(self.bot, 'shard_ids', None), getattr(self.bot, 'shard_count', None))
+    
     def get_voice_state(self, ctx: commands.Context):
         state = self.voice_states.get(ctx.guild.id)
         if not state:
-            state = VoiceState(self.bot, ctx)
+            state = VoiceState(self.bot, self, ctx.guild, ctx.channel)
             self.voice_states[ctx.guild.id] = state
             
         return state
     
+    async def cog_load(self):
+        self.scheduler.start()
+        if self.audio_workers is not None:
+            self.audio_workers.start()
+        self.checkpoint_queues.start()
+        self.heartbeat.start()
+        self.bot.loop.create_task(self.restore_queues())
+    
     def cog_unload(self):
+        self.checkpoint_queues.cancel()
+        self.heartbeat.cancel()
+        if getattr(self.bot, 'reloading', None) == __name__:
+            # Leave the players running for the reloaded cog, they are torn down if it never claims them.
+            # The queues are journaled first, so a reload that crashes the bot loses nothing
+            for state in self.voice_states.values():
+                state.checkpoint()
+            handover = self.bot.music_handover = Handover(self)
+            self.bot.loop.call_later(handover_timeout, self.abandon, handover)
+        else:
+            self.teardown()
+    
+    def adopt(self, handover: Handover):
+        """Take over the players of the unloaded cog, playback goes on as if nothing happened"""
+        handover.claimed = True
+        self.voice_states = handover.voice_states
+        self.telemetry = handover.telemetry
+        self.library = handover.library
+        self.scheduler = handover.scheduler
+        self.audio_workers = handover.audio_workers
         for state in self.voice_states.values():
+            state._cog = self
+            self.scheduler.wake(state)
+        logger.info(f"Took over {len(self.voice_states)} players from the unloaded music cog")
+        logger.debug(f"Took [{time.perf_counter_ns() - handover.started}] nanoseconds from unloading the music cog to adopting its players")
+    
+    def abandon(self, handover: Handover):
+        """Tear down the players if no reloaded cog claimed them"""
+        if handover.claimed:
+            return
+        if self.bot.music_handover is handover:
+            self.bot.music_handover = None
+        logger.warning(f"No music cog took over {len(self.voice_states)} players, stopping them")
+        self.teardown()
+    
+    def teardown(self):
+        self.scheduler.stop()
+        for state in self.voice_states.values():
+            state.save_queue()  # Before the teardown, so loading the cog again picks the queue back up
             self.bot.loop.create_task(state.cancel_task_and_disconnect())
+        self.library.close()
+        if self.audio_workers is not None:
+            self.audio_workers.close()
+    
+    @tasks.loop(seconds = queue_checkpoint_interval)
+    async def checkpoint_queues(self):
+        for state in self.voice_states.values():
+            state.checkpoint()
+    
+    @tasks.loop(seconds = heartbeat_interval)
+    async def heartbeat(self):
+        if not self._heartbeat.beat():
+            # A standby took over while this process was stalled, two processes can't play to the same channels.
+            # Closing the bot unloads this cog and cancels this loop, so it runs in its own task
+            logger.critical("Another process took over the players, shutting down")
+            self.heartbeat.stop()
+            self.abdicate()
+            self.bot.loop.create_task(self.bot.close())
+    
+    def abdicate(self):
+        """Stop the players without touching the journals or the voice channels, they belong to the standby now"""
+        self.scheduler.stop()
+        for state in self.voice_states.values():
+            state.abdicate()
+        self.voice_states = {}
+    
+    async def restore_queues(self):
+        """Rebuild the queues saved in the journals and rejoin their voice channels.
+            After a failover the standby's copies of the journals are used, read up to the last line of the primary"""
+        await self.bot.wait_until_ready()
+        takeover = getattr(self.bot, 'takeover', None)
+        self.bot.takeover = None
+        # Read after the writes of a cog unloaded meanwhile, and off the event loop
+        saved_guilds = takeover.states if takeover is not None else await after_writes(QueueJournal.saved_guilds)
+        restores = []
+        for guild_id in saved_guilds:
+            if guild_id in self.voice_states:   # Someone started a new queue meanwhile
+                continue
+            if not self.owns_guild(guild_id):   # Restored by the process running its shard
+                continue
+            saved = takeover.states[guild_id] if takeover is not None else await after_writes(QueueJournal.load, guild_id)
+            restores.append(self.restore_queue(guild_id, saved))
+        # Rejoining a voice channel takes a round trip or two, every guild does it at once
+        restored = sum(await asyncio.gather(*restores))
+        
+        if takeover is not None:
+            now = time.time()
+            since_beat = f"{now - takeover.last_beat:.2f}s after the last heartbeat of the primary, " if takeover.last_beat else ""
+            logger.warning(f"Took over {restored} queues {since_beat}{now - takeover.noticed:.2f}s after noticing it was gone")
+    
+    async def restore_queue(self, guild_id: int, saved):
+        """Rejoin the voice channel of a saved queue and play it from where it was, True if it was restored"""
+        start = time.perf_counter_ns()
+        guild = self.bot.get_guild(guild_id)
+        voice_channel = guild.get_channel(saved.voice_channel) if guild and saved.voice_channel else None
+        text_channel = guild.get_channel(saved.text_channel) if guild and saved.text_channel else None
+        if voice_channel is None or text_channel is None or not saved.entries:
+            QueueJournal(guild_id).discard()
+            return False
+        
+        try:
+            voice = guild.voice_client or await voice_channel.connect()
+        except (discord.ClientException, asyncio.TimeoutError) as e:
+            logger.warning(f"[{guild}] Couldn't rejoin {voice_channel} to restore the queue: {e}")
+            return False
+        if guild_id in self.voice_states:   # Someone started a new queue while we connected
+            return False
+        
+        state = VoiceState(self.bot, self, guild, text_channel)
+        state.voice = voice
+        state.restore_queue(saved)
+        self.voice_states[guild_id] = state
+        if not any(not m.bot for m in voice_channel.members):
+            state.suspend()
+        logger.info(f"[{guild}] Restored {len(saved.entries)} songs in {(time.perf_counter_ns() - start) / 1e6:.2f}ms")
+        return True
+    
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
+        """Suspend the player when the last listener leaves its voice channel and resume when someone joins"""
+        state = self.voice_states.get(member.guild.id)
+        if state is None or not state.voice or state.voice.channel is None:
+            return
+        
+        channel = state.voice.channel
+        if before.channel != channel and after.channel != channel and member.id != self.bot.user.id:
+            return
+        if member.id == self.bot.user.id:
+            state.checkpoint()  # Journal the channel the bot was moved to
+        
+        if any(not m.bot for m in channel.members):
+            state.resume_listeners()
+        else:
+            state.suspend()
             
     def cog_check(self, ctx: commands.Context):
         """Check before invoking any command from the cog"""
@@ -52,12 +234,14 @@ class Music(commands.Cog):
         state = self.voice_states.get(ctx.guild.id)
         
         # Check for any command used before join,play,playtop. Prevents unnecessary player initialization.
-        if not ((state is not None) or (ctx.command.name in ['join', 'play', 'playtop'])):
+        if not ((state is not None) or (ctx.command.name in ['join', 'play', 'playtop', 'loadplaylist'] + self.stateless_commands)):
             return False
         
         return True
     
     async def cog_before_invoke(self, ctx: commands.Context):
+        if ctx.command.name in self.stateless_commands:
+            return
         ctx.voice_state = self.get_voice_state(ctx)
         
     async def cog_command_error(self, ctx: commands.Context, error: commands.CommandError):
@@ -95,13 +279,12 @@ class Music(commands.Cog):
                                         title = "Command Error",
                                         description = f"There has been an error.{additional_info}")
     
-    async def cleanup(self, ctx, guild):
+    async def cleanup(self, guild, channel):
         try:
-            await ctx.voice_state.cancel_task_and_disconnect()
-            await self.send_error_embed(ctx, title = f"Player Timeout",
-                                        description = f"The player has timed out due to being idle.\nLeaving the voice channel.",
-                                        lifetime = None)
-        except AttributeError:
+            await self.voice_states[guild.id].cancel_task_and_disconnect()
+            self.outbox.info(channel.id, f"The player has timed out due to being idle.\nLeaving the voice channel.",
+                             title = f"Player Timeout", color = discord.Color.red())
+        except (AttributeError, KeyError):
             pass
 
         try:
@@ -109,21 +292,51 @@ class Music(commands.Cog):
         except KeyError:
             pass
         
+    async def resolve_song(self, ctx: commands.Context, song: str):
+        """Queue number from a number, an offset from the nowplaying song like -3, or a part of a song title.
+            None if no title matches"""
+        song = song.strip()
+        if song.isdigit():
+            return int(song)
+        if song[:1] == '-' and song[1:].isdigit():
+            return ctx.voice_state.nowplaying_index - int(song[1:])
+        return await ctx.voice_state.find_song(song)
+    
+    def parse_song_ranges(self, songs: str):
+        """Inclusive (first, last) queue number ranges from numbers and ranges like '3 7 9' or '5-50, 60',
+            None if songs isn't made of those alone"""
+        tokens = re.split(r'[\s,]+', songs.strip())
+        ranges = []
+        for token in tokens:
+            match = re.fullmatch(r'(\d+)(?:-(\d+))?', token)
+            if match is None:
+                return None
+            first = int(match[1])
+            ranges.append((first, int(match[2] or first)))
+        return ranges
+    
     async def send_info_embed(self, ctx: commands.Context, 
                               description: str, title: str = None, 
                               lifetime: float = info_message_lifetime):
-        _embed = discord.Embed(title = title,
-                               description = description, 
-                               color =  discord.Color.gold())
-        await ctx.send(embed = _embed, delete_after = lifetime)
+        # Queued rather than sent, the infos of a burst of commands go out as one embed
+        self.outbox.info(ctx.channel.id, description, title = title, color = discord.Color.gold(), delete_after = lifetime)
     
     async def send_error_embed(self, ctx: commands.Context,
                                description: str, title: str = "Command Error",
                                lifetime: float = error_message_lifetime):
-        _embed = discord.Embed(title = title,
-                               description = description, 
-                               color =  discord.Color.red())
-        await ctx.send(embed = _embed, delete_after = lifetime)
+        self.outbox.info(ctx.channel.id, description, title = title, color = discord.Color.red(), delete_after = lifetime)
+    
+    async def send_embed(self, ctx: commands.Context, embed: discord.Embed, lifetime: float = info_message_lifetime):
+        # Through the outbox as well, so it can't overtake the infos queued before it
+        self.outbox.embed(ctx.channel.id, embed, delete_after = lifetime)
+    
+    async def send_paginator(self, ctx: commands.Context, paginator: Paginator):
+        # The buttons edit the message discord.py sends, so it goes around the outbox once that is empty
+        await self.outbox.flush(ctx.channel.id)
+        await paginator.send(ctx, delete_after = info_message_lifetime)
+    
+    def react(self, ctx: commands.Context, emoji: str):
+        self.outbox.react(ctx.channel.id, ctx.message.id, emoji)
         
     async def ensure_voice(ctx: commands.Context):
         """Ensures that user is connected to a voice channel"""
@@ -143,6 +356,7 @@ class Music(commands.Cog):
         voice_client = discord.utils.get(self.bot.voice_clients, guild = ctx.guild)
         if (not ctx.voice_state.voice) and voice_client:
             ctx.voice_state.voice = ctx.voice_client
+            ctx.voice_state.checkpoint()
             return
         
         voice_channel = ctx.author.voice.channel
@@ -150,6 +364,7 @@ class Music(commands.Cog):
             await ctx.voice_state.voice.move_to(voice_channel)
         else:
             ctx.voice_state.voice = await voice_channel.connect()
+        ctx.voice_state.checkpoint()
             
     @commands.command(name='disconnect', aliases=['leave','stop'])
     async def _disconnect(self, ctx: commands.Context):
@@ -192,7 +407,7 @@ class Music(commands.Cog):
         
         if ctx.voice_state.is_loaded and ctx.voice_state.voice.is_playing():
             ctx.voice_state.voice.pause()
-            await ctx.message.add_reaction('⏯')
+            self.react(ctx, '⏯')
         
     @commands.command(name='resume', aliases=['res'])
     async def _resume(self, ctx: commands.Context):
@@ -200,7 +415,7 @@ class Music(commands.Cog):
         
         if ctx.voice_state.is_loaded and ctx.voice_state.voice.is_paused():
             ctx.voice_state.voice.resume()
-            await ctx.message.add_reaction('⏯')
+            self.react(ctx, '⏯')
             
     @commands.command(name='skip', aliases=['next'])
     async def _skip(self, ctx: commands.Context):
@@ -209,15 +424,34 @@ class Music(commands.Cog):
         if not ctx.voice_state.is_loaded:
             return await self.send_info_embed(ctx, f"Nothing is playing right now.")
             
-        await ctx.message.add_reaction('⏭')
+        self.react(ctx, '⏭')
         ctx.voice_state.skip_song()
         
+    @commands.command(name='seek')
+    async def _seek(self, ctx: commands.Context, *, position: str):
+        """Plays the current song from a time on (1:23 or 83)"""
+        
+        if not ctx.voice_state.is_loaded:
+            return await self.send_info_embed(ctx, f"Nothing is playing right now.")
+        
+        seconds = parse_length(position)
+        length = ctx.voice_state.current.length
+        if seconds is None or (length and seconds >= length):
+            return await self.send_error_embed(ctx, f"Please check the time.")
+        
+        if await ctx.voice_state.seek(seconds):
+            self.react(ctx, '⏩')
+        
     @commands.command(name='skipto', aliases=['st'])
-    async def _skipto(self, ctx: commands.Context, index: int):
-        """Skips song to given queue number"""
+    async def _skipto(self, ctx: commands.Context, *, song: str):
+        """Skips song to given queue number, title or offset back from the current song (-3)"""
         
         if not ctx.voice_state.is_loaded:
             return await self.send_info_embed(ctx, f"Nothing is playing right now.")
+        
+        index = await self.resolve_song(ctx, song)
+        if index is None:
+            return await self.send_error_embed(ctx, f"No song in the playlist matches '{song}'.")
             
         try:
             logger.debug(f"Skipto: current nowplaying = {ctx.voice_state.nowplaying_index}")
@@ -227,7 +461,7 @@ class Music(commands.Cog):
         except:
             raise commands.CommandError(f'Skipto command has encountered an error.')
         else:
-            await ctx.message.add_reaction('⏭')
+            self.react(ctx, '⏭')
         
     @commands.command(name='previous', aliases = ['prev'])
     async def _previous(self, ctx: commands.Context):
@@ -244,60 +478,123 @@ class Music(commands.Cog):
         except IndexError:
             return await self.send_error_embed(ctx, f"There was an error playing previous song.")
         else:
-            await ctx.message.add_reaction('⏭')
+            self.react(ctx, '⏭')
         
     @commands.command(name='queue', aliases=['q', 'playlist', 'list'])
     async def _queue(self, ctx: commands.Context, page: int = 0):
         """Show the player's queue. 
-        Can specify page to view. 10 entries per page"""
+        Can specify page to view, the buttons flip through the others. 10 entries per page"""
         
         if ctx.voice_state.playlist_empty:
             return await self.send_info_embed(ctx, f"The playlist is empty.")
         
-        playlist_len = len(ctx.voice_state.playlist[:])
-        items_per_page = 10
-        pages = math.ceil(playlist_len/items_per_page)
-        
-        nowplaying_index = ctx.voice_state.nowplaying_index
         logger.debug(f"Request for playlist page: {page}")
-        page = math.ceil(nowplaying_index/items_per_page) if page == 0 else page
+        voice_state = ctx.voice_state
+        paginator = Paginator(lambda page: self.queue_embed(voice_state, page), page)
+        await self.send_paginator(ctx, paginator)
+    
+    async def queue_embed(self, voice_state: VoiceState, page: int):
+        """(embed, page, pages) of a page of the queue, page 0 is the page of the nowplaying song"""
+        playlist = voice_state.playlist
+        if playlist.playlist_empty:
+            return discord.Embed(description = f"The playlist is empty.", color = discord.Color.gold()), 1, 1
+        
+        items_per_page = 10
+        nowplaying_index = playlist.nowplaying_index
+        pages = math.ceil(len(playlist)/items_per_page)
+        page = max(1, math.ceil(nowplaying_index/items_per_page)) if page == 0 else min(max(1, page), pages)
         logger.debug(f"Sending playlist page: {page}")
         
+        queue, footer = await playlist.cached_page(('queue', page), 
+                                             lambda: self.render_queue_page(playlist, page, items_per_page))
+        # The remaining time changes as the song plays, so it isn't part of the cached page
+        upcoming = len(playlist) - nowplaying_index
+        remaining = format_length(voice_state.remaining_duration())
+        description = f"**{upcoming} upcoming tracks, {remaining} remaining:**\n\n{queue}"
+        embed = discord.Embed(description = description, 
+                               color = discord.Color.blurple()).set_footer(text = footer)
+        return embed, page, pages
+    
+    async def render_queue_page(self, playlist, page: int, items_per_page: int):
+        """Render a page of the queue as (entries, footer), only reads the entries on that page"""
+        playlist_len = len(playlist)
+        pages = math.ceil(playlist_len/items_per_page)
+        nowplaying_index = playlist.nowplaying_index
+        
         start = (page - 1) * items_per_page
         end = start + items_per_page
         
-        queue = ''
-        for i, song in enumerate(ctx.voice_state.playlist[start:end], start = start):
+        lines = []
+        for i, song in enumerate(await playlist.window(start, end), start = start):
+            length = f" `{format_length(song.length)}`" if song.length else ""
             if i == nowplaying_index - 1:
-                queue += f"`{i+1}.` \N{Headphone} [{song.title}]({song.url})\n"
+                lines.append(f"`{i+1}.` \N{Headphone} [{song.title}]({song.url}){length}\n")
             else:
-                queue += f"`{i+1}.` [{song.title}]({song.url})\n"
-            
-        embed = discord.Embed(description = f"**{playlist_len - nowplaying_index} upcoming tracks:**\n\n{queue}", 
-                               color = discord.Color.blurple()).set_footer(text = f"Viewing page {page}/{pages}")
-        await ctx.send(embed = embed, delete_after = info_message_lifetime)
+                lines.append(f"`{i+1}.` [{song.title}]({song.url}){length}\n")
+        queue = ''.join(lines)
+        
+        footer = f"Viewing page {page}/{pages}"
+        if playlist.fair_mode:
+            footer += " \N{Middle Dot} Fair mode"
+        return (queue, footer)
+    
+    @commands.command(name='eta', aliases=['when'])
+    async def _eta(self, ctx: commands.Context, *, song: str = None):
+        """Shows when a song will play, your next song by default"""
+        
+        if ctx.voice_state.upcoming_empty:
+            return await self.send_info_embed(ctx, f"No songs are coming up.")
+        
+        if song is None:
+            found = ctx.voice_state.next_eta(ctx.author.id)
+            if found is None:
+                return await self.send_info_embed(ctx, f"You have no songs coming up.")
+            index, seconds = found
+        else:
+            index = await self.resolve_song(ctx, song)
+            if index is None:
+                return await self.send_error_embed(ctx, f"No song in the playlist matches '{song}'.")
+            seconds = ctx.voice_state.eta(index)
+            if seconds is None:
+                return await self.send_error_embed(ctx, f"That song isn't coming up.")
+        
+        entry = (await ctx.voice_state.playlist.window(index - 1, index))[0]
+        await self.send_info_embed(ctx, f"`{index}.` **{entry.title}** plays in {format_length(seconds)}.")
     
     @commands.command(name='history', aliases=['hist'])
-    async def _hist(self, ctx: commands.Context, *, page: int = 1):
-        """Show the player's queue. 
-        Can specify page to view. 10 entries per page"""
+    async def _hist(self, ctx: commands.Context, *, page: int = 0):
+        """Show the songs played before the current one. 
+        Can specify page to view, defaults to the latest. 10 entries per page"""
         
-        if len(ctx.voice_state.songs_history) == 0:
+        if ctx.voice_state.nowplaying_index <= 1:
             return await self.send_info_embed(ctx, f"The played queue is empty.")
+        
+        voice_state = ctx.voice_state
+        paginator = Paginator(lambda page: self.history_embed(voice_state, page), page)
+        await self.send_paginator(ctx, paginator)
+    
+    async def history_embed(self, voice_state: VoiceState, page: int):
+        """(embed, page, pages) of a page of the played songs, page 0 is the latest page"""
+        playlist = voice_state.playlist
+        played = max(0, playlist.nowplaying_index - 1)
+        if played == 0:
+            return discord.Embed(description = f"The played queue is empty.", color = discord.Color.gold()), 1, 1
             
         items_per_page = 10
-        pages = math.ceil(len(ctx.voice_state.songs_history)/items_per_page)
+        pages = math.ceil(played/items_per_page)
+        page = pages if page == 0 else min(max(1, page), pages)
         
-        start = (page - 1) * items_per_page
-        end = start + items_per_page
+        async def render():
+            start = (page - 1) * items_per_page
+            end = min(start + items_per_page, played)
+            queue = ''.join(f"`{i+1}.` [**{song.title}**]({song.url})\n"
+                            for i, song in enumerate(await playlist.window(start, end), start = start))
+            return f"**{played} tracks have been played:**\n\n{queue}", f"Viewing page {page}/{pages}"
         
-        queue = ''
-        for i, song in enumerate(ctx.voice_state.songs_history[start:end], start = start):
-            queue += f"`{i+1}.` [**{song.title}**]({song.url})\n"
-            
-        embed = discord.Embed(description = f"**{len(ctx.voice_state.songs_history)} tracks have been played:**\n\n{queue}", 
-                               color = discord.Color.green()).set_footer(text = f"Viewing page {page}/{pages}")
-        await ctx.send(embed = embed, delete_after = info_message_lifetime)
+        description, footer = await playlist.cached_page(('history', page), render)
+        embed = discord.Embed(description = description, 
+                               color = discord.Color.green()).set_footer(text = footer)
+        return embed, page, pages
         
     @commands.command(name='previnfo', aliases=['pi'])
     async def _previnfo(self, ctx: commands.Context):
@@ -309,7 +606,7 @@ class Music(commands.Cog):
             return await self.send_error_embed(ctx, f"There is no song before the currently playing song.")
         
         _embed = await ctx.voice_state.prev_info_embed()
-        await ctx.send(embed = _embed, delete_after = info_message_lifetime)
+        await self.send_embed(ctx, _embed)
     
     @commands.command(name='nowplaying', aliases=['np','now','current'])
     async def _nowplaying(self, ctx: commands.Context):
@@ -318,7 +615,7 @@ class Music(commands.Cog):
         if not ctx.voice_state.is_loaded:
             return await self.send_info_embed(ctx, f"Nothing is playing right now.")
         
-        await ctx.send(embed = ctx.voice_state.current_info_embed(), delete_after = info_message_lifetime)
+        await self.send_embed(ctx, ctx.voice_state.current_info_embed())
         
     @commands.command(name='nextinfo', aliases=['ni'])
     async def _nextinfo(self, ctx: commands.Context):
@@ -330,7 +627,7 @@ class Music(commands.Cog):
             return await self.send_info_embed(ctx, f"There are no upcoming songs.")
         
         _embed = await ctx.voice_state.next_info_embed()
-        await ctx.send(embed = _embed, delete_after = info_message_lifetime)
+        await self.send_embed(ctx, _embed)
         
     @commands.command(name='shuffle')
     async def _shuffle(self, ctx: commands.Context):
@@ -340,39 +637,53 @@ class Music(commands.Cog):
             return await self.send_info_embed(ctx, f"The playlist is empty.")
 
         ctx.voice_state.shuffle_queue()
-        await ctx.message.add_reaction('\N{Twisted Rightwards Arrows}')
+        self.react(ctx, '\N{Twisted Rightwards Arrows}')
+        
+    @commands.command(name='unshuffle')
+    async def _unshuffle(self, ctx: commands.Context):
+        """Restores the queue order from before shuffling"""
+
+        if not ctx.voice_state.unshuffle_queue():
+            return await self.send_info_embed(ctx, f"The queue isn't shuffled.")
+        self.react(ctx, '\N{Clockwise Rightwards and Leftwards Open Circle Arrows}')
     
     @commands.command(name='remove')
-    async def _remove(self, ctx: commands.Context, index: str = None):
-        """Removes a song from the queue at a given index or from a user"""
+    async def _remove(self, ctx: commands.Context, *, index: str = None):
+        """Removes a song from the queue at a given index or title, several like 3 7 9 or 5-50, or the songs of a user"""
 
         if ctx.voice_state.playlist_empty:
             return await self.send_info_embed(ctx, f"The playlist is empty.")
         
         if index == None:
             return await self.send_error_embed(ctx, f"Please provide a song to remove.")
-        elif index.isdigit():
+        elif len(ctx.message.mentions) == 0:
+            ranges = self.parse_song_ranges(index)
+            if ranges is not None and (len(ranges) > 1 or ranges[0][0] != ranges[0][1]):
+                count = ctx.voice_state.remove_songs(ranges)
+                if count == 0:
+                    return await self.send_error_embed(ctx, f"Please check the indexes.")
+                return await self.send_info_embed(ctx, f"Removed {count} songs from the playlist.")
+            song = await self.resolve_song(ctx, index)
+            if song is None:
+                return await self.send_error_embed(ctx, f"No song in the playlist matches '{index}'.")
             try:
-                ctx.voice_state.remove_song(int(index))
+                ctx.voice_state.remove_song(song)
             except IndexError:
                 return await self.send_error_embed(ctx, f"Please check the index.")
             else:
-                await ctx.message.add_reaction('\N{White Heavy Check Mark}')
+                self.react(ctx, '\N{White Heavy Check Mark}')
         else:
-            if len(ctx.message.mentions) == 0:
-                return await self.send_error_embed(ctx, f"Please provide a song to remove.")
-            else:
-                requesters_to_remove = []
-                for user_mentioned in ctx.message.mentions:
-                    requesters_to_remove.append(user_mentioned.id)
-                    
-                try:
-                    count = await ctx.voice_state.remove_requesters(requesters_to_remove)
-                    await self.send_info_embed(ctx, f"Removed {count} songs from the playlist.")
-                except:
-                    #await self.send_error_embed(ctx, f"There was an error in removing the songs")
-                    raise commands.CommandError()
-                    #await self.send_info_embed(ctx, f"{people} were mentioned.")
+            requesters_to_remove = []
+            for user_mentioned in ctx.message.mentions:
+                requesters_to_remove.append(user_mentioned.id)
+                
+            try:
+                count = await ctx.voice_state.remove_requesters(requesters_to_remove)
+                await self.send_info_embed(ctx, f"Removed {count} songs from the playlist.")
+            except:
+                #await self.send_error_embed(ctx, f"There was an error in removing the songs")
+                raise commands.CommandError()
+                #await self.send_info_embed(ctx, f"{people} were mentioned.")
     
     @commands.command(name='remdupes')
     async def _remove_dupes(self, ctx: commands.Context):
@@ -387,6 +698,34 @@ class Music(commands.Cog):
         except:
             raise commands.CommandError()
         
+    @commands.command(name='nodupes')
+    async def _toggle_no_dupes(self, ctx: commands.Context, value: str = None):
+        """Toggles rejecting songs that are already in the playlist or sets a given state"""
+        
+        if value == None:
+            value = ctx.voice_state.toggle_no_duplicates()
+        elif value in ['y', 'Y', 'T', 't', '1', 'on', 'ON', 'On']:
+            value = ctx.voice_state.toggle_no_duplicates(True)
+        elif value in ['n', 'N', 'F', 'f', '0', 'off', 'OFF', 'Off']:
+            value = ctx.voice_state.toggle_no_duplicates(False)
+        
+        msg = "on" if value else "off"
+        await self.send_info_embed(ctx, f"No duplicates mode has been turned {msg}.")
+        
+    @commands.command(name='fair')
+    async def _toggle_fair(self, ctx: commands.Context, value: str = None):
+        """Toggles playing the upcoming songs round robin by requester or sets a given state"""
+        
+        if value == None:
+            value = ctx.voice_state.toggle_fair_mode()
+        elif value in ['y', 'Y', 'T', 't', '1', 'on', 'ON', 'On']:
+            value = ctx.voice_state.toggle_fair_mode(True)
+        elif value in ['n', 'N', 'F', 'f', '0', 'off', 'OFF', 'Off']:
+            value = ctx.voice_state.toggle_fair_mode(False)
+        
+        msg = "on" if value else "off"
+        await self.send_info_embed(ctx, f"Fair mode has been turned {msg}.")
+        
     @commands.command(name='remabs')
     async def _remove_absent(self, ctx: commands.Context):
         """Removes songs requested by absent users"""
@@ -407,19 +746,50 @@ class Music(commands.Cog):
         
         ctx.voice_state.clear_queue()
     
+    @commands.command(name='queuelimit', aliases=['ql'])
+    @commands.check_any(commands.is_owner(), commands.has_any_role("Helpers", "Moderators", "Admins"))
+    async def _queue_limit(self, ctx: commands.Context, limit: str = None):
+        """Sets the max upcoming songs per user, or turns the limit off (Staff only)"""
+        
+        if limit == None:
+            value = ctx.voice_state.queue_limit
+            msg = f"{value} songs per user" if value is not None else "off"
+            return await self.send_info_embed(ctx, f"The queue limit is {msg}.")
+        elif limit.isdigit() and int(limit) > 0:
+            ctx.voice_state.queue_limit = int(limit)
+            await self.send_info_embed(ctx, f"Users can now queue up to {limit} songs.")
+        elif limit in ['n', 'N', 'F', 'f', '0', 'off', 'OFF', 'Off']:
+            ctx.voice_state.queue_limit = None
+            await self.send_info_embed(ctx, f"The queue limit has been turned off.")
+        else:
+            await self.send_error_embed(ctx, f"Please provide a number of songs or 'off'.")
+    
     @commands.command(name='move', aliases = ['mv'])
-    async def _move(self, ctx: commands.Context, old_index: int, new_index: int):
-        """Moves a song in queue to a given index"""
+    async def _move(self, ctx: commands.Context, *, songs: str):
+        """Moves a song in queue, given by index or title, to a given index. Several songs like 10-20 or 3 7 9 move together"""
 
         if ctx.voice_state.playlist_empty:
             return await self.send_info_embed(ctx, f"The playlist is empty.")
+        
+        song, _, new_index = songs.rpartition(' ')
+        if not song or not new_index.isdigit():
+            return await self.send_error_embed(ctx, f"Please provide a song and the index to move it to.")
+        ranges = self.parse_song_ranges(song)
+        if ranges is not None and (len(ranges) > 1 or ranges[0][0] != ranges[0][1]):
+            count = await ctx.voice_state.move_songs(ranges, int(new_index))
+            if count == 0:
+                return await self.send_error_embed(ctx, f"Please check the indexes.")
+            return await self.send_info_embed(ctx, f"Moved {count} songs to {new_index}.")
+        old_index = await self.resolve_song(ctx, song)
+        if old_index is None:
+            return await self.send_error_embed(ctx, f"No song in the playlist matches '{song}'.")
             
         try:
-            await ctx.voice_state.move_song(old_index, new_index)
+            await ctx.voice_state.move_song(old_index, int(new_index))
         except IndexError:
             return await self.send_error_embed(ctx, f"Please check the index.")
         else:
-            await ctx.message.add_reaction('\N{Up Down Arrow}')
+            self.react(ctx, '\N{Up Down Arrow}')
 
     @commands.command(name='play', aliases=['p'])
     @commands.check(ensure_voice)
@@ -441,13 +811,20 @@ class Music(commands.Cog):
                 logger.error(e, exc_info = True)
                 return await self.send_error_embed(ctx, title = "YoutubeDl Error",
                                                    description = f"An error occured while processing the request: {str(e)}")
-            else:
-                if isinstance(source, YTDLMetadata):
-                    await self.send_info_embed(ctx, f"Enqueued {str(source)}")
-                elif isinstance(source, list):
-                    await self.send_info_embed(ctx, f"Enqueued {len(source)} songs.")
         
-        await ctx.voice_state.push_entry(source, pushTopFlag = pushTopFlag)
+        count = await ctx.voice_state.push_entry(source, pushTopFlag = pushTopFlag)
+        if isinstance(source, YTDLMetadata):
+            # The queue limit is checked first when adding, so it is reported first too
+            if count == 0 and ctx.voice_state.playlist.queue_allowance(ctx.author.id) == 0:
+                return await self.send_error_embed(ctx, f"You already have {ctx.voice_state.queue_limit} songs queued, "
+                                                        f"wait for some of them to play.")
+            elif count == 0:
+                return await self.send_error_embed(ctx, f"{str(source)} is already in the playlist.")
+            await self.send_info_embed(ctx, f"Enqueued {str(source)}")
+        elif isinstance(source, list):
+            skipped = len(source) - count
+            skip_info = f"\n{skipped} songs were skipped due to the queue limit or duplicates." if skipped > 0 else ""
+            await self.send_info_embed(ctx, f"Enqueued {count} songs.{skip_info}")
         
     @commands.command(name='playtop', aliases=['pt'])
     @commands.check(ensure_voice)
@@ -456,6 +833,74 @@ class Music(commands.Cog):
         
         await self._play(ctx, search = search, pushTopFlag = True)
                 
+    async def save_playlist(self, ctx: commands.Context, name: str, owner_id: int):
+        playlist = ctx.voice_state.playlist
+        if playlist.playlist_empty:
+            return await self.send_info_embed(ctx, f"The playlist is empty.")
+        
+        count = await self.library.save(ctx.guild.id, owner_id, name, await playlist.window(0, len(playlist)))
+        await self.send_info_embed(ctx, f"Saved {count} songs as '{name}'.")
+    
+    @commands.command(name='saveplaylist', aliases=['sp'])
+    async def _save_playlist(self, ctx: commands.Context, *, name: str):
+        """Saves the playlist under a name, to load it again later"""
+        
+        await self.save_playlist(ctx, name, ctx.author.id)
+    
+    @commands.command(name='saveguildplaylist', aliases=['sgp'])
+    @commands.check_any(commands.is_owner(), commands.has_any_role("Helpers", "Moderators", "Admins"))
+    async def _save_guild_playlist(self, ctx: commands.Context, *, name: str):
+        """Saves the playlist under a name for everyone in the server (Staff only)"""
+        
+        await self.save_playlist(ctx, name, GUILD_OWNER)
+    
+    @commands.command(name='loadplaylist', aliases=['lp'])
+    @commands.check(ensure_voice)
+    async def _load_playlist(self, ctx: commands.Context, *, name: str):
+        """Enqueues a saved playlist, yours or the server's"""
+        
+        tracks = await self.library.load(ctx.guild.id, ctx.author.id, name)
+        if tracks is None:
+            return await self.send_error_embed(ctx, f"There is no saved playlist named '{name}'.")
+        
+        if not ctx.voice_state.voice:
+            await ctx.invoke(self._join)
+        
+        source = [BasicMetadata(ctx, url = t.url, title = t.title, length = t.length) for t in tracks]
+        count = await ctx.voice_state.push_entry(source)
+        skipped = len(source) - count
+        skip_info = f"\n{skipped} songs were skipped due to the queue limit or duplicates." if skipped > 0 else ""
+        await self.send_info_embed(ctx, f"Enqueued {count} songs from '{name}'.{skip_info}")
+    
+    @commands.command(name='playlists', aliases=['pls'])
+    async def _playlists(self, ctx: commands.Context):
+        """Lists your saved playlists and the server's"""
+        
+        playlists = await self.library.playlists(ctx.guild.id, ctx.author.id)
+        if not playlists:
+            return await self.send_info_embed(ctx, f"There are no saved playlists.")
+        
+        lines = [f"`{name}` - {count} songs{' (server)' if owner_id == GUILD_OWNER else ''}"
+                 for name, owner_id, count in playlists]
+        await self.send_info_embed(ctx, '\n'.join(lines), title = "Saved Playlists")
+    
+    @commands.command(name='delplaylist', aliases=['dp'])
+    async def _delete_playlist(self, ctx: commands.Context, *, name: str):
+        """Deletes one of your saved playlists"""
+        
+        if not await self.library.delete(ctx.guild.id, ctx.author.id, name):
+            return await self.send_error_embed(ctx, f"You have no saved playlist named '{name}'.")
+        self.react(ctx, '\N{White Heavy Check Mark}')
+    
+    @commands.command(name='delguildplaylist', aliases=['dgp'])
+    @commands.check_any(commands.is_owner(), commands.has_any_role("Helpers", "Moderators", "Admins"))
+    async def _delete_guild_playlist(self, ctx: commands.Context, *, name: str):
+        """Deletes a saved playlist of the server (Staff only)"""
+        
+        if not await self.library.delete(ctx.guild.id, GUILD_OWNER, name):
+            return await self.send_error_embed(ctx, f"The server has no saved playlist named '{name}'.")
+        self.react(ctx, '\N{White Heavy Check Mark}')
+    
     @commands.command(name='restart')
     async def _restart(self, ctx: commands.Context):
         try:
@@ -464,6 +909,53 @@ class Music(commands.Cog):
             logger.error(e)
             await self.send_error_embed(ctx, f"There has been an error in restarting the player")
     
+    @commands.command(name='playstats', hidden = True)
+    @commands.is_owner()
+    async def _playstats(self, ctx: commands.Context, guild_id: int = None):
+        """Show playback telemetry of the recent tracks in a guild (Owner only)"""
+        
+        guild_id = guild_id or ctx.guild.id
+        tracks = self.telemetry.tracks(guild_id)
+        if len(tracks) == 0:
+            return await self.send_info_embed(ctx, f"No tracks have been played in that guild yet.")
+        
+        phases, underruns, premature_ends = self.telemetry.summary(guild_id)
+        stats = ''
+        for phase in TrackTelemetry.PHASES:
+            if phase in phases:
+                median, p95 = phases[phase]
+                stats += f"{phase:<21} {median * 1000:>8.0f} {p95 * 1000:>8.0f}\n"
+        recent = '\n'.join(str(track) for track in tracks[-5:])
+        
+        embed = (discord.Embed(title = f"Playback telemetry of the last {len(tracks)} tracks",
+                               description = f"```\n{'phase':<21} {'p50 ms':>8} {'p95 ms':>8}\n{stats}```",
+                               color = discord.Color.blurple())
+                .add_field(name = "Underruns", value = underruns)
+                .add_field(name = "Premature ends", value = premature_ends)
+                .add_field(name = "Recent tracks", value = recent[:1024], inline = False))
+        await self.send_embed(ctx, embed)
+    
+    @commands.command(name='schedstats', hidden = True)
+    @commands.is_owner()
+    async def _schedstats(self, ctx: commands.Context):
+        """Show the players per state and how far the player scheduler runs behind (Owner only)"""
+        
+        scheduler = self.scheduler
+        counts = scheduler.counts()
+        states = '\n'.join(f"{state:<10} {count:>6}" for state, count in sorted(counts.items())) or "No players"
+        active = counts.get('loading', 0) + counts.get('playing', 0)
+        embed = (discord.Embed(title = f"{active} active players of {len(scheduler.players)}",
+                               description = f"```\n{states}```",
+                               color = discord.Color.blurple())
+                .add_field(name = "Tick lag", value = f"{scheduler.lag * 1000:.1f}ms avg, {scheduler.max_lag * 1000:.1f}ms max")
+                .add_field(name = "Pending timers", value = scheduler.wheel.pending)
+                .add_field(name = "Player steps", value = scheduler.steps))
+        if self.audio_workers is not None:
+            workers = '\n'.join(f"{i}: pid {s['pid']}, {s['streams']} streams" if s else f"{i}: not answering"
+                                for i, s in enumerate(await self.audio_workers.status()))
+            embed.add_field(name = "Audio workers", value = workers, inline = False)
+        await self.send_embed(ctx, embed)
+    
     @_play.error
     @_playtop.error
     @_join.error
@@ -1,229 +1,683 @@
 import asyncio
+import discord
 import time
-import itertools
 import random
 import queue
 import logging
 
-from async_timeout import timeout
-from discord.ext import commands, tasks
+from discord.ext import commands
 from .ytdl import *
+from .telemetry import TrackTelemetry
+from .journal import QueueJournal, entry_record
+from .history import HistoryStore
+from .sequence import BlockList
+from .workers import WorkerAudioSource
+from .indexes import RequesterIndex, DuplicateIndex, ShuffleIndex, TitleIndex, FairIndex, requester_id, canonical_id
 
 logger = logging.getLogger('discord.' + __name__)
 logger.setLevel(logging.DEBUG)
 
 error_message_lifetime = None
 info_message_lifetime = None
+empty_channel_grace = 300 # seconds the player stays suspended in an empty voice channel before leaving
+history_window = 500    # played songs kept in memory, older ones are moved to the history store
+history_spill_batch = 100   # played songs moved to the store at once
+idle_timeout = 180      # seconds the player waits for a song to be queued and loaded before it leaves
+prefetch_lead = 30      # seconds before the end of a song that the next one is resolved with yt-dlp
+
+def entry_length(entry):
+    """Seconds of an entry, songs of unknown length count as 0"""
+    return entry.length or 0
 
 class SongQueue(asyncio.Queue):
-    """An async queue for songs"""
+    """An async queue for songs, that keeps the played songs behind a cursor.
+        Entries before the cursor are history, the rest are upcoming songs.
+        Only the upcoming songs count towards the asyncio.Queue size, so get() waits for those.
+        The entries live in a BlockList, so inserts, removals and moves anywhere in a long queue stay cheap.
+        Every change is reported to the EntryIndex objects in self.indexes and bumps self.version.
+        When a QueueJournal is attached, every change is also written to it.
+        The BlockList sums the song lengths, so durations of ranges of the queue cost O(log n)
+        once the blocks the range ends in have cached their prefix sums.
+        on_upcoming is called whenever upcoming songs are added, players use it instead of waiting on get()."""
+    def _init(self, maxsize):
+        self._queue = BlockList(weight = entry_length)
+        self._cursor = 0
+        self.indexes = []
+        self.version = 0
+        self.journal = None
+        self.on_upcoming = None
+        
+    def _qsize(self):
+        return len(self._queue) - self._cursor
+    
+    # asyncio.Queue sizes itself with len(self._queue), which counts the history too
+    def qsize(self):
+        return self._qsize()
+    
+    def empty(self):
+        return self._qsize() == 0
+    
+    def _put(self, item):
+        self.version += 1
+        if self.journal is not None:
+            self.journal.add(len(self._queue), (item, ))
+        self._queue.append(item)
+        for index in self.indexes:
+            index.added(item, True)
+        if self.on_upcoming is not None:
+            self.on_upcoming()
+        
+    def _get(self):
+        self.version += 1
+        item = self._queue[self._cursor]
+        self._cursor += 1
+        if self.journal is not None:
+            self.journal.seek(self._cursor)
+        for index in self.indexes:
+            index.played((item, ))
+        return item
+    
+    def _added(self, count: int = 1):
+        """Book keeping done by put_nowait(), for entries added to the upcoming part in other ways.
+            Wakes up the consumer waiting on get()"""
+        self._unfinished_tasks += count
+        self._finished.clear()
+        self._wakeup_next(self._getters)
+        if self.on_upcoming is not None:
+            self.on_upcoming()
+    
     def __getitem__(self, item):
         try:
-            if isinstance(item, slice):
-                return list(itertools.islice(self._queue, item.start, item.stop, item.step))
-            else:
-                return self._queue[item]
+            return self._queue[item]
         except IndexError:
             raise IndexError()
         
+    def __setitem__(self, index: int, item):
+        self.version += 1
+        if index < 0:
+            index += len(self._queue)
+        old_item = self._queue[index]
+        self._queue[index] = item
+        if self.journal is not None:
+            self.journal.set(index, item)
+        for entry_index in self.indexes:
+            entry_index.removed(old_item, index >= self._cursor)
+            entry_index.added(item, index >= self._cursor)
+        
     def __iter__(self):
         return self._queue.__iter__()
     
     def __len__(self):
-        return self.qsize()
+        return len(self._queue)
+    
+    @property
+    def cursor(self):
+        return self._cursor
+    
+    def index(self, item):
+        """Absolute index of an entry, O(1) unless its block changed since the last lookup"""
+        return self._queue.index(item)
+    
+    def window(self, start: int, stop: int):
+        """Entries [start, stop) without touching the rest of the queue"""
+        return list(self._queue.islice(max(0, start), stop))
+    
+    def duration_between(self, start: int, stop: int):
+        """Seconds of the entries [start, stop)"""
+        return self._queue.weight_between(max(0, start), stop)
+    
+    def upcoming(self):
+        """Iterate over the upcoming entries, lazily"""
+        return self._queue.islice(self._cursor)
+    
+    def seek(self, index: int):
+        """Move the cursor, all entries before index become history"""
+        if not 0 <= index <= len(self._queue):
+            raise IndexError()
+        self.version += 1
+        old_cursor = self._cursor
+        self._cursor = index
+        if self.journal is not None:
+            self.journal.seek(index)
+        cursor_indexes = [i for i in self.indexes if i.tracks_cursor]
+        if index > old_cursor:
+            for entry_index in cursor_indexes:
+                entry_index.played(self._queue.islice(old_cursor, index))
+        elif index < old_cursor:
+            for entry_index in cursor_indexes:
+                entry_index.unplayed(self._queue.islice(index, old_cursor))
+            self._added(0)
     
     def clear(self):
+        self.version += 1
         self._queue.clear()
+        self._cursor = 0
+        if self.journal is not None:
+            self.journal.clear()
+        for index in self.indexes:
+            index.cleared()
+        
+    def clear_upcoming(self):
+        self.version += 1
+        removed = self._queue.delete_range(self._cursor, len(self._queue))
+        if self.journal is not None:
+            self.journal.clear_upcoming()
+        for index in self.indexes:
+            for item in removed:
+                index.removed(item, True)
     
-    def shuffle(self):
-        random.shuffle(self._queue)
+    def drop_history(self, count: int):
+        """Remove the count oldest played entries, returning them"""
+        count = min(count, self._cursor)
+        self.version += 1
+        removed = self._queue.delete_range(0, count)
+        self._cursor -= count
+        if self.journal is not None:
+            self.journal.drop_history(count)
+        for index in self.indexes:
+            for item in removed:
+                index.removed(item, False)
+        return removed
+    
+    def _swap_upcoming(self, upcoming: list):
+        """Replace the upcoming part with a reordering of the same entries. Only references are moved
+            and the membership doesn't change, so the indexes don't need to hear about it"""
+        self.version += 1
+        old_upcoming = self._queue.delete_range(self._cursor, len(self._queue))
+        self._queue.insert_many(self._cursor, upcoming)
+        if self.journal is not None:
+            # Journal the new order as positions in the old one instead of writing every entry again
+            positions = {id(item): i for i, item in enumerate(old_upcoming)}
+            self.journal.permute(self._cursor, [positions[id(item)] for item in upcoming])
+    
+    def shuffle(self, shuffle_index: ShuffleIndex = None):
+        """Shuffle the upcoming songs, saving their order in the shuffle index first"""
+        upcoming = self.window(self._cursor, len(self._queue))
+        if shuffle_index is not None:
+            shuffle_index.start(upcoming)
+        random.shuffle(upcoming)
+        self._swap_upcoming(upcoming)
+        
+    def unshuffle(self, shuffle_index: ShuffleIndex):
+        """Restore the order saved by the shuffle index, returns False if the queue isn't shuffled"""
+        upcoming = shuffle_index.stop()
+        if upcoming is None:
+            return False
+        self._swap_upcoming(upcoming)
+        return True
+    
+    def round_robin(self, fair: FairIndex):
+        """Reorder the upcoming songs round robin by requester"""
+        self._swap_upcoming(fair.order(self.upcoming()))
         
     def remove(self, index: int):
-        try:
-            del self._queue[index]
-        except IndexError:
+        if index < 0:
+            index += len(self._queue)
+        if not 0 <= index < len(self._queue):
             raise IndexError()
+        self.version += 1
+        item = self._queue.pop(index)
+        if self.journal is not None:
+            self.journal.remove(index)
+        upcoming = index >= self._cursor
+        if not upcoming:
+            self._cursor -= 1
+        for entry_index in self.indexes:
+            entry_index.removed(item, upcoming)
+        return item
+    
+    def remove_range(self, start: int, stop: int):
+        """Remove entries [start, stop) as one operation, returns them"""
+        start = max(0, start)
+        stop = min(stop, len(self._queue))
+        if start >= stop:
+            return []
+        self.version += 1
+        items = self._queue.delete_range(start, stop)
+        if self.journal is not None:
+            self.journal.remove_range(start, len(items))
+        played = max(0, min(stop, self._cursor) - start)
+        self._cursor -= played
+        for entry_index in self.indexes:
+            for i, item in enumerate(items):
+                entry_index.removed(item, i >= played)
+        return items
+    
+    def remove_entry(self, item):
+        """Remove an entry without knowing its position"""
+        return self.remove(self._queue.index(item))
 
-    async def appendleft(self, x):
-        if self.qsize() == 0:   # Check added to signal the async queue.get() that something has been added
-                                # If we simply appendleft to an empty queue,
-                                # queue.get() doesn't get know that the queue now has entries
-            await self.put(x)
-        else:
-            self._queue.appendleft(x)
+    def appendleft(self, x):
+        """Add an entry to the top of the upcoming songs"""
+        self.insert(self._cursor, x)
+        
+    def extend(self, items: list):
+        """Add a batch of entries to the end of the upcoming songs"""
+        self.insert_many(len(self._queue), items)
+        
+    def prepend(self, items: list):
+        """Add a batch of entries to the top of the upcoming songs, keeping their order"""
+        self.insert_many(self._cursor, items)
+        
+    def insert_many(self, idx: int, items: list):
+        """Splice a batch of entries in at an absolute index as one operation.
+            The consumer waiting on get() is woken at most once for the whole batch."""
+        if not items:
+            return
+        idx = max(0, min(idx, len(self._queue)))
+        self.version += 1
+        self._queue.insert_many(idx, items)
+        if self.journal is not None:
+            self.journal.add(idx, items)
+        upcoming = idx >= self._cursor
+        if not upcoming:
+            self._cursor += len(items)
+        for index in self.indexes:
+            for item in items:
+                index.added(item, upcoming)
+        if upcoming:
+            self._added(len(items))
+            
+    def insert_at(self, positions: list, items: list):
+        """Insert entries at several absolute indexes as one operation, positions are ascending and
+            are where the entries end up. The consumer waiting on get() is woken at most once."""
+        if not items:
+            return
+        self.version += 1
+        if self.journal is not None:
+            self.journal.add_at(positions, items)
+        played = 0
+        for idx, item in zip(positions, items):
+            self._queue.insert(idx, item)
+            if idx < self._cursor + played:
+                played += 1
+        self._cursor += played
+        for index in self.indexes:
+            for i, item in enumerate(items):
+                index.added(item, i >= played)
+        if played < len(items):
+            self._added(len(items) - played)
             
     def insert(self, idx: int, item):
+        """Insert at an absolute index, entries inserted before the cursor become history"""
+        idx = max(0, min(idx, len(self._queue)))
+        self.version += 1
         self._queue.insert(idx, item)
+        if self.journal is not None:
+            self.journal.add(idx, (item, ))
+        upcoming = idx >= self._cursor
+        if upcoming:
+            self._added()
+        else:
+            self._cursor += 1
+        for index in self.indexes:
+            index.added(item, upcoming)
+            
+    def replace(self, entries: list, cursor: int):
+        """Replace the whole sequence, used by the bulk removals and to restore a saved queue"""
+        self.version += 1
+        self._queue.replace(entries)
+        self._cursor = cursor
+        if self.journal is not None:
+            self.journal.clear()
+            self.journal.add(0, entries)
+            self.journal.seek(cursor)
+        for index in self.indexes:
+            index.cleared()
+            for i, item in enumerate(entries):
+                index.added(item, i >= cursor)
+        if self._qsize() > 0:
+            self._added(0)
 
 class Playlist:
-    """Class rewriting songs queues, while merging upcoming and history queues behind an interface"""
-    def __init__(self):
-        self.upcoming = SongQueue()
-        self.history = SongQueue()
+    """Class rewriting songs queues, keeping history and upcoming songs in one sequence behind an interface.
+        With a HistoryStore the oldest played songs leave memory, positions as per users still count them,
+        so the songs in memory start at position self.spilled"""
+    def __init__(self, history: HistoryStore = None):
+        self.songs = SongQueue()
+        self.history = history
+        self.spilled = 0
+        self.history_window = history_window
+        self.requesters = RequesterIndex()
+        self.duplicates = DuplicateIndex()
+        self.shuffled = ShuffleIndex()
+        self.titles = TitleIndex()
+        self.fair = FairIndex()      # Only hooked up in fair mode
+        self.songs.indexes.extend([self.requesters, self.duplicates, self.shuffled, self.titles])
+        self.queue_limit = None     # Max upcoming songs per requester, None for no limit
+        self.no_duplicates = False  # Reject songs that are already in the playlist
+        self._fair_mode = False
+        
+        self._pages = {}            # Rendered pages of the current version
+        self._pages_version = -1
         
     def __del__(self):
+        # Dropping the playlist isn't a clear the journal should remember, the saved queue must outlive it
+        self.songs.journal = None
         self.clear_all_queues()
     
-    @property
-    def _playlist(self):
-        return self.history[:] + self.upcoming[:]
+    def __len__(self):
+        return self.spilled + len(self.songs)
     
     @property
     def nowplaying_index(self):
         """Return the position of nowplaying song in playlist as per users, (equals to when indexing starts at 1)"""
-        return len(self.history)
+        return self.spilled + self.songs.cursor
+    
+    @property
+    def version(self):
+        """Changes whenever the playlist or the nowplaying cursor changes"""
+        return self.songs.version
+    
+    async def window(self, start: int, stop: int):
+        """Entries [start, stop) of the playlist, costs O(stop - start) regardless of the playlist length.
+            Spilled songs are read back from the store as BasicMetadata"""
+        entries = []
+        if start < self.spilled:
+            entries = [BasicMetadata.restored(r['r'], r['c'], r['u'], r['t'], r['d'])
+                       for r in await self.history.window(start, min(stop, self.spilled))]
+        return entries + self.songs.window(start - self.spilled, stop - self.spilled)
+    
+    def window_around(self, index: int, size: int):
+        """Return (start, entries) of the size aligned window containing index"""
+        start = (index // size) * size
+        return start, self.songs.window(start, start + size)
+    
+    async def cached_page(self, key, render):
+        """Return await render(), cached until the playlist version changes"""
+        if self._pages_version != self.version:
+            self._pages.clear()
+            self._pages_version = self.version
+        page = self._pages.get(key)
+        if page is None:
+            version = self.version
+            page = await render()
+            if version == self.version == self._pages_version:  # Not rendered from an older queue
+                self._pages[key] = page
+        return page
         
     @property
     def upcoming_empty(self):
-        return len(self.upcoming) == 0
+        return self.songs.qsize() == 0
     
     @property
     def history_empty(self):
-        return len(self.history) == 0
+        return self.songs.cursor == 0
     
     @property
     def playlist_empty(self):
-        return len(self._playlist) == 0
+        return len(self.songs) == 0
     
     @property
     def previous_playable(self):
-        return len(self.history) >= 2
+        return self.songs.cursor >= 2
     
     @property
     def prev_song(self):
         if self.previous_playable:
-            return self.history[-2]
+            return self.songs[self.songs.cursor - 2]
     
     @property
     def next_song(self):
         if not self.upcoming_empty:
-            return self.upcoming[0]
+            return self.songs[self.songs.cursor]
+    
+    @property
+    def fair_mode(self):
+        """Upcoming songs are kept round robin by requester, so the queue order is the play order
+            and positions, skipto, remove and move work as usual. Queued songs go in at their turn"""
+        return self._fair_mode
+    
+    @fair_mode.setter
+    def fair_mode(self, value: bool):
+        if value == self._fair_mode:
+            return
+        if value:
+            self.songs.indexes.append(self.fair)
+            self.songs.round_robin(self.fair)
+        else:
+            self.songs.indexes.remove(self.fair)
+            self.fair.cleared()
+        self._fair_mode = value
+        self.songs.version += 1     # The rendered pages show the mode
+    
+    def _push_fair(self, items: list):
+        """Insert songs of one requester at their turns in the round robin, as one operation"""
+        self.songs.insert_at(self.fair.slots(self.songs, items), items)
+    
+    def get_nowait(self):
+        """The next upcoming song becomes the nowplaying song, raises asyncio.QueueEmpty if there is none"""
+        entry = self.songs.get_nowait()
+        self.spill_history()
+        return entry
     
-    async def get(self):
-        return await self.upcoming.get()
+    def spill_history(self):
+        """Move the oldest played songs to the history store once the history outgrows its window"""
+        if self.history is None:
+            return
+        excess = self.songs.cursor - max(1, self.history_window)
+        if excess < history_spill_batch:
+            return
+        entries = self.songs.drop_history(excess)
+        self.history.append([entry_record(entry) for entry in entries])
+        self.spilled += len(entries)
     
-    async def put_history(self, item):
-        await self.history.put(item)
+    def _time_until(self, local: int, elapsed: float = None):
+        cursor = self.songs.cursor
+        if elapsed is None or cursor == 0:   # Nothing is playing, the next song starts right away
+            return self.songs.duration_between(cursor, local)
+        return max(0, self.songs.duration_between(cursor - 1, local) - elapsed)
+    
+    def eta(self, index: int, elapsed: float = None):
+        """Seconds until the song at index (as per users) starts, None if it isn't upcoming.
+            elapsed is how far the player is into the nowplaying song, None when nothing plays"""
+        local = index - self.spilled - 1
+        if not self.songs.cursor <= local < len(self.songs):
+            return None
+        return self._time_until(local, elapsed)
+    
+    def remaining_duration(self, elapsed: float = None):
+        """Seconds until the queue runs out"""
+        return self._time_until(len(self.songs), elapsed)
+    
+    def next_eta(self, requester: int, elapsed: float = None):
+        """(index as per users, seconds until it starts) of the next upcoming song of the requester, or None.
+            Looks up the position of each of their songs, so it is linear in the songs they have in memory"""
+        cursor = self.songs.cursor
+        positions = [i for i in map(self.songs.index, self.requesters.entries(requester)) if i >= cursor]
+        if not positions:
+            return None
+        local = min(positions)
+        return self.spilled + local + 1, self._time_until(local, elapsed)
+    
+    async def spilled_record(self, index: int):
+        """Saved record of the spilled song at position index (as per users)"""
+        if not 1 <= index <= self.spilled:
+            raise IndexError()
+        return await self.history.record(index - 1)
+    
+    def update_nowplaying(self, entry, resolved):
+        """Swap the entry returned by get() with its resolved metadata"""
+        index = self.songs.cursor - 1
+        if index >= 0 and self.songs[index] is entry:
+            self.songs[index] = resolved
+        else:   # The entry was moved around while the player was resolving it
+            for index, song in enumerate(self.songs):
+                if song is entry:
+                    self.songs[index] = resolved
+                    break
     
     def __getitem__(self, item):
         try:
-            if isinstance(item, slice):
-                return list(itertools.islice(self._playlist, item.start, item.stop, item.step))
-            else:
-                return self._playlist[item]
+            return self.songs[item]
         except IndexError:
             raise IndexError()
         
+    def queue_allowance(self, requester: int):
+        """Number of songs the requester can still add under the queue limit"""
+        if self.queue_limit is None:
+            return None
+        return max(0, self.queue_limit - self.requesters.upcoming_count(requester))
+        
+    def is_duplicate(self, entry):
+        return entry in self.duplicates
+        
     async def push_entry(self, source, pushTopFlag: bool = False):
+        """Add songs to the playlist, returns the number of songs added after applying the queue limit
+            and dropping duplicates in no duplicates mode"""
         if isinstance(source, YTDLMetadata):
+            if self.queue_allowance(requester_id(source)) == 0:
+                return 0
+            if self.no_duplicates and self.is_duplicate(source):
+                return 0
             if pushTopFlag:
-                await self.upcoming.appendleft(source)
+                self.songs.appendleft(source)
+            elif self.fair_mode:
+                self._push_fair([source])
             else:
-                await self.upcoming.put(source)
+                await self.songs.put(source)
+            return 1
         elif isinstance(source, list):
+            if len(source) == 0:
+                return 0
+            if self.no_duplicates:
+                seen = set()
+                unique_songs = []
+                for song in source:
+                    cid = canonical_id(song.url)
+                    if cid not in seen and not self.is_duplicate(song):
+                        seen.add(cid)
+                        unique_songs.append(song)
+                source = unique_songs
+            allowance = self.queue_allowance(requester_id(source[0])) if source else None   # Lists come from a single command
+            if allowance is not None:
+                source = source[:allowance]
             start = time.perf_counter_ns()
             if pushTopFlag:
-                source = reversed(source)
-                for i in source:
-                    await self.upcoming.appendleft(i)
+                self.songs.prepend(source)
+            elif self.fair_mode and source:
+                self._push_fair(source)
             else:
-                for i in source:
-                    await self.upcoming.put(i)
+                self.songs.extend(source)
             end = time.perf_counter_ns()
             logger.debug(f"Took {end-start} nanoseconds to push all songs into the queue")
+            return len(source)
+        return 0
     
     async def shift_queues_to(self, index: int):
-        if 0 <= index <= len(self._playlist):
-            try:
-                # case index == self.nowplaying_index not needed as it won't shift anything
-                if index < self.nowplaying_index:
-                    # shift hist to upcoming
-                    list_buffer = []
-                    for _ in range(self.nowplaying_index - index):
-                        entry = self.history[-1]
-                        list_buffer.append(entry)
-                        self.history.remove(-1)
-                    list_buffer = list(reversed(list_buffer))
-                    await self.push_entry(list_buffer, True)
-                    list_buffer_len = len(list_buffer)
-                    logger.debug(f"Pushed {list_buffer_len} songs to upcoming: {list(map(str, list_buffer))}")
-                elif index > self.nowplaying_index:
-                    # shift upcoming to hist
-                    debug_list = self.upcoming[:index - self.nowplaying_index]
-                    for _ in range(index - self.nowplaying_index):
-                        entry = self.upcoming[0]
-                        self.upcoming.remove(0)
-                        await self.history.put(entry)
-                        debug_list_len = len(debug_list)
-                    logger.debug(f"Pushed {debug_list_len} songs to history: {list(map(str, debug_list))}")
-            except Exception as e:
-                logger.error(e)
-                raise
-        else:
-            raise IndexError()
-        
-    def get_now_song(self):
-        """Pull the last entry (nowplaying song) from history. Removes the entry from queue."""
-        if not self.history_empty:
-            try:
-                nowplaying_song = self.history[-1]
-                self.history.remove(-1)
-            except IndexError:
-                raise IndexError()
-            else:
-                return nowplaying_song
-            
-    def get_now_and_prev_songs(self):
-        """Pull the last 2 entries (prev, nowplaying song) from history. Removes the entries from queue."""
-        if self.previous_playable:
-            try:
-                nowplaying_song = self.history[-1]
-                prev_song = self.history[-2]
-                self.history.remove(-1) # Removing last 2 songs by using the last index for both
-                self.history.remove(-1)
-            except IndexError:
-                raise IndexError()
-            else:
-                return (nowplaying_song, prev_song)
+        """Move the nowplaying cursor, songs before index become history"""
+        self.songs.seek(index - self.spilled)
+        self.spill_history()
+        logger.debug(f"Moved the nowplaying cursor to {index}")
             
     def shuffle_upcoming(self):
-        self.upcoming.shuffle()
+        self.songs.shuffle(self.shuffled)
+        if self.fair_mode:
+            self.songs.round_robin(self.fair)
+        
+    def unshuffle_upcoming(self):
+        unshuffled = self.songs.unshuffle(self.shuffled)
+        if unshuffled and self.fair_mode:
+            self.songs.round_robin(self.fair)
+        return unshuffled
         
     def clear_all_queues(self):
-        self.upcoming.clear()
-        self.history.clear()
+        self.songs.clear()
+        if self.history is not None:
+            self.history.clear()
+        self.spilled = 0
         
     def clear_upcoming_queue(self):
-        self.upcoming.clear()
+        self.songs.clear_upcoming()
         
+    async def find_song(self, query: str):
+        """Position (as per users) of the song whose title best matches the query, None if nothing does.
+            Of equally good matches the first upcoming one wins, then the latest played one.
+            Titles with every word of the query win over fuzzy matches, the spilled songs are searched
+            for those before the fuzzy search of the songs in memory"""
+        start = time.perf_counter_ns()
+        matches = self.titles.search(query, fuzzy = False)
+        if not matches and self.spilled:
+            position = await self.history.search(query)
+            if position is not None:
+                return position + 1
+        if not matches:
+            matches = self.titles.search(query)
+        if not matches:
+            return None
+        cursor = self.songs.cursor
+        if len(matches) <= 64:
+            positions = sorted(self.songs.index(entry) for entry in matches)
+            position = next((i for i in positions if i >= cursor), positions[-1])
+        else:   # A common word, walking from the cursor finds one sooner than locating every match
+            position = next((i for i, entry in enumerate(self.songs.upcoming(), cursor) if entry in matches), None)
+            if position is None:
+                position = max(self.songs.index(entry) for entry in matches)
+        logger.debug(f"Took [{time.perf_counter_ns() - start}] nanoseconds to find '{query}'")
+        return self.spilled + position + 1
+    
     def remove_song(self, index: int):
         index = 1 if index < 1 else index
-        index = len(self._playlist) if index > len(self._playlist) else index
+        index = len(self) if index > len(self) else index
+        if index <= self.spilled:   # Played songs on disk can't be taken out
+            raise IndexError()
         
-        if index <= self.nowplaying_index:
-            return self.history.remove(index - 1)
-        else:
-            index = index - self.nowplaying_index
-            return self.upcoming.remove(index - 1)
+        return self.songs.remove(index - self.spilled - 1)
+    
+    def _local_ranges(self, ranges):
+        """Sorted, merged [start, stop) ranges of the songs in memory, from inclusive ranges as per users.
+            Songs that were spilled or are past the end are left out"""
+        merged = []
+        for first, last in sorted((min(a, b), max(a, b)) for a, b in ranges):
+            start = max(first, self.spilled + 1) - self.spilled - 1
+            stop = min(last, len(self)) - self.spilled
+            if start >= stop:
+                continue
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], stop)
+            else:
+                merged.append([start, stop])
+        return merged
+    
+    def remove_songs(self, ranges):
+        """Remove every song in the inclusive (first, last) ranges as per users, returns the number removed.
+            Costs one block operation per range instead of one removal per song"""
+        start_time = time.perf_counter_ns()
+        count = 0
+        for start, stop in reversed(self._local_ranges(ranges)):   # From the end, so earlier positions hold
+            count += len(self.songs.remove_range(start, stop))
+        logger.debug(f"Took [{time.perf_counter_ns() - start_time}] nanoseconds to remove {count} songs")
+        return count
+    
+    async def move_songs(self, ranges, new_idx: int):
+        """Move every song in the inclusive (first, last) ranges as per users so the first of them lands at new_idx,
+            keeping their order. Returns the number moved"""
+        start_time = time.perf_counter_ns()
+        cursor = self.songs.cursor
+        nowplaying = self.songs[cursor - 1] if cursor > 0 else None
+        moving = []
+        for start, stop in reversed(self._local_ranges(ranges)):
+            moving[:0] = self.songs.remove_range(start, stop)
+        if not moving:
+            return 0
+        new_idx = max(new_idx, self.spilled + 1)
+        local = min(new_idx - self.spilled - 1, len(self.songs))
+        # Songs moved to the nowplaying position or above go into history
+        self.songs.insert_many(local, moving)
+        if nowplaying is not None and nowplaying in moving:
+            await self.shift_queues_to(self.spilled + local + moving.index(nowplaying) + 1)
+        logger.debug(f"Took [{time.perf_counter_ns() - start_time}] nanoseconds to move {len(moving)} songs")
+        return len(moving)
     
     async def remove_requesters(self, requesters_to_remove: list):
         """remove *all* songs from the mentioned person"""
         try:
             start = time.perf_counter_ns()
-            modified_playlist = []
             count = 0
-            new_nowplaying_idx = 0
-            for idx, song in enumerate(self._playlist[:]):
-                if song.requester.id not in requesters_to_remove:
-                    modified_playlist.append(song)
-                else:
-                    count +=1
-                if idx == self.nowplaying_index - 1:
-                    new_nowplaying_idx = len(modified_playlist)
-            self.clear_all_queues()
-            await self.push_entry(modified_playlist)
-            if not new_nowplaying_idx == 0:
-                await self.shift_queues_to(new_nowplaying_idx)
+            for requester in requesters_to_remove:
+                for song in self.requesters.entries(requester):
+                    self.songs.remove_entry(song)
+                    count += 1
             end = time.perf_counter_ns()
             logger.debug(f"Took [{end-start}] nanoseconds to remove requesters")
             return count
@@ -235,22 +689,11 @@ class Playlist:
         """remove *all* repeated songs (leave the first occurrence alone)"""
         try:
             start = time.perf_counter_ns()
-            modified_playlist = []
             count = 0
-            new_nowplaying_idx = 0
-            url_set = {}
-            for idx, song in enumerate(self._playlist[:]):
-                if song.url not in url_set:
-                    modified_playlist.append(song)
-                    url_set.add(song.url)
-                else:
-                    count +=1
-                if idx == self.nowplaying_index - 1:
-                    new_nowplaying_idx = len(modified_playlist)
-            self.clear_all_queues()
-            await self.push_entry(modified_playlist)
-            if not new_nowplaying_idx == 0:
-                await self.shift_queues_to(new_nowplaying_idx)
+            for songs in self.duplicates.duplicates():
+                for song in sorted(songs, key = self.songs.index)[1:]:
+                    self.songs.remove_entry(song)
+                    count += 1
             end = time.perf_counter_ns()
             logger.debug(f"Took [{end-start}] nanoseconds to remove dupes")
             return count
@@ -262,17 +705,17 @@ class Playlist:
         """remove *only upcoming* songs from users not in the voice channel"""
         try:
             start = time.perf_counter_ns()
-            modified_playlist = []
             count = 0
-            for song in self.upcoming[:]:
-                if song.requester.id in present_members:
-                    modified_playlist.append(song)
-                else:
-                    count +=1
-            self.clear_upcoming_queue()
-            await self.push_entry(modified_playlist)
+            for requester in self.requesters.requesters():
+                if requester in present_members:
+                    continue
+                for song in self.requesters.entries(requester):
+                    index = self.songs.index(song)
+                    if index >= self.songs.cursor:
+                        self.songs.remove(index)
+                        count += 1
             end = time.perf_counter_ns()
-            logger.debug(f"Took [{end-start}] seconds to remove songs by absent users")
+            logger.debug(f"Took [{end-start}] nanoseconds to remove songs by absent users")
             return count
         except Exception as e:
             logger.error(e)
@@ -281,59 +724,83 @@ class Playlist:
     async def move_song(self, old_idx: int, new_idx: int):
         # indice sanitization
         old_idx = 1 if old_idx < 1 else old_idx
-        old_idx = len(self._playlist) if old_idx > len(self._playlist) else old_idx
-        new_idx = 1 if new_idx < 1 else new_idx
-        new_idx = len(self._playlist) if new_idx > len(self._playlist) else new_idx
+        old_idx = len(self) if old_idx > len(self) else old_idx
+        new_idx = self.spilled + 1 if new_idx <= self.spilled else new_idx
+        new_idx = len(self) if new_idx > len(self) else new_idx
+        if old_idx <= self.spilled:
+            raise IndexError()
             
-        moving_nowplaying_song = False
+        moving_nowplaying_song = old_idx == self.nowplaying_index
         try:
-            if old_idx == self.nowplaying_index:
-                moving_nowplaying_song = True
-            
-            if old_idx <= self.nowplaying_index:
-                item = self.history[old_idx - 1]
-                self.history.remove(old_idx - 1)
-            else:
-                item = self.upcoming[old_idx - self.nowplaying_index - 1]
-                self.upcoming.remove(old_idx - self.nowplaying_index - 1)
+            item = self.songs[old_idx - self.spilled - 1]
+            self.songs.remove(old_idx - self.spilled - 1)
         except IndexError:
             raise IndexError()
         else:
-            if new_idx <= self.nowplaying_index:
-                self.history.insert(new_idx - 1, item)
-            else:
-                self.upcoming.insert(new_idx - self.nowplaying_index - 1, item)
+            # An entry moved to the nowplaying position or above goes into history
+            self.songs.insert(new_idx - self.spilled - 1, item)
             
             if moving_nowplaying_song == True:
                 await self.shift_queues_to(new_idx)
 
 class VoiceState:
-    """Class defining a music player that uses a queue"""
+    """Class defining a music player that uses a queue.
+        The player is a state machine stepped by the cog's PlayerScheduler: waiting for a song,
+        loading its stream in a short lived task, playing it, and stopped once torn down.
+        Its deadlines are timers of the scheduler, so an idle player costs no task at all."""
     #__slots__ = ('bot', '_ctx', '_guild', '_channel', '_cog', 'current', 'voice', 'next', 'songs', 'history', 'queuebuffer', '_bufferflag', '_loop', '_volume', '_send_embed', 'audio_player')
     
-    def __init__(self, bot: commands.Bot, ctx: commands.Context):
+    def __init__(self, bot: commands.Bot, cog: commands.Cog, guild: discord.Guild, channel: discord.abc.Messageable):
         self.bot = bot
-        self._ctx = ctx
-        self._guild = ctx.guild
-        self._channel = ctx.channel
-        self._cog = ctx.cog
+        self._guild = guild
+        self._channel = channel
+        self._cog = cog
         
         self.current = None
         self.voice = None
-        self.next = asyncio.Event()
-        self.playlist = Playlist()
+        self.playlist = Playlist(HistoryStore(guild.id))
         
         self._bufferflag = False
         self._loop = False
         self._volume = 0.5
         self._send_embed = False
         
-        #self.audio_player = ctx.bot.loop.create_task(self.audio_player_task())
-        self.audio_player = self.audio_player_task.start()
+        self.empty_channel_grace = empty_channel_grace
+        self._suspended = False
+        self._resume_offset = 0
+        self._grace_timer = None
+        self._start_offset = 0  # Where to start the first song, set when a saved queue is restored mid song
+        
+        # Leftovers of an earlier queue of the guild that wasn't restored belong to nothing now
+        self.journal = QueueJournal(guild.id)
+        self.journal.discard()
+        self.playlist.songs.journal = self.journal
+        
+        self.state = 'waiting'
+        self._source = None         # YTDLSource streaming the nowplaying song, None while nothing streams
+        self._telemetry = None
+        self._load_task = None
+        self._deadline = None       # Timer tearing the player down when no song gets loaded in time
+        self._prefetch_timer = None
+        self._prefetched = None     # (entry, task resolving its info) of the next song
+        self._wait_start = time.perf_counter()
+        self.scheduler = cog.scheduler
+        self.playlist.songs.on_upcoming = self.wake
+        self.scheduler.add(self)
         
     #def __del__(self):
         #self.audio_player_task.cancel()
         
+    @property
+    def voice(self):
+        return self._voice
+    
+    @voice.setter
+    def voice(self, value):
+        self._voice = value
+        if value is not None:
+            self.wake()     # The idle deadline runs from the join, even if nothing gets queued
+        
     @property
     def bufferflag(self):
         return self._bufferflag
@@ -371,6 +838,10 @@ class VoiceState:
     def is_loaded(self):
         return self.voice and self.current
     
+    @property
+    def suspended(self):
+        return self._suspended
+    
     @property
     def playlist_empty(self):
         return self.playlist.playlist_empty
@@ -388,52 +859,232 @@ class VoiceState:
         return self.playlist.nowplaying_index
 
     async def push_entry(self, source, pushTopFlag: bool = False):
-        await self.playlist.push_entry(source, pushTopFlag)
+        return await self.playlist.push_entry(source, pushTopFlag)
 
-    @tasks.loop()
-    async def audio_player_task(self):
-        #while not self.bot.is_closed():
-        if not self.bot.is_closed():
-            logger.info("Audio Player Initiated")
-            self.next.clear()
-            
-            if True:
-                # Try to get the next song within 3 minutes.
-                # If no song will be added to the queue in time,
-                # the player will disconnect due to performance
-                # reasons.
-                newsource = None
-                try:
-                    logger.debug("Waiting to play")
-                    async with timeout(180): # 3 minutes
-                        logger.debug("Getting the song")
-                        self.current = await self.playlist.get()
-                        logger.debug("Got the song")
-                        newsource = await YTDLSource.create_source(self.current.ctx, self.current.url, loop = self.bot.loop)
-                        self.current = YTDLMetadata(newsource.ctx, newsource.data)
-                        logger.debug("Got the audiosource")
-                        
-                except asyncio.TimeoutError as e:
-                    logger.info("Timed out while waiting for song")
-                    #raise VoiceError(str(e))
-                    return self.destroy(self._ctx, self._guild)
-                
-                logger.debug("Playing song")
-                self.voice.play(newsource.audio_source, after = lambda _: self.bot.loop.call_soon_threadsafe(self.next.set))
-                if self._send_embed == True:
-                    await self.current.channel.send(embed=self.current.create_embed(), delete_after = info_message_lifetime)
-                
-                await self.playlist.put_history(self.current)
-                await self.next.wait()
-                logger.debug("Done playing the song")
-                if self.voice is not None:
-                    self.voice.stop()
-                self.current = None
-                newsource = None
-    
-    @audio_player_task.before_loop
-    async def before_audio_player(self):
-        await self.bot.wait_until_ready()
+    def wake(self):
+        self.scheduler.wake(self)
+    
+    def step(self):
+        """Advance the state machine, the scheduler calls this after wake()"""
+        if self.state == 'waiting':
+            self._start_next()
+        elif self.state == 'playing' and self._source is None and not self._suspended:
+            # Listeners are back, open the stream again where it was suspended
+            self._load(self.current, self._resume_offset, resuming = True)
+    
+    def _start_next(self):
+        if self._suspended or self.voice is None:
+            return
+        # If no song is queued and loaded within idle_timeout, the player disconnects due to performance reasons
+        if self._deadline is None:
+            self._deadline = self.scheduler.call_later(idle_timeout, self._timed_out)
+        if self.playlist.upcoming_empty:
+            logger.debug("Waiting to play")
+            return
+        
+        telemetry = self._telemetry = TrackTelemetry()
+        telemetry.queue_wait = time.perf_counter() - self._wait_start
+        entry = self.current = self.playlist.get_nowait()
+        telemetry.dequeued()
+        self._resume_offset, self._start_offset = self._start_offset, 0
+        logger.debug("Got the song")
+        self._load(entry, self._resume_offset)
+    
+    def _load(self, entry, offset: float, resuming: bool = False):
+        self.state = 'loading'
+        self._load_task = self.bot.loop.create_task(self._open_source(entry, offset, resuming))
+    
+    async def _open_source(self, entry, offset: float, resuming: bool):
+        """Resolve and open the stream of a song, the only part of the player that waits on anything"""
+        try:
+            info = None if resuming else await self._prefetched_info(entry)
+            source = await self._create_source(entry.url, offset = offset, info = info,
+                                               telemetry = None if resuming else self._telemetry)
+        except Exception as e:
+            logger.error(f"[{self._guild}] Couldn't load {entry.url}: {e}")
+            self._load_task = None
+            self._telemetry = None
+            self._finish_track()
+            return
+        
+        self._load_task = None
+        if self.state != 'loading':     # Torn down meanwhile
+            source.audio_source.cleanup()
+            return
+        logger.debug("Got the audiosource")
+        if not resuming:
+            self.current = YTDLMetadata.from_entry(entry, source.data)
+            self.playlist.update_nowplaying(entry, self.current)
+        self._play(source, resuming)
+    
+    def _play(self, source: YTDLSource, resuming: bool):
+        self.state = 'playing'
+        if self._deadline is not None:
+            self._deadline.cancel()
+            self._deadline = None
+        if self._suspended:
+            # Nobody is listening anymore, step() opens the stream again once someone is back
+            logger.debug(f"Player suspended at {self._resume_offset:.2f}s")
+            source.audio_source.cleanup()
+            return
+        
+        logger.debug("Playing song")
+        self._source = source
+        self.voice.play(source.audio_source, after = lambda _: self.bot.loop.call_soon_threadsafe(self._stream_ended, source))
+        if self._send_embed == True and not resuming:
+            channel = self._guild.get_channel(self.current.channel_id) or self._channel
+            self._cog.outbox.embed(channel.id, self.current.create_embed(), delete_after = info_message_lifetime)
+        
+        self._schedule_prefetch()
+    
+    def _schedule_prefetch(self):
+        if self._prefetch_timer is not None:
+            self._prefetch_timer.cancel()
+            self._prefetch_timer = None
+        if self.current.length:
+            delay = self.current.length - self._resume_offset - prefetch_lead
+            self._prefetch_timer = self.scheduler.call_later(max(0, delay), self._prefetch)
+    
+    async def _create_source(self, link: str, *, offset: float = 0, info: dict = None, telemetry: TrackTelemetry = None):
+        """Open a stream in this process, or in an audio worker when the cog runs them"""
+        workers = self._cog.audio_workers
+        if workers is not None:
+            return await workers.create_source(self._guild.id, link, offset = offset, info = info, telemetry = telemetry)
+        return await YTDLSource.create_source(link, loop = self.bot.loop, offset = offset, info = info, telemetry = telemetry)
+    
+    async def _resolve_info(self, link: str):
+        """yt-dlp info of a song without opening its stream, in an audio worker when the cog runs them"""
+        workers = self._cog.audio_workers
+        if workers is not None:
+            return await workers.resolve_info(self._guild.id, link)
+        return await YTDLSource.resolve_info(link, loop = self.bot.loop)
+    
+    def _stream_ended(self, source: YTDLSource):
+        if source is not self._source:  # A stream the player already let go of
+            return
+        self._source = None
+        if self._suspended:     # Stopped by suspend(), the song resumes when listeners are back
+            return
+        self._finish_track()
+    
+    def _finish_track(self):
+        logger.debug("Done playing the song")
+        if self._telemetry is not None:
+            self._cog.telemetry.record(self._guild.id, self._telemetry)
+            self._telemetry = None
+        if self._prefetch_timer is not None:
+            self._prefetch_timer.cancel()
+            self._prefetch_timer = None
+        if self.voice is not None:
+            self.voice.stop()
+        self.current = None
+        self.state = 'waiting'
+        self._wait_start = time.perf_counter()
+        self.wake()
+    
+    def _timed_out(self):
+        self._deadline = None
+        if self.state in ('waiting', 'loading'):
+            logger.info("Timed out while waiting for song")
+            self.destroy()
+    
+    def _prefetch(self):
+        """Resolve the next song with yt-dlp while the current one finishes, so only ffmpeg is left to start"""
+        self._prefetch_timer = None
+        entry = self.playlist.next_song
+        if entry is None or self.state != 'playing':
+            return
+        self._drop_prefetched()
+        task = self.bot.loop.create_task(self._resolve_info(entry.url))
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())    # Failures are retried when the song loads
+        self._prefetched = (entry, task)
+    
+    async def _prefetched_info(self, entry):
+        """Info prefetched for entry, None if the next song changed since or the prefetch failed"""
+        if self._prefetched is None:
+            return None
+        prefetched_entry, task = self._prefetched
+        self._prefetched = None
+        if prefetched_entry is not entry or task.cancelled():
+            task.cancel()
+            return None
+        try:
+            return await task
+        except Exception:
+            return None
+    
+    def _drop_prefetched(self):
+        if self._prefetched is not None:
+            self._prefetched[1].cancel()
+            self._prefetched = None
+    
+    def _halt(self):
+        """Stop whatever the player is doing, the stream that was playing doesn't count as finished"""
+        self.state = 'stopped'
+        for timer in (self._deadline, self._prefetch_timer):
+            if timer is not None:
+                timer.cancel()
+        self._deadline = self._prefetch_timer = None
+        if self._load_task is not None:
+            self._load_task.cancel()
+            self._load_task = None
+        self._drop_prefetched()
+        self._source = None
+        self._telemetry = None
+        if self.voice is not None:
+            self.voice.stop()
+        self.current = None
+    
+    def suspend(self):
+        """Stop streaming to an empty voice channel, remembering the offset to resume from"""
+        if self._suspended:
+            return
+        
+        logger.info(f"No listeners left in {self._guild}, suspending the player")
+        self._suspended = True
+        self._grace_timer = self.scheduler.call_later(self.empty_channel_grace, self.destroy)
+        
+        if self.voice and self.voice.source is not None:
+            self._resume_offset = self.voice.source.position
+            self.voice.stop()   # Tears down ffmpeg and the upstream connection, the player waits for listeners
+    
+    def resume_listeners(self):
+        """Someone is back in the voice channel, restart the stream where it was suspended"""
+        if not self._suspended:
+            return
+        
+        logger.info(f"Listeners are back in {self._guild}, resuming the player")
+        self._suspended = False
+        if self._grace_timer is not None:
+            self._grace_timer.cancel()
+            self._grace_timer = None
+        self.wake()
+    
+    async def seek(self, position: float):
+        """Play the nowplaying song from position seconds on. An audio worker seeks its own stream,
+            a stream of the bot process is opened again at position"""
+        source = self._source
+        if self.state != 'playing' or source is None:
+            return False
+        
+        self._resume_offset = position
+        original = source.audio_source.original
+        if isinstance(original, WorkerAudioSource):
+            paused = self.voice.is_paused()
+            self.voice.pause()  # The voice thread stops reading while seek() drops the frames in flight
+            seeked = await self.bot.loop.run_in_executor(None, original.seek, position)
+            if seeked:
+                source.audio_source.seeked(position)
+            if not paused and self.voice is not None:
+                self.voice.resume()     # Also ends the song on a failed seek, read() returns nothing anymore
+            if self._source is source:
+                self._schedule_prefetch()
+            return seeked
+        
+        self._source = None     # _stream_ended ignores the stream stopped here
+        self.voice.stop()
+        self._load(self.current, position, resuming = True)
+        return True
     
     def skip_song(self):
         if self.is_loaded:
@@ -443,7 +1094,10 @@ class VoiceState:
             
     async def skip_to_song(self, index: int):
         try:
-            if index > self.playlist.nowplaying_index:
+            if 1 <= index <= self.playlist.spilled:
+                # The song is only in the history store now, queue it again right after the nowplaying song
+                self.playlist.songs.appendleft(self.restore_entry(await self.playlist.spilled_record(index)))
+            elif index > self.playlist.nowplaying_index:
                 await self.playlist.shift_queues_to(index - 1)
             elif index < self.playlist.nowplaying_index:
                 await self.playlist.shift_queues_to(index - 1)
@@ -456,17 +1110,8 @@ class VoiceState:
         
     async def previous_song(self):
         if self.previous_playable:
-            try:
-                nowplaying_song, prev_song = self.playlist.get_now_and_prev_songs()
-            except IndexError:
-                raise IndexError()
-            else:
-                # Had to push both entries as a list instead of individually,
-                # it was having some weird async problem with the queue after using skipto command
-                # where after skipto, using previous caused nowplaying to repeat and the previous to be dropped from the queue.
-                # Maybe due to single entry push using queue.put() or some async desynchronization.
-                await self.push_entry([prev_song, nowplaying_song], pushTopFlag = True)
-                self.skip_song()
+            await self.playlist.shift_queues_to(self.playlist.nowplaying_index - 2)
+            self.skip_song()
         else:
             raise IndexError()
     
@@ -476,8 +1121,7 @@ class VoiceState:
             if isinstance(song, YTDLMetadata):
                 return song.create_embed()
             else:
-                newsource = await YTDLSource.create_source(song.ctx, song.url, loop = self.bot.loop)
-                song = YTDLMetadata(newsource.ctx, newsource.data)
+                song = YTDLMetadata.from_entry(song, await self._resolve_info(song.url))
                 return song.create_embed()
     
     def current_info_embed(self):
@@ -489,15 +1133,35 @@ class VoiceState:
             if isinstance(song, YTDLMetadata):
                 return song.create_embed()
             else:
-                newsource = await YTDLSource.create_source(song.ctx, song.url, loop = self.bot.loop)
-                song = YTDLMetadata(newsource.ctx, newsource.data)
+                song = YTDLMetadata.from_entry(song, await self._resolve_info(song.url))
                 return song.create_embed()
     
     def shuffle_queue(self):
         self.playlist.shuffle_upcoming()
         
+    def unshuffle_queue(self):
+        return self.playlist.unshuffle_upcoming()
+        
     def remove_song(self, index: int):
         return self.playlist.remove_song(index)
+    
+    async def find_song(self, query: str):
+        return await self.playlist.find_song(query)
+    
+    def remove_songs(self, ranges):
+        return self.playlist.remove_songs(ranges)
+    
+    async def move_songs(self, ranges, new_idx: int):
+        return await self.playlist.move_songs(ranges, new_idx)
+    
+    def eta(self, index: int):
+        return self.playlist.eta(index, self.play_offset)
+    
+    def next_eta(self, requester: int):
+        return self.playlist.next_eta(requester, self.play_offset)
+    
+    def remaining_duration(self):
+        return self.playlist.remaining_duration(self.play_offset)
         
     async def remove_requesters(self, requesters_to_remove: list):
         try:
@@ -515,13 +1179,33 @@ class VoiceState:
     
     async def remove_absent(self, present_members: list):
         try:
-            count = await self.playlist.remove_absent()
+            count = await self.playlist.remove_absent(present_members)
             return count
         except Exception as e:
             raise
     
     def clear_queue(self):
         self.playlist.clear_all_queues()
+    
+    def toggle_fair_mode(self, value: bool = None):
+        if value == None:
+            value = not self.playlist.fair_mode
+        self.playlist.fair_mode = value
+        return value
+    
+    def toggle_no_duplicates(self, value: bool = None):
+        if value == None:
+            value = not self.playlist.no_duplicates
+        self.playlist.no_duplicates = value
+        return value
+    
+    @property
+    def queue_limit(self):
+        return self.playlist.queue_limit
+    
+    @queue_limit.setter
+    def queue_limit(self, value: int):
+        self.playlist.queue_limit = value
         
     async def move_song(self, old_idx: int, new_idx: int):
         return await self.playlist.move_song(old_idx, new_idx)
@@ -533,28 +1217,106 @@ class VoiceState:
         self.send_embed = value
         return value
             
-    def destroy(self, ctx, guild):
+    def destroy(self):
         """Destroy and clean the player"""
-        return self.bot.loop.create_task(self._cog.cleanup(ctx, guild))
+        return self.bot.loop.create_task(self._cog.cleanup(self._guild, self._channel))
     
-    async def restart_player(self):
-        self.audio_player_task.cancel()
-        self.next.set()
-        try:
-            nowplaying_song = self.playlist.get_now_song()
-        except IndexError:
-            raise IndexError()
+    @property
+    def play_offset(self):
+        """Seconds into the nowplaying song, None when nothing is playing"""
+        if self.voice and self.voice.source is not None:
+            return self.voice.source.position
+        if self._suspended and self.current is not None:
+            return self._resume_offset
+        return None
+    
+    def checkpoint(self, compact: bool = False):
+        """Journal the play offset and voice channel, compacting the journal into a snapshot once it grows"""
+        if self.journal is None:
+            return
+        voice_channel = self.voice.channel.id if self.voice and self.voice.channel else None
+        if compact or self.journal.needs_compaction:
+            songs = self.playlist.songs
+            self.journal.snapshot(list(songs), songs.cursor, self.play_offset, voice_channel, self._channel.id)
         else:
-            if nowplaying_song is not None:
-                await self.push_entry([nowplaying_song], pushTopFlag = True)
+            if voice_channel is not None:
+                self.journal.voice(voice_channel, self._channel.id)
+            self.journal.offset(self.play_offset)
+            self.journal.sync()
+    
+    def save_queue(self):
+        """Snapshot the queue and stop journaling, so tearing down the player keeps it saved"""
+        if self.journal is None:
+            return
+        self.checkpoint(compact = True)
+        self.journal.close()
+        self.playlist.songs.journal = self.journal = None
+    
+    def restore_entry(self, record: dict):
+        """Queue entry from a saved record, without yt-dlp"""
+        return BasicMetadata.restored(record['r'], record['c'] or self._channel.id, record['u'], record['t'], record.get('d'))
+    
+    def restore_queue(self, saved):
+        """Put back a queue loaded from the journal, the entries are rebuilt from their records"""
+        entries = [self.restore_entry(record) for record in saved.entries]
+        
+        cursor = saved.cursor
+        if saved.offset is not None and cursor > 0:
+            # The song before the cursor was interrupted, play it again from where it was
+            cursor -= 1
+            self._start_offset = saved.offset
+        
+        songs = self.playlist.songs
+        songs.journal = None
+        songs.replace(entries, cursor)
+        self.journal = QueueJournal(self._guild.id, seq = saved.seq)
+        self.journal.snapshot(entries, saved.cursor, saved.offset, saved.voice_channel, self._channel.id)
+        songs.journal = self.journal
+    
+    async def restart_player(self):
+        self._halt()
+        if not self.playlist.history_empty:
+            # Put the nowplaying song back on top of the upcoming songs
+            await self.playlist.shift_queues_to(self.playlist.nowplaying_index - 1)
         await asyncio.sleep(1)
-        self.audio_player_task.start()
+        if self.state == 'stopped' and self in self.scheduler.players:
+            self.state = 'waiting'
+            self._wait_start = time.perf_counter()
+            self.wake()
     
     async def cancel_task_and_disconnect(self):
-        self.audio_player_task.cancel()
+        self._halt()
+        self.scheduler.remove(self)
+        if self._grace_timer is not None:
+            self._grace_timer.cancel()
+            self._grace_timer = None
+        if self.journal is not None:
+            self.playlist.songs.journal = None
+            self.journal.discard()
+            self.journal = None
+        if self.playlist.history is not None:
+            self.playlist.history.close()
+            self.playlist.history = None
         self.clear_queue()
         
         if self.voice:
             await self.voice.disconnect()
             self.voice = None
             self.current = None
+
+    def abdicate(self):
+        """Stop playing after another process took over the guild. The journal is left as it is and
+            the voice client is only dropped from the cache, leaving the channel would kick the new player out"""
+        self._halt()
+        self.scheduler.remove(self)
+        if self._grace_timer is not None:
+            self._grace_timer.cancel()
+            self._grace_timer = None
+        self.playlist.songs.journal = None
+        self.journal = None
+        if self.playlist.history is not None:
+            self.playlist.history.close()
+            self.playlist.history = None
+        if self.voice:
+            self.voice.cleanup()
+            self.voice = None
@@ -0,0 +1,176 @@
+import math
+import time
+import asyncio
+import logging
+
+from async_timeout import timeout
+
+logger = logging.getLogger('discord.' + __name__)
+logger.setLevel(logging.DEBUG)
+
+scheduler_tick = 0.5    # seconds per timer wheel tick, deadlines fire up to a tick late
+wheel_slots = 64        # slots per level of the timer wheel
+wheel_levels = 3        # levels of the timer wheel, 3 levels of 64 half second slots cover 36 hours
+lag_smoothing = 0.1     # weight of the latest tick in the average scheduler lag
+
+class Timer():
+    """A deadline in a TimerWheel, cancelling it is O(1) and the wheel drops it when its slot comes up"""
+    __slots__ = ('due', 'callback', 'cancelled')
+
+    def __init__(self, due: int, callback):
+        self.due = due
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class TimerWheel():
+    """Hierarchical timer wheel. Level 0 has a slot per tick, a slot of level n spans slots**n ticks.
+        A timer is filed in the level of the highest digit where its due tick differs from the current one,
+        and moves down a level each time its slot comes up, so scheduling and cancelling are O(1)
+        and a tick only touches the timers that are due or cascading."""
+    def __init__(self, tick: float, now: float, slots: int = wheel_slots, levels: int = wheel_levels):
+        self.tick = tick
+        self.slots = slots
+        self.start = now
+        self.ticks = 0
+        self.pending = 0
+        self._levels = [[[] for _ in range(slots)] for _ in range(levels)]
+        self._overflow = []     # timers past the last level, filed again every turn of the last level
+        self._due = []
+
+    def _file(self, timer: Timer):
+        if timer.due <= self.ticks:
+            self._due.append(timer)
+            return
+        span = 1
+        for level in self._levels:
+            if timer.due // (span * self.slots) == self.ticks // (span * self.slots):
+                level[(timer.due // span) % self.slots].append(timer)
+                return
+            span *= self.slots
+        self._overflow.append(timer)
+
+    def schedule(self, deadline: float, callback):
+        """Call callback() once the wheel is advanced past deadline, a time of the same clock as now"""
+        timer = Timer(max(self.ticks + 1, math.ceil((deadline - self.start) / self.tick)), callback)
+        self._file(timer)
+        self.pending += 1
+        return timer
+
+    def _cascade(self, timers: list):
+        for timer in timers:
+            if not timer.cancelled:
+                self._file(timer)
+            else:
+                self.pending -= 1
+
+    def advance(self, now: float):
+        """Move the wheel up to now, returns the callbacks of the timers that came due"""
+        target = int((now - self.start) // self.tick)
+        callbacks = []
+        while self.ticks < target:
+            self.ticks += 1
+            span = self.slots ** len(self._levels)
+            if self.ticks % span == 0:
+                overflow, self._overflow = self._overflow, []
+                self._cascade(overflow)
+            for level in range(len(self._levels) - 1, 0, -1):
+                span //= self.slots
+                if self.ticks % span == 0:
+                    slot = (self.ticks // span) % self.slots
+                    timers, self._levels[level][slot] = self._levels[level][slot], []
+                    self._cascade(timers)
+            slot = self.ticks % self.slots
+            due, self._levels[0][slot] = self._levels[0][slot], []
+            due += self._due
+            self._due = []
+            for timer in due:
+                self.pending -= 1
+                if not timer.cancelled:
+                    callbacks.append(timer.callback)
+        return callbacks
+
+class PlayerScheduler():
+    """Drives the players of every guild from one task.
+        Players are state machines with a state attribute and a step() method, a player is stepped once
+        after something it waits on happens (wake()), and every player deadline lives in one TimerWheel.
+        Keeps track of how late the ticks run and of the players in each state."""
+    def __init__(self, tick: float = scheduler_tick):
+        self.tick = tick
+        self.wheel = TimerWheel(tick, time.monotonic())
+        self.players = set()
+        self.lag = 0.0          # Smoothed seconds the ticks run behind
+        self.max_lag = 0.0
+        self.steps = 0
+        self._ready = {}        # Players to step, in the order they were woken
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def add(self, player):
+        self.players.add(player)
+        self.wake(player)
+
+    def remove(self, player):
+        self.players.discard(player)
+        self._ready.pop(player, None)
+
+    def wake(self, player):
+        """Step the player on the next turn of the scheduler, any number of wakes before that step it once"""
+        if player in self.players:
+            self._ready[player] = None
+            self._wakeup.set()
+
+    def call_later(self, delay: float, callback):
+        """Call callback() after delay seconds, give or take a tick. Returns a Timer to cancel it"""
+        return self.wheel.schedule(time.monotonic() + delay, callback)
+
+    def counts(self):
+        """Number of players in each state"""
+        counts = {}
+        for player in self.players:
+            counts[player.state] = counts.get(player.state, 0) + 1
+        return counts
+
+    def _call(self, callback):
+        try:
+            callback()
+        except Exception:
+            logger.exception("Error in a scheduled player callback")
+
+    async def _run(self):
+        next_tick = time.monotonic() + self.tick
+        while True:
+            try:
+                async with timeout(max(0, next_tick - time.monotonic())):
+                    await self._wakeup.wait()
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            now = time.monotonic()
+            if now >= next_tick:
+                lag = now - next_tick
+                self.lag += (lag - self.lag) * lag_smoothing
+                self.max_lag = max(self.max_lag, lag)
+                for callback in self.wheel.advance(now):
+                    self._call(callback)
+                next_tick = max(next_tick + self.tick, now)
+
+            start = time.perf_counter_ns()
+            ready, self._ready = self._ready, {}
+            for player in ready:
+                self._call(player.step)
+            self.steps += len(ready)
+            if ready:
+                logger.debug(f"Took [{time.perf_counter_ns() - start}] nanoseconds to step {len(ready)} players")
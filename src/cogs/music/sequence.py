@@ -0,0 +1,358 @@
+import bisect
+import itertools
+
+class BlockList():
+    """A list split into blocks of about BLOCK_SIZE entries.
+        Positional access is a binary search over the block offsets and inserts, deletes and
+        splits only touch one block plus the offsets, so they cost O(sqrt n) instead of O(n).
+        Every entry remembers its block, and a block builds a map of the positions of its entries
+        the first time one is looked up, so finding the position of an entry is O(1) until its block changes.
+        This relies on every entry being a distinct object.
+        With a weight function the blocks also keep the sum of their weights, indexed by a Fenwick tree,
+        and a block builds the prefix sums of its weights the first time a range ends inside it,
+        so the total weight of a range costs O(log n), plus O(sqrt n) once after its end blocks changed."""
+    BLOCK_SIZE = 512
+
+    def __init__(self, iterable = (), weight = None):
+        self._blocks = []
+        self._starts = []   # Index of the first entry of every block
+        self._len = 0
+        self._owner = {}    # id(entry) -> block holding it
+        self._numbers = None    # id(block) -> block number, rebuilt after the blocks change
+        self._weight = weight
+        self._sums = []     # Weight of every block
+        self._total = 0
+        self._tree = None   # Fenwick tree over self._sums, rebuilt after the blocks change
+        self._positions = {}    # id(block) -> {id(entry): index in the block}, dropped when the block changes
+        self._prefixes = {}     # id(block) -> weights of the entries before each index of the block, same
+        self.extend(iterable)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self._blocks)
+
+    def __reversed__(self):
+        for block in reversed(self._blocks):
+            yield from reversed(block)
+
+    def __bool__(self):
+        return self._len > 0
+
+    def _locate(self, index: int):
+        """Return (block number, index inside the block) of an absolute index"""
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError("BlockList index out of range")
+        b = bisect.bisect_right(self._starts, index) - 1
+        return b, index - self._starts[b]
+
+    def _update_starts(self, b: int):
+        """Recompute the offsets of the blocks after block b"""
+        starts = self._starts
+        blocks = self._blocks
+        start = starts[b] + len(blocks[b]) if b >= 0 else 0
+        for i in range(b + 1, len(blocks)):
+            starts[i] = start
+            start += len(blocks[i])
+
+    def _changed(self, block: list):
+        """The entries of a block changed, its cached positions and prefix sums are stale"""
+        self._positions.pop(id(block), None)
+        self._prefixes.pop(id(block), None)
+
+    def _own(self, block: list, entries):
+        owner = self._owner
+        for item in entries:
+            owner[id(item)] = block
+
+    def _weigh(self, entries):
+        weight = self._weight
+        return sum(weight(item) for item in entries) if weight is not None else 0
+
+    def _add_weight(self, b: int, delta):
+        """Weight of block b changed by delta, without the blocks themselves changing"""
+        if not delta:
+            return
+        self._sums[b] += delta
+        self._total += delta
+        tree = self._tree
+        if tree is not None:
+            i = b + 1
+            while i < len(tree):
+                tree[i] += delta
+                i += i & -i
+
+    def _rebuild(self, entries: list):
+        size = self.BLOCK_SIZE
+        self._blocks = [entries[i:i + size] for i in range(0, len(entries), size)]
+        self._starts = list(range(0, len(entries), size))
+        self._len = len(entries)
+        self._owner = {}
+        for block in self._blocks:
+            self._own(block, block)
+        self._numbers = None
+        self._sums = [self._weigh(block) for block in self._blocks]
+        self._total = sum(self._sums)
+        self._tree = None
+        self._positions = {}
+        self._prefixes = {}
+
+    def _split_block(self, b: int):
+        """Split an oversized block in two"""
+        block = self._blocks[b]
+        half = len(block) // 2
+        new_block = block[half:]
+        self._blocks.insert(b + 1, new_block)
+        del block[half:]
+        self._changed(block)
+        self._starts.insert(b + 1, self._starts[b] + half)
+        self._own(new_block, new_block)
+        self._move_weight(b, new_block)
+
+    def _split_at(self, index: int):
+        """Make index the start of a block and return that block number (len(blocks) if index == len)"""
+        if index == self._len:
+            return len(self._blocks)
+        b, i = self._locate(index)
+        if i == 0:
+            return b
+        block = self._blocks[b]
+        new_block = block[i:]
+        self._blocks.insert(b + 1, new_block)
+        del block[i:]
+        self._changed(block)
+        self._starts.insert(b + 1, self._starts[b] + i)
+        self._own(new_block, new_block)
+        self._move_weight(b, new_block)
+        return b + 1
+
+    def _move_weight(self, b: int, new_block: list):
+        """Book keeping after the end of block b was split off into new_block, inserted after it"""
+        moved = self._weigh(new_block)
+        self._sums[b] -= moved
+        self._sums.insert(b + 1, moved)
+        self._numbers = None
+        self._tree = None
+
+    def _drop_block(self, b: int):
+        self._changed(self._blocks[b])
+        del self._blocks[b]
+        del self._starts[b]
+        self._total -= self._sums.pop(b)    # Only rounding errors are left in an empty block
+        self._numbers = None
+        self._tree = None
+
+    def _maybe_compact(self):
+        """Splits at arbitrary positions leave small blocks behind, rebuild once there are too many"""
+        if len(self._blocks) > 2 * (self._len // self.BLOCK_SIZE) + 8:
+            self._rebuild(list(self))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._len)
+            if step == 1:
+                return list(self.islice(start, stop))
+            return [self[i] for i in range(start, stop, step)]
+        b, i = self._locate(index)
+        return self._blocks[b][i]
+
+    def __setitem__(self, index: int, item):
+        b, i = self._locate(index)
+        block = self._blocks[b]
+        old_item = block[i]
+        del self._owner[id(old_item)]
+        block[i] = item
+        self._owner[id(item)] = block
+        self._changed(block)
+        if self._weight is not None:
+            self._add_weight(b, self._weight(item) - self._weight(old_item))
+
+    def __contains__(self, item):
+        return id(item) in self._owner
+
+    def index(self, item):
+        """Position of an entry (by identity)"""
+        block = self._owner.get(id(item))
+        if block is None:
+            raise ValueError("Entry is not in the BlockList")
+        if self._numbers is None:
+            self._numbers = {id(block): b for b, block in enumerate(self._blocks)}
+        positions = self._positions.get(id(block))
+        if positions is None:
+            positions = self._positions[id(block)] = {id(entry): i for i, entry in enumerate(block)}
+        return self._starts[self._numbers[id(block)]] + positions[id(item)]
+
+    def remove(self, item):
+        return self.pop(self.index(item))
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._len)
+            if step != 1:
+                raise ValueError("BlockList only supports contiguous slice deletion")
+            return self.delete_range(start, stop)
+        self.pop(index)
+
+    def islice(self, start: int = 0, stop: int = None):
+        """Iterate over entries [start, stop) without copying the blocks before start"""
+        stop = self._len if stop is None else min(stop, self._len)
+        if start >= stop:
+            return
+        b, i = self._locate(start)
+        remaining = stop - start
+        while remaining > 0:
+            block = self._blocks[b]
+            chunk = block[i:i + remaining]
+            yield from chunk
+            remaining -= len(chunk)
+            b += 1
+            i = 0
+
+    def append(self, item):
+        if not self._blocks or len(self._blocks[-1]) >= self.BLOCK_SIZE:
+            self._blocks.append([])
+            self._starts.append(self._len)
+            self._sums.append(0)
+            self._numbers = None
+            self._tree = None
+        self._blocks[-1].append(item)
+        self._owner[id(item)] = self._blocks[-1]
+        self._changed(self._blocks[-1])
+        self._len += 1
+        if self._weight is not None:
+            self._add_weight(len(self._blocks) - 1, self._weight(item))
+
+    def extend(self, iterable):
+        for item in iterable:
+            self.append(item)
+
+    def insert(self, index: int, item):
+        if index < 0:
+            index = max(0, index + self._len)
+        if index >= self._len:
+            return self.append(item)
+        b, i = self._locate(index)
+        self._blocks[b].insert(i, item)
+        self._owner[id(item)] = self._blocks[b]
+        self._changed(self._blocks[b])
+        self._len += 1
+        if self._weight is not None:
+            self._add_weight(b, self._weight(item))
+        if len(self._blocks[b]) > 2 * self.BLOCK_SIZE:
+            self._split_block(b)
+        self._update_starts(b)
+
+    def insert_many(self, index: int, items: list):
+        """Splice a batch in at index, whole blocks are added instead of single entries"""
+        if not items:
+            return
+        index = max(0, min(index, self._len))
+        b = self._split_at(index)
+        size = self.BLOCK_SIZE
+        new_blocks = [items[i:i + size] for i in range(0, len(items), size)]
+        for block in new_blocks:
+            self._own(block, block)
+        self._blocks[b:b] = new_blocks
+        self._numbers = None
+        self._starts[b:b] = [0] * len(new_blocks)
+        new_sums = [self._weigh(block) for block in new_blocks]
+        self._sums[b:b] = new_sums
+        self._total += sum(new_sums)
+        self._tree = None
+        self._len += len(items)
+        self._update_starts(b - 1)
+        self._maybe_compact()
+
+    def pop(self, index: int = -1):
+        b, i = self._locate(index)
+        item = self._blocks[b].pop(i)
+        del self._owner[id(item)]
+        self._changed(self._blocks[b])
+        self._len -= 1
+        if self._weight is not None:
+            self._add_weight(b, -self._weight(item))
+        if not self._blocks[b]:
+            self._drop_block(b)
+            b -= 1
+        self._update_starts(b)
+        return item
+
+    def delete_range(self, start: int, stop: int):
+        """Delete entries [start, stop), returning them"""
+        start = max(0, start)
+        stop = min(stop, self._len)
+        if start >= stop:
+            return []
+        first = self._split_at(start)
+        last = self._split_at(stop)
+        removed = list(itertools.chain.from_iterable(self._blocks[first:last]))
+        for block in self._blocks[first:last]:
+            self._changed(block)
+        del self._blocks[first:last]
+        del self._starts[first:last]
+        self._total -= sum(self._sums[first:last])
+        del self._sums[first:last]
+        self._numbers = None
+        self._tree = None
+        for item in removed:
+            del self._owner[id(item)]
+        self._len -= len(removed)
+        self._update_starts(first - 1)
+        self._maybe_compact()
+        return removed
+
+    def clear(self):
+        self._blocks = []
+        self._starts = []
+        self._len = 0
+        self._owner = {}
+        self._numbers = None
+        self._sums = []
+        self._total = 0
+        self._tree = None
+        self._positions = {}
+        self._prefixes = {}
+
+    def replace(self, entries):
+        """Replace all the entries"""
+        self._rebuild(list(entries))
+
+    @property
+    def total_weight(self):
+        return self._total
+
+    def _weight_before_block(self, b: int):
+        """Weight of the blocks before block b"""
+        tree = self._tree
+        if tree is None:
+            # Linear time Fenwick tree build, each node adds itself to its parent
+            tree = self._tree = [0] + self._sums
+            for i in range(1, len(tree)):
+                parent = i + (i & -i)
+                if parent < len(tree):
+                    tree[parent] += tree[i]
+        total = 0
+        while b > 0:
+            total += tree[b]
+            b -= b & -b
+        return total
+
+    def weight_before(self, index: int):
+        """Weight of the entries [0, index)"""
+        if index <= 0 or self._weight is None:
+            return 0
+        if index >= self._len:
+            return self._total
+        b, i = self._locate(index)
+        block = self._blocks[b]
+        prefix = self._prefixes.get(id(block))
+        if prefix is None:
+            prefix = self._prefixes[id(block)] = list(itertools.accumulate(map(self._weight, block), initial = 0))
+        return self._weight_before_block(b) + prefix[i]
+
+    def weight_between(self, start: int, stop: int):
+        """Weight of the entries [start, stop)"""
+        return self.weight_before(stop) - self.weight_before(start)
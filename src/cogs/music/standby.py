@@ -0,0 +1,179 @@
+"""Warm standby. The process running the players writes a heartbeat next to the queue journals,
+    a standby process (goplay-music.py --standby) tails the journals while the heartbeat is fresh
+    and logs in to restore every queue from where it was once the heartbeat is lost.
+    The journal directory can be a replica of the primary's, kept up to date by a shared mount or rsync.
+    When the bot runs as several processes (cluster.py) every shard range has its own heartbeat,
+    and a standby started with the same --shard-ids only tails and takes over the guilds of that range."""
+import os
+import json
+import time
+import socket
+import asyncio
+import logging
+
+from . import journal
+from .journal import QueueJournal
+
+logger = logging.getLogger('discord.' + __name__)
+logger.setLevel(logging.DEBUG)
+
+heartbeat_interval = 2  # seconds between the heartbeats of the primary
+heartbeat_timeout = 10  # seconds without a heartbeat before the standby takes over
+startup_grace = 60      # seconds a standby waits for a first heartbeat before it takes over from a primary that never beat
+tail_interval = 0.5     # seconds between two reads of the journals by the standby
+
+def process_alive(pid: int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:     # Alive, just not ours
+        pass
+    return True
+
+def owns_guild(guild_id: int, shard_ids: list = None, shard_count: int = None):
+    """Whether the guild is on one of the shards, every guild belongs to a process running every shard"""
+    if shard_ids is None:
+        return True
+    return (guild_id >> 22) % shard_count in shard_ids
+
+def heartbeat_name(shard_ids: list = None):
+    """One heartbeat per shard range, so the processes of a cluster don't take each other's heartbeat for their own"""
+    if shard_ids is None:
+        return 'heartbeat'
+    return f"heartbeat-{min(shard_ids)}-{max(shard_ids)}"
+
+class Heartbeat():
+    """Heartbeat file of the process running the players, it names the process and the time of its last beat"""
+    def __init__(self, directory: str = None, shard_ids: list = None):
+        self.path = os.path.join(directory or journal.journal_dir, heartbeat_name(shard_ids))
+        self.pid = os.getpid()
+        self.host = socket.gethostname()
+        self._last = None   # time of the last beat of this process
+        self._started = time.time()
+        self._seen = False  # whether a standby read a heartbeat yet
+
+    def read(self):
+        try:
+            with open(self.path, 'r', encoding = 'utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _ours(self, beat: dict):
+        return beat['pid'] == self.pid and beat['host'] == self.host
+
+    def beat(self):
+        """Write the heartbeat. False if another process took over since the last beat, nothing is written then"""
+        if self._last is not None:
+            current = self.read()
+            if current is not None and not self._ours(current) and current['time'] > self._last:
+                return False
+        self._last = time.time()
+        os.makedirs(os.path.dirname(self.path), exist_ok = True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding = 'utf-8') as f:
+            json.dump({'pid': self.pid, 'host': self.host, 'time': self._last}, f)
+        os.replace(tmp_path, self.path)
+        return True
+
+    def lost(self):
+        """Whether the primary stopped beating, right away if it was a process of this host that exited.
+            A standby started before the primary waits startup_grace seconds for its first heartbeat"""
+        current = self.read()
+        if current is None:
+            return self._seen or time.time() - self._started > startup_grace
+        self._seen = True
+        if current['host'] == self.host and not process_alive(current['pid']):
+            return True
+        return time.time() - current['time'] > heartbeat_timeout
+
+class JournalTail():
+    """Queue states of every guild, kept up to date by reading the lines appended to the journals.
+        A compaction rewrites the snapshot and truncates the journal, the guild is loaded again then.
+        Lines read twice are skipped by their sequence number, like QueueJournal.load does.
+        With shard ids only the guilds on those shards are tailed."""
+    def __init__(self, directory: str = None, shard_ids: list = None, shard_count: int = None):
+        self.directory = directory or journal.journal_dir
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.states = {}        # guild id -> QueueState
+        self._positions = {}    # guild id -> bytes of its journal read so far
+        self._snapshots = {}    # guild id -> mtime of its snapshot when it was loaded
+
+    def poll(self):
+        guilds = {guild_id for guild_id in QueueJournal.saved_guilds(self.directory)
+                  if owns_guild(guild_id, self.shard_ids, self.shard_count)}
+        for guild_id in set(self.states) - guilds:  # The queue ended on purpose
+            del self.states[guild_id]
+            self._positions.pop(guild_id, None)
+            self._snapshots.pop(guild_id, None)
+        for guild_id in guilds:
+            self._poll_guild(guild_id)
+
+    def _mtime(self, path: str):
+        try:
+            return os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _size(self, path: str):
+        try:
+            return os.stat(path).st_size
+        except FileNotFoundError:
+            return 0
+
+    def _poll_guild(self, guild_id: int):
+        files = QueueJournal(guild_id, self.directory)
+        snapshot = self._mtime(files.snapshot_path)
+        position = self._positions.get(guild_id)
+        size = self._size(files.path)
+        if guild_id not in self.states or snapshot != self._snapshots.get(guild_id) or size < position:
+            self._positions[guild_id] = size    # Lines appended while loading are read again next time, and skipped
+            self._snapshots[guild_id] = snapshot
+            self.states[guild_id] = QueueJournal.load(guild_id, self.directory)
+            return
+        if size == position:
+            return
+
+        state = self.states[guild_id]
+        with open(files.path, 'rb') as f:
+            f.seek(position)
+            data = f.read(size - position)
+        end = data.rfind(b'\n') + 1     # A line still being written is read once it is complete
+        for line in data[:end].splitlines():
+            op = json.loads(line)
+            if op['s'] > state.seq:
+                state.apply(op)
+        state.cursor = max(0, min(state.cursor, len(state.entries)))
+        self._positions[guild_id] = position + end
+
+class Takeover():
+    """What the standby knows when it takes over, the restored queues log the failover time from it"""
+    def __init__(self, states: dict, last_beat: float):
+        self.states = states            # guild id -> QueueState
+        self.last_beat = last_beat      # time of the last heartbeat of the primary, None if there never was one
+        self.noticed = time.time()
+
+async def stand_by(directory: str = None, shard_ids: list = None, shard_count: int = None):
+    """Tail the journals until the heartbeat of the primary is lost, returns the Takeover.
+        With shard ids this stands by for the process running those shards only"""
+    heartbeat = Heartbeat(directory, shard_ids)
+    tail = JournalTail(directory, shard_ids, shard_count)
+    logger.info(f"Standing by, tailing the queue journals in {tail.directory} for {os.path.basename(heartbeat.path)}")
+    while True:
+        start = time.perf_counter_ns()
+        tail.poll()
+        if heartbeat.lost():
+            break
+        await asyncio.sleep(tail_interval)
+    logger.debug(f"Took [{time.perf_counter_ns() - start}] nanoseconds to read the last lines of {len(tail.states)} queue journals")
+
+    current = heartbeat.read()
+    last_beat = current['time'] if current else None
+    if last_beat is not None:
+        logger.warning(f"The primary (pid {current['pid']} on {current['host']}) stopped beating "
+                       f"{time.time() - last_beat:.1f}s ago, taking over {len(tail.states)} queues")
+    else:
+        logger.info(f"No primary is running, taking over {len(tail.states)} queues")
+    return Takeover(tail.states, last_beat)
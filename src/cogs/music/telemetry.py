@@ -0,0 +1,78 @@
+import collections
+import math
+import statistics
+import time
+import logging
+
+logger = logging.getLogger('discord.' + __name__)
+logger.setLevel(logging.DEBUG)
+
+telemetry_window = 100   # tracks kept per guild
+
+class TrackTelemetry():
+    """Timings of a single track play, all phases in seconds"""
+    __slots__ = ('title', 'queue_wait', 'extraction', 'resolution', 'probe', 'spawn_to_first_frame',
+                 'time_to_first_audio', 'underruns', 'premature_end', 'shared', 'dequeued_at', 'spawned_at')
+    PHASES = ('queue_wait', 'extraction', 'resolution', 'probe', 'spawn_to_first_frame', 'time_to_first_audio')
+
+    def __init__(self, title: str = None):
+        self.title = title
+        self.queue_wait = None
+        self.extraction = None
+        self.resolution = None
+        self.probe = None
+        self.spawn_to_first_frame = None
+        self.time_to_first_audio = None
+        self.underruns = 0
+        self.premature_end = False
+        self.shared = False         # The ffmpeg process was shared with another guild, no probe or spawn
+        self.dequeued_at = None
+        self.spawned_at = None
+
+    def dequeued(self):
+        self.dequeued_at = time.perf_counter()
+
+    def first_frame(self):
+        now = time.perf_counter()
+        if self.spawned_at is not None:
+            self.spawn_to_first_frame = now - self.spawned_at
+        if self.dequeued_at is not None:
+            self.time_to_first_audio = now - self.dequeued_at
+
+    def __str__(self):
+        ttfa = f"{self.time_to_first_audio * 1000:.0f}ms" if self.time_to_first_audio is not None else "n/a"
+        flags = ""
+        if self.underruns:
+            flags += f" {self.underruns} underruns"
+        if self.premature_end:
+            flags += " ended early"
+        return f"{self.title}: {ttfa}{flags}"
+
+class Telemetry():
+    """Rolling per guild window of track telemetry"""
+    def __init__(self, window: int = telemetry_window):
+        self.window = window
+        self._guilds = {}
+
+    def record(self, guild_id: int, track: TrackTelemetry):
+        tracks = self._guilds.get(guild_id)
+        if tracks is None:
+            tracks = self._guilds[guild_id] = collections.deque(maxlen = self.window)
+        tracks.append(track)
+        logger.debug(f"[{guild_id}] {track}")
+
+    def tracks(self, guild_id: int):
+        return list(self._guilds.get(guild_id, ()))
+
+    def summary(self, guild_id: int):
+        """Return {phase: (median, p95)} along with the underrun and early end counts of the window"""
+        tracks = self.tracks(guild_id)
+        phases = {}
+        for phase in TrackTelemetry.PHASES:
+            values = sorted(getattr(t, phase) for t in tracks if getattr(t, phase) is not None)
+            if values:
+                p95 = values[min(len(values) - 1, math.ceil(len(values) * 0.95) - 1)]
+                phases[phase] = (statistics.median(values), p95)
+        underruns = sum(t.underruns for t in tracks)
+        premature_ends = sum(1 for t in tracks if t.premature_end)
+        return phases, underruns, premature_ends
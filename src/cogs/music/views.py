@@ -0,0 +1,60 @@
+import discord
+import logging
+
+logger = logging.getLogger('discord.' + __name__)
+logger.setLevel(logging.DEBUG)
+
+paginator_timeout = 180     # seconds without a button press before the buttons are taken off the message
+
+class Paginator(discord.ui.View):
+    """Buttons that flip through the pages of an embed by editing the same message.
+        render(page) returns (embed, page, pages) with the page clamped to the current page count,
+        it is awaited and reads rendered pages from the playlist cache, so pages are only rendered again once the queue changes."""
+    def __init__(self, render, page: int = 0, timeout: float = paginator_timeout):
+        super().__init__(timeout = timeout)
+        self.render = render
+        self.page = page
+        self.pages = 1
+        self.message = None
+
+    async def build(self):
+        embed, self.page, self.pages = await self.render(self.page)
+        self._first.disabled = self._previous.disabled = self.page <= 1
+        self._next.disabled = self._last.disabled = self.page >= self.pages
+        return embed
+
+    async def send(self, ctx, delete_after: float = None):
+        self.message = await ctx.send(embed = await self.build(), view = self, delete_after = delete_after)
+        return self.message
+
+    async def flip(self, interaction: discord.Interaction, page: int):
+        self.page = page
+        await interaction.response.edit_message(embed = await self.build(), view = self)
+
+    async def on_timeout(self):
+        if self.message is None:
+            return
+        try:
+            await self.message.edit(view = None)
+        except discord.HTTPException:   # The message was deleted already
+            pass
+
+    @discord.ui.button(emoji = '\N{Black Left-Pointing Double Triangle}', style = discord.ButtonStyle.secondary)
+    async def _first(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.flip(interaction, 1)
+
+    @discord.ui.button(emoji = '\N{Black Left-Pointing Triangle}', style = discord.ButtonStyle.secondary)
+    async def _previous(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.flip(interaction, self.page - 1)
+
+    @discord.ui.button(emoji = '\N{Anticlockwise Downwards and Upwards Open Circle Arrows}', style = discord.ButtonStyle.secondary)
+    async def _refresh(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.flip(interaction, self.page)
+
+    @discord.ui.button(emoji = '\N{Black Right-Pointing Triangle}', style = discord.ButtonStyle.secondary)
+    async def _next(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.flip(interaction, self.page + 1)
+
+    @discord.ui.button(emoji = '\N{Black Right-Pointing Double Triangle}', style = discord.ButtonStyle.secondary)
+    async def _last(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.flip(interaction, self.pages)
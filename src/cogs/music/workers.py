@@ -0,0 +1,379 @@
+"""Audio worker processes. A worker resolves links with yt-dlp, probes and starts ffmpeg for the streams
+    the bot plays and sends it the opus frames over a Unix socket. ffmpeg is a subprocess either way, what moves
+    out of the bot is yt-dlp extraction, ffprobe and reading the ffmpeg pipes, seeking included.
+    Run by WorkerPool from src: python -m cogs.music.workers --socket PATH --index N"""
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+import socketserver
+import logging
+import logging.handlers
+
+import discord
+
+from .ytdl import YTDLSource, YTDLError, PlaybackSource
+from .telemetry import TrackTelemetry
+
+logger = logging.getLogger('discord.' + __name__)
+logger.setLevel(logging.DEBUG)
+
+worker_start_timeout = 10   # seconds to wait for a worker to listen on its socket
+request_timeout = 120       # seconds a worker has to answer a command, resolving a link with yt-dlp included
+stall_timeout = 15          # seconds without a frame from a worker before the stream counts as ended
+
+# Keys of the yt-dlp info that the player and create_source use, the rest isn't worth sending around
+STREAM_INFO_KEYS = ('url', 'id', 'extractor_key', 'title', 'duration', 'webpage_url',
+                    'uploader', 'uploader_url', 'upload_date', 'thumbnail')
+
+def stream_info(info: dict):
+    return {key: info.get(key) for key in STREAM_INFO_KEYS}
+
+# Messages both ways are a kind byte (b'J' json, b'A' opus frame), a 4 byte length and the payload
+HEADER = struct.Struct('>cI')
+
+def send_message(sock: socket.socket, kind: bytes, payload: bytes):
+    sock.sendall(HEADER.pack(kind, len(payload)) + payload)
+
+def send_json(sock: socket.socket, message: dict):
+    send_message(sock, b'J', json.dumps(message, separators = (',', ':')).encode())
+
+def recv_exact(sock: socket.socket, size: int):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+def recv_message(sock: socket.socket):
+    """(kind, payload) of the next message, (None, None) once the other end hangs up"""
+    header = recv_exact(sock, HEADER.size)
+    if header is None:
+        return None, None
+    kind, size = HEADER.unpack(header)
+    payload = recv_exact(sock, size)
+    if payload is None:
+        return None, None
+    return kind, payload
+
+class WorkerAudioSource(discord.AudioSource):
+    """Opus frames of a stream played by an audio worker. The voice client's send thread reads them
+        from the socket, the worker blocks on a full socket buffer so it only runs a few seconds ahead."""
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.closed = False
+        self.ended = False
+        self._lock = threading.Lock()
+        self._read_lock = threading.Lock()  # seek() drains the socket while the voice thread is paused
+
+    def _next_message(self):
+        """(kind, payload) of the next frame or event, (None, None) once the stream is over"""
+        if self.closed or self.ended:
+            return None, None
+        try:
+            kind, payload = recv_message(self.sock)
+        except OSError:     # Timed out or closed under us
+            kind, payload = None, None
+        if kind == b'J':
+            message = json.loads(payload)
+            if message.get('event') == 'end' or 'error' in message:
+                kind, payload = None, None
+        if kind is None:
+            self.ended = True
+        return kind, payload
+
+    def read(self):
+        with self._read_lock:
+            while True:
+                kind, payload = self._next_message()
+                if kind == b'A':
+                    return payload
+                if kind is None:
+                    return b''
+
+    def seek(self, offset: float):
+        """Have the worker restart the stream at offset seconds. Blocks until the worker did, dropping
+            the frames from before the seek, False if the stream ended instead"""
+        with self._read_lock:
+            self._send({'cmd': 'seek', 'offset': offset})
+            while True:
+                kind, payload = self._next_message()
+                if kind is None:
+                    return False
+                if kind == b'J' and json.loads(payload).get('event') == 'seeked':
+                    return True
+
+    def is_opus(self):
+        return True
+
+    def _send(self, message: dict):
+        with self._lock:
+            if not self.closed:
+                send_json(self.sock, message)
+
+    def cleanup(self):
+        if self.closed:
+            return
+        try:
+            self._send({'cmd': 'stop'})
+        except OSError:
+            pass
+        self.closed = True
+        self.sock.close()
+
+class AudioWorker():
+    """A worker process and the socket it listens on"""
+    def __init__(self, index: int, directory: str):
+        self.index = index
+        self.path = os.path.join(directory, f"goplay-audio-{os.getpid()}-{index}.sock")
+        self.process = None
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        self.process = subprocess.Popen([sys.executable, '-m', 'cogs.music.workers',
+                                         '--socket', self.path, '--index', str(self.index)])
+        logger.info(f"Started audio worker {self.index} as pid {self.process.pid}")
+
+    def stop(self):
+        if self.alive:
+            self.process.terminate()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def connect(self):
+        """Blocking connection to the worker, waits for a worker that is still starting"""
+        deadline = time.monotonic() + worker_start_timeout
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+                sock.settimeout(request_timeout)
+                return sock
+            except (FileNotFoundError, ConnectionRefusedError):
+                sock.close()
+                if time.monotonic() > deadline:
+                    raise YTDLError(f"Audio worker {self.index} isn't listening")
+                time.sleep(0.1)
+
+    def request(self, command: dict):
+        """Send a command and wait for the first reply, returns (socket, reply)"""
+        sock = self.connect()
+        try:
+            send_json(sock, command)
+            kind, payload = recv_message(sock)
+        except OSError as e:
+            sock.close()
+            raise YTDLError(f"Audio worker {self.index} failed: {e}")
+        if kind != b'J':
+            sock.close()
+            raise YTDLError(f"Audio worker {self.index} hung up")
+        reply = json.loads(payload)
+        if 'error' in reply:
+            sock.close()
+            raise YTDLError(reply['error'])
+        return sock, reply
+
+class WorkerPool():
+    """Audio worker processes of the bot, each guild streams through the same worker.
+        The blocking socket calls run in the default executor, workers that died are started again on use."""
+    def __init__(self, count: int, directory: str = None):
+        directory = directory or tempfile.gettempdir()
+        self.workers = [AudioWorker(i, directory) for i in range(count)]
+
+    def start(self):
+        for worker in self.workers:
+            if not worker.alive:    # Workers handed over by a reloaded cog keep running
+                worker.start()
+
+    def close(self):
+        for worker in self.workers:
+            worker.stop()
+
+    def worker_for(self, guild_id: int):
+        worker = self.workers[guild_id % len(self.workers)]
+        if not worker.alive:
+            if worker.process is not None:
+                logger.warning(f"Audio worker {worker.index} exited with {worker.process.returncode}, restarting it")
+            worker.start()
+        return worker
+
+    async def _request(self, guild_id: int, command: dict):
+        worker = self.worker_for(guild_id)
+        return await asyncio.get_running_loop().run_in_executor(None, worker.request, command)
+
+    async def resolve_info(self, guild_id: int, link: str):
+        """Same as YTDLSource.resolve_info, run by the worker"""
+        sock, reply = await self._request(guild_id, {'cmd': 'resolve', 'url': link})
+        sock.close()
+        return reply['info']
+
+    async def create_source(self, guild_id: int, link: str, *, offset: float = 0,
+                            telemetry: TrackTelemetry = None, info: dict = None):
+        """Same as YTDLSource.create_source, with the worker resolving the link and running ffmpeg"""
+        telemetry = telemetry or TrackTelemetry()
+        command = {'cmd': 'play', 'url': link, 'offset': offset, 'info': stream_info(info) if info else None}
+        sock, reply = await self._request(guild_id, command)
+        sock.settimeout(stall_timeout)
+        for phase, value in reply['telemetry'].items():
+            setattr(telemetry, phase, value)
+        telemetry.spawned_at = time.perf_counter()
+        data = reply['ready']
+        telemetry.title = data.get('title')
+        source = PlaybackSource(WorkerAudioSource(sock), offset, duration = data.get('duration'), telemetry = telemetry)
+        return YTDLSource(source, data = data)
+
+    async def status(self):
+        """Status of every worker, None for the ones not answering"""
+        statuses = []
+        for worker in self.workers:
+            if not worker.alive:
+                statuses.append(None)
+                continue
+            try:
+                sock, reply = await asyncio.get_running_loop().run_in_executor(None, worker.request, {'cmd': 'status'})
+                sock.close()
+            except YTDLError:
+                reply = None
+            statuses.append(reply)
+        return statuses
+
+# Worker process side
+
+class StreamServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str):
+        super().__init__(path, StreamHandler)
+        self.started = time.monotonic()
+        self.streams = 0
+        self.lock = threading.Lock()
+
+    def status(self):
+        with self.lock:
+            return {'pid': os.getpid(), 'streams': self.streams, 'uptime': time.monotonic() - self.started}
+
+def open_stream(link: str, offset: float, info: dict, telemetry: TrackTelemetry):
+    # create_source only awaits executor jobs and ffprobe, it runs fine in a loop of its own per stream thread
+    return asyncio.run(YTDLSource.create_source(link, offset = offset, telemetry = telemetry, info = info))
+
+class StreamHandler(socketserver.BaseRequestHandler):
+    """A connection from the bot, its first message is one of the commands play, resolve or status.
+        A play connection then carries the frames, and stop and seek commands from the bot"""
+    def handle(self):
+        kind, payload = recv_message(self.request)
+        if kind != b'J':
+            return
+        command = json.loads(payload)
+        try:
+            match command.get('cmd'):
+                case 'status':
+                    send_json(self.request, self.server.status())
+                case 'resolve':
+                    try:
+                        info = asyncio.run(YTDLSource.resolve_info(command['url']))
+                    except Exception as e:
+                        return send_json(self.request, {'error': str(e)})
+                    send_json(self.request, {'info': stream_info(info)})
+                case 'play':
+                    self.play(command)
+        except OSError:     # The bot hung up
+            pass
+
+    def play(self, command: dict):
+        sock = self.request
+        telemetry = TrackTelemetry()
+        try:
+            source = open_stream(command['url'], command.get('offset', 0), command.get('info'), telemetry)
+        except Exception as e:
+            logger.error(f"Couldn't open {command['url']}: {e}")
+            return send_json(sock, {'error': str(e)})
+        send_json(sock, {'ready': stream_info(source.data),
+                         'telemetry': {'extraction': telemetry.extraction, 'resolution': telemetry.resolution,
+                                       'probe': telemetry.probe, 'shared': telemetry.shared}})
+
+        control = {'stop': False, 'seek': None}
+        threading.Thread(target = self.listen, args = (control, ), daemon = True).start()
+        with self.server.lock:
+            self.server.streams += 1
+        try:
+            while not control['stop']:
+                if control['seek'] is not None:
+                    # The info of the running stream is reused, only ffmpeg starts again
+                    offset, control['seek'] = control['seek'], None
+                    source.audio_source.cleanup()
+                    try:
+                        source = open_stream(command['url'], offset, stream_info(source.data), None)
+                    except Exception as e:
+                        logger.error(f"Couldn't seek {command['url']} to {offset:.2f}s: {e}")
+                        send_json(sock, {'error': str(e)})
+                        break
+                    send_json(sock, {'event': 'seeked', 'offset': offset})
+                frame = source.audio_source.read()
+                if not frame:
+                    send_json(sock, {'event': 'end'})
+                    break
+                send_message(sock, b'A', frame)
+        finally:
+            source.audio_source.cleanup()
+            with self.server.lock:
+                self.server.streams -= 1
+
+    def listen(self, control: dict):
+        """Commands the bot sends while the frames flow"""
+        sock = self.request
+        while not control['stop']:
+            try:
+                kind, payload = recv_message(sock)
+            except OSError:
+                kind = None
+            if kind is None:    # The bot hung up
+                control['stop'] = True
+                return
+            message = json.loads(payload)
+            if message.get('cmd') == 'stop':
+                control['stop'] = True
+            elif message.get('cmd') == 'seek':
+                control['seek'] = float(message['offset'])
+
+def exit_with_parent(parent: int):
+    """Workers don't outlive the bot, even when it is killed without stopping them"""
+    while os.getppid() == parent:
+        time.sleep(1)
+    os._exit(0)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', required = True)
+    parser.add_argument('--index', type = int, default = 0)
+    args = parser.parse_args()
+
+    handler = logging.handlers.RotatingFileHandler(filename = f'logs/audio-worker-{args.index}.log', encoding = 'utf-8',
+                                                   maxBytes = 16 * 1024 * 1024, backupCount = 3)
+    handler.setFormatter(logging.Formatter('[{asctime}] [{levelname:<8}] {name}: {message}', '%Y-%m-%d %H:%M:%S', style = '{'))
+    logging.getLogger('discord').addHandler(handler)
+
+    threading.Thread(target = exit_with_parent, args = (os.getppid(), ), daemon = True).start()
+    with StreamServer(args.socket) as server:
+        logger.info(f"Audio worker {args.index} listening on {args.socket}")
+        server.serve_forever()
+
+if __name__ == '__main__':
+    main()
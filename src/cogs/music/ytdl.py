@@ -2,12 +2,33 @@ import discord
 import yt_dlp
 import asyncio
 import functools
+import time
 
 from discord.ext import commands
+from .fanout import shared_streams
+from .telemetry import TrackTelemetry
 
 # Suppress noise about console usage from errors
 #yt_dlp.utils.bug_reports_message = lambda: ''
 
+def format_length(seconds: float):
+    """h:mm:ss, or m:ss under an hour"""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+def parse_length(text: str):
+    """Seconds of h:mm:ss, m:ss or plain seconds, None if text is none of them"""
+    parts = text.strip().split(':')
+    if len(parts) > 3:
+        return None
+    seconds = 0
+    for part in parts:
+        if not part.replace('.', '', 1).isdigit():
+            return None
+        seconds = seconds * 60 + float(part)
+    return seconds
+
 class VoiceError(Exception):
     pass
 
@@ -15,13 +36,15 @@ class YTDLError(Exception):
     pass
 
 class YTDLMetadata():
-    """Class to contain full Metadata about the song, extracted from youtube_dl"""
-    __Slots__ = ('requester', 'channel', 'ctx', 'uploader', 'uploader_url', 'date', 'title', 'thumbnail', 'duration' , 'url')
+    """Class to contain full Metadata about the song, extracted from youtube_dl.
+        Only the ids of the requester and channel are kept, not the command context"""
+    __slots__ = ('requester_id', 'channel_id', 'uploader', 'uploader_url', 'date', 'title', 'thumbnail', 'duration' , 'length', 'url')
     def __init__(self, ctx: commands.Context, data: dict):
-        self.requester = ctx.author
-        self.channel = ctx.channel
-        self.ctx = ctx
+        self.requester_id = ctx.author.id
+        self.channel_id = ctx.channel.id
+        self._parse(data)
         
+    def _parse(self, data: dict):
         self.uploader = data.get('uploader')
         self.uploader_url = data.get('uploader_url')
         date = data.get('upload_date')
@@ -29,17 +52,31 @@ class YTDLMetadata():
         self.title = data.get('title')
         self.thumbnail = data.get('thumbnail')
         self.duration = self.parse_duration(int(data.get('duration')))
+        self.length = data.get('duration')  # seconds
         self.url = data.get('webpage_url')
         
+    @classmethod
+    def from_entry(cls, entry, data: dict):
+        """Full metadata of a queued entry, keeping who queued it and where"""
+        metadata = cls.__new__(cls)
+        metadata.requester_id = entry.requester_id
+        metadata.channel_id = entry.channel_id
+        metadata._parse(data)
+        return metadata
+        
     def __str__(self):
         return f'**{self.title}** by **{self.uploader}**'
     
+    @property
+    def mention(self):
+        return f"<@{self.requester_id}>"
+    
     def create_embed(self):
         embed = (discord.Embed(title = "Now Playing",
                                description = f"```css\n{self.title}\n```",
                                color = discord.Color.magenta())
                 .add_field(name = "Duration", value = self.duration)
-                .add_field(name = "Requested by", value = self.requester.mention)
+                .add_field(name = "Requested by", value = self.mention)
                 .add_field(name = "Uploader", value = f"[{self.uploader}]({self.uploader_url})")
                 .add_field(name = "URL", value = f"[Click]({self.url})")
                 .set_thumbnail(url = self.thumbnail))
@@ -65,19 +102,34 @@ class YTDLMetadata():
         return ', '.join(duration)
 
 class BasicMetadata():
-    """Class to contain only basic data about the link"""
-    __Slots__ = ('requester', 'channel', 'ctx', 'url', 'title')
+    """Class to contain only basic data about the link, with the ids of the requester and channel"""
+    __slots__ = ('requester_id', 'channel_id', 'url', 'title', 'length')
     
-    def __init__(self, ctx: commands.Context, url: str, title: str):
-        self.requester = ctx.author
-        self.channel = ctx.channel
-        self.ctx = ctx
+    def __init__(self, ctx: commands.Context, url: str, title: str, length: float = None):
+        self.requester_id = ctx.author.id
+        self.channel_id = ctx.channel.id
         
         self.url = url
         self.title = title
+        self.length = length    # seconds, when the extractor knew it
+        
+    @classmethod
+    def restored(cls, requester_id: int, channel_id: int, url: str, title: str, length: float = None):
+        """Entry rebuilt from a saved queue, there is no command context behind it"""
+        metadata = cls.__new__(cls)
+        metadata.requester_id = requester_id
+        metadata.channel_id = channel_id
+        metadata.url = url
+        metadata.title = title
+        metadata.length = length
+        return metadata
 
     def __str__(self):
         return f'**{self.title}** by **{self.url}**'
+    
+    @property
+    def mention(self):
+        return f"<@{self.requester_id}>"
 
 class YTDLExtractorFlat():
     """Youtube_dl extractor for links and playlists"""
@@ -119,7 +171,7 @@ class YTDLExtractorFlat():
         else:                           # The link is for a playlist
             url_list = []
             for entry in data['entries']:
-                url_list.append(BasicMetadata(ctx, url = entry['url'], title = entry['title']))
+                url_list.append(BasicMetadata(ctx, url = entry['url'], title = entry['title'], length = entry.get('duration')))
             return url_list
 
 class YTDLExtractorNonFlat():
@@ -160,6 +212,54 @@ class YTDLExtractorNonFlat():
             metadata_object = YTDLMetadata(ctx, data['entries'][0])
             return metadata_object
 
+class PlaybackSource(discord.AudioSource):
+    """Wrapper over the ffmpeg source that keeps count of the frames sent,
+        so the player knows where to pick the stream up again"""
+    FRAME_LENGTH = discord.opus.Encoder.FRAME_LENGTH / 1000 # seconds
+    EARLY_END_TOLERANCE = 5 # seconds before the expected end that still count as a full play
+    
+    def __init__(self, original: discord.AudioSource, offset: float = 0, *, 
+                 duration: float = None, telemetry: TrackTelemetry = None):
+        self.original = original
+        self.offset = offset
+        self.frames = 0
+        self.duration = duration
+        self.telemetry = telemetry
+        
+    @property
+    def position(self):
+        """Seconds into the track, including the offset the stream was started at"""
+        return self.offset + self.frames * self.FRAME_LENGTH
+    
+    def seeked(self, position: float):
+        """The stream goes on at position, the frames played so far stay counted for the telemetry"""
+        self.offset = position - self.frames * self.FRAME_LENGTH
+    
+    def read(self):
+        if self.telemetry is None:
+            data = self.original.read()
+            if data:
+                self.frames += 1
+            return data
+        
+        start = time.perf_counter()
+        data = self.original.read()
+        if data:
+            if self.frames == 0:
+                self.telemetry.first_frame()
+            elif time.perf_counter() - start > self.FRAME_LENGTH:  # The voice thread will send this frame late
+                self.telemetry.underruns += 1
+            self.frames += 1
+        elif self.duration and self.position < self.duration - self.EARLY_END_TOLERANCE:
+            self.telemetry.premature_end = True
+        return data
+    
+    def is_opus(self):
+        return self.original.is_opus()
+    
+    def cleanup(self):
+        self.original.cleanup()
+
 class YTDLSource():
     """Youtube_dl based ffmpeg source for audio.
         Extracts the stream url from a link and creates the source"""
@@ -186,17 +286,30 @@ class YTDLSource():
     
     ytdl = yt_dlp.YoutubeDL(YTDL_FORMAT_OPTIONS)
     
-    def __init__(self, ctx: commands.Context, source: discord.FFmpegOpusAudio, *, data: dict):
+    def __init__(self, source: PlaybackSource, *, data: dict):
         self.audio_source = source
-        self.ctx = ctx
         self.data = data
     
     @classmethod
-    async def create_source(cls, ctx: commands.Context, link: str, *, loop: asyncio.BaseEventLoop = None):
+    async def resolve_info(cls, link: str, *, loop: asyncio.BaseEventLoop = None, telemetry: TrackTelemetry = None):
+        """yt-dlp info of the track at link with its stream url, the slow part of create_source.
+            Resolved ahead of time it can be handed to create_source"""
         loop = loop or asyncio.get_event_loop()
+        telemetry = telemetry or TrackTelemetry()
+        
+        # Same as extract_info(process = True), split in two to time metadata extraction and stream resolution
+        start = time.perf_counter()
+        partial = functools.partial(cls.ytdl.extract_info, link, download=False, process=False)
+        extracted_info = await loop.run_in_executor(None, partial)
+        telemetry.extraction = time.perf_counter() - start
         
-        partial = functools.partial(cls.ytdl.extract_info, link, download=False)
+        if extracted_info is None:
+            raise YTDLError(f"Couldn't fetch {link}")
+        
+        start = time.perf_counter()
+        partial = functools.partial(cls.ytdl.process_ie_result, extracted_info, download=False)
         processed_info = await loop.run_in_executor(None, partial)
+        telemetry.resolution = time.perf_counter() - start
         
         if processed_info is None:
             raise YTDLError(f"Couldn't fetch {link}")
@@ -210,7 +323,36 @@ class YTDLSource():
                     info = processed_info['entries'].pop(0)
                 except IndexError:
                     raise YTDLError(f"Couldn't retrieve any matches for {link}")
-        
-        ffmpeg_source = await discord.FFmpegOpusAudio.from_probe(info['url'], **cls.FFMPEG_OPTIONS)
-        return cls(ctx, ffmpeg_source, data=info)
+        return info
     
+    @classmethod
+    async def create_source(cls, link: str, *, loop: asyncio.BaseEventLoop = None, 
+                            offset: float = 0, telemetry: TrackTelemetry = None, info: dict = None):
+        """Open the stream of the track at link, info from resolve_info() skips asking yt-dlp again"""
+        loop = loop or asyncio.get_event_loop()
+        telemetry = telemetry or TrackTelemetry()
+        if info is None:
+            info = await cls.resolve_info(link, loop = loop, telemetry = telemetry)
+        
+        ffmpeg_options = dict(cls.FFMPEG_OPTIONS)
+        if offset > 0:  # Resuming a track, seek the input instead of decoding the skipped part
+            ffmpeg_options['before_options'] += f" -ss {offset:.2f}"
+        
+        async def open_ffmpeg():
+            # Same as FFmpegOpusAudio.from_probe, split to time ffprobe and the ffmpeg spawn
+            start = time.perf_counter()
+            codec, bitrate = await discord.FFmpegOpusAudio.probe(info['url'])
+            telemetry.probe = time.perf_counter() - start
+            telemetry.spawned_at = time.perf_counter()
+            return discord.FFmpegOpusAudio(info['url'], bitrate = bitrate, codec = codec, **ffmpeg_options)
+        
+        if info.get('id') is None:
+            audio_source = await open_ffmpeg()
+        else:   # Guilds playing the same track at the same time share one ffmpeg process
+            key = (info.get('extractor_key'), info['id'], round(offset, 2))
+            audio_source = await shared_streams.open(key, open_ffmpeg)
+            telemetry.shared = telemetry.spawned_at is None
+            
+        telemetry.title = info.get('title')
+        source = PlaybackSource(audio_source, offset, duration = info.get('duration'), telemetry = telemetry)
+        return cls(source, data=info)
@@ -0,0 +1,222 @@
+"""Outbound message scheduler shared by the cogs.
+    Messages to a channel wait a short window so bursts go out merged into fewer messages, and every request
+    goes through rate limit buckets kept from the X-RateLimit headers, so commands never sleep on a 429."""
+import time
+import asyncio
+import logging
+import collections
+import urllib.parse
+
+import aiohttp
+import discord
+
+logger = logging.getLogger('discord.' + __name__)
+logger.setLevel(logging.DEBUG)
+
+api_base = 'https://discord.com/api/v10'
+coalesce_window = 0.3   # seconds a channel collects messages before sending them, merged where possible
+max_content = 2000      # characters Discord allows in a message
+max_description = 4096  # characters Discord allows in an embed description
+
+class RateLimit():
+    """A rate limit bucket as told by the X-RateLimit headers of its last response"""
+    __slots__ = ('remaining', 'reset_at')
+
+    def __init__(self):
+        self.remaining = 1
+        self.reset_at = 0.0
+
+    def delay(self, now: float):
+        """Seconds to wait before the next request"""
+        if self.remaining <= 0 and self.reset_at > now:
+            return self.reset_at - now
+        return 0
+
+    def update(self, headers, now: float):
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset_after = headers.get('X-RateLimit-Reset-After')
+        if remaining is not None:
+            self.remaining = int(remaining)
+        if reset_after is not None:
+            self.reset_at = now + float(reset_after)
+
+class HTTPSender():
+    """Sends the outbox requests to the REST API with aiohttp rather than through discord.py,
+        so the outbox sees the rate limit headers and does the waiting itself.
+        token is a callable, the bot only has its token once it logged in. Point api_base at a fake API to test."""
+    def __init__(self, token, base: str = None):
+        self.token = token
+        self.base = base or api_base
+        self._session = None
+
+    async def request(self, method: str, path: str, payload: dict = None):
+        """(status, headers, json body) of the response"""
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        headers = {'Authorization': f"Bot {self.token()}"}
+        async with self._session.request(method, self.base + path, json = payload, headers = headers) as response:
+            data = await response.json() if response.content_type == 'application/json' else None
+            return response.status, response.headers, data
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+class Outgoing():
+    """A request waiting in the outbox of a channel"""
+    __slots__ = ('route', 'method', 'path', 'payload', 'merge', 'delete_after')
+
+    def __init__(self, route: str, method: str, path: str, payload: dict = None, merge: bool = False, delete_after: float = None):
+        self.route = route
+        self.method = method
+        self.path = path
+        self.payload = payload
+        self.merge = merge
+        self.delete_after = delete_after
+
+    def merged(self, other):
+        """This message with the other appended, None if they can't go out as one message"""
+        if not (self.merge and other.merge and self.path == other.path and self.delete_after == other.delete_after):
+            return None
+        a, b = self.payload, other.payload
+        if 'embeds' in a and 'embeds' in b:
+            ea, eb = a['embeds'][0], b['embeds'][0]
+            if (ea.get('title'), ea.get('color')) != (eb.get('title'), eb.get('color')):
+                return None
+            description = ea.get('description', '') + '\n' + eb.get('description', '')
+            if len(description) > max_description:
+                return None
+            payload = {'embeds': [dict(ea, description = description)]}
+        elif 'content' in a and 'content' in b and a.get('flags') == b.get('flags'):
+            content = a['content'] + '\n' + b['content']
+            if len(content) > max_content:
+                return None
+            payload = dict(a, content = content)
+        else:
+            return None
+        return Outgoing(self.route, self.method, self.path, payload, True, self.delete_after)
+
+class Outbox():
+    """Per channel queues of outbound messages, reactions and deletes, each drained by a short lived task.
+        A channel's queue waits window seconds after its first message, then consecutive messages of the same
+        kind are merged and everything is sent in order, waiting on the rate limit buckets when they run out."""
+    def __init__(self, sender, window: float = coalesce_window):
+        self.sender = sender
+        self.window = window
+        self.sent = 0           # Requests made
+        self.merged = 0         # Messages that went out merged into another
+        self.rate_limited = 0   # 429 responses, the buckets should keep this at 0
+        self._pending = {}      # channel id -> deque of Outgoing
+        self._drains = {}       # channel id -> task draining its queue
+        self._limits = {}       # (route, channel id) -> RateLimit
+        self._global_reset = 0.0
+
+    def _enqueue(self, channel_id: int, item: Outgoing):
+        self._pending.setdefault(channel_id, collections.deque()).append(item)
+        if channel_id not in self._drains:
+            self._drains[channel_id] = asyncio.get_running_loop().create_task(self._drain(channel_id))
+
+    def info(self, channel_id: int, description: str, *, title: str = None,
+             color: discord.Color = None, delete_after: float = None):
+        """Queue an embed, embeds of the same title and color sent within the window become one"""
+        embed = discord.Embed(title = title, description = description, color = color)
+        self._enqueue(channel_id, Outgoing('messages', 'POST', f"/channels/{channel_id}/messages",
+                                           {'embeds': [embed.to_dict()]}, True, delete_after))
+
+    def embed(self, channel_id: int, embed: discord.Embed, *, delete_after: float = None):
+        """Queue a full embed (fields, thumbnail), it goes out as a message of its own"""
+        self._enqueue(channel_id, Outgoing('messages', 'POST', f"/channels/{channel_id}/messages",
+                                           {'embeds': [embed.to_dict()]}, False, delete_after))
+
+    def send(self, channel_id: int, content: str, *, suppress_embeds: bool = False,
+             merge: bool = True, delete_after: float = None):
+        """Queue a text message, merged with the texts around it unless merge is False (links meant to embed)"""
+        payload = {'content': content}
+        if suppress_embeds:
+            payload['flags'] = discord.MessageFlags(suppress_embeds = True).value
+        self._enqueue(channel_id, Outgoing('messages', 'POST', f"/channels/{channel_id}/messages",
+                                           payload, merge, delete_after))
+
+    def react(self, channel_id: int, message_id: int, emoji: str):
+        emoji = urllib.parse.quote(emoji)
+        self._enqueue(channel_id, Outgoing('reactions', 'PUT',
+                                           f"/channels/{channel_id}/messages/{message_id}/reactions/{emoji}/@me"))
+
+    def delete(self, channel_id: int, message_id: int):
+        self._enqueue(channel_id, Outgoing('delete', 'DELETE', f"/channels/{channel_id}/messages/{message_id}"))
+
+    async def flush(self, channel_id: int):
+        """Wait until everything queued for the channel went out.
+            Messages sent around the outbox (with a view to edit later) wait on this to keep the channel in order"""
+        drain = self._drains.get(channel_id)
+        if drain is not None:
+            await asyncio.shield(drain)
+
+    async def close(self):
+        for drain in list(self._drains.values()):
+            drain.cancel()
+        await self.sender.close()
+
+    async def _drain(self, channel_id: int):
+        queue = self._pending[channel_id]
+        try:
+            await asyncio.sleep(self.window)
+            while queue:
+                item = queue.popleft()
+                while queue:
+                    merged = item.merged(queue[0])
+                    if merged is None:
+                        break
+                    queue.popleft()
+                    item = merged
+                    self.merged += 1
+                try:
+                    data = await self._request(channel_id, item)
+                    if item.delete_after is not None and data is not None:
+                        asyncio.get_running_loop().call_later(item.delete_after, self.delete, channel_id, int(data['id']))
+                except Exception:   # A failed request drops that message, the rest of the queue still goes out
+                    logger.exception(f"Couldn't {item.method} {item.path}")
+        finally:
+            del self._drains[channel_id]
+            if not queue:
+                del self._pending[channel_id]
+
+    async def _request(self, channel_id: int, item: Outgoing):
+        """Make the request once its rate limit allows, again after a 429. Returns the response body, None on errors"""
+        limit = self._limits.setdefault((item.route, channel_id), RateLimit())
+        while True:
+            now = time.monotonic()
+            delay = max(limit.delay(now), self._global_reset - now)
+            if delay > 0:
+                logger.debug(f"Waiting {delay:.2f}s on the {item.route} rate limit of channel {channel_id}")
+                await asyncio.sleep(delay)
+
+            start = time.perf_counter_ns()
+            status, headers, data = await self.sender.request(item.method, item.path, item.payload)
+            self.sent += 1
+            now = time.monotonic()
+            limit.update(headers, now)
+            if status != 429:
+                break
+            self.rate_limited += 1
+            retry_after = float((data or {}).get('retry_after', 1))
+            if headers.get('X-RateLimit-Global'):
+                self._global_reset = now + retry_after
+            else:
+                limit.remaining = 0
+                limit.reset_at = now + retry_after
+            logger.warning(f"Rate limited on {item.route} in channel {channel_id}, retrying in {retry_after:.2f}s")
+
+        logger.debug(f"Took [{time.perf_counter_ns() - start}] nanoseconds to {item.method} {item.path}")
+        if status >= 400:
+            logger.error(f"{item.method} {item.path} failed with {status}: {data}")
+            return None
+        return data
+
+def outbox_for(bot):
+    """The outbox of the bot, shared by the cogs so they all go by the same rate limit buckets"""
+    outbox = getattr(bot, 'outbox', None)
+    if outbox is None:
+        outbox = bot.outbox = Outbox(HTTPSender(lambda: bot.http.token))
+    return outbox
@@ -1,10 +1,34 @@
+import time
 import asyncio
+import argparse
 
 import discord
 import logging
 import logging.handlers
 from discord.ext import commands
 
+from cogs import outbox
+from cogs.music import journal, standby
+
+# Shards of this process, given by cluster.py when it runs several processes.
+# Without them one process runs every shard Discord recommends.
+parser = argparse.ArgumentParser()
+parser.add_argument('--shard-ids', help="contiguous range of shards to run, like 0-3")
+parser.add_argument('--shard-count', type=int, help="total number of shards of the bot")
+parser.add_argument('--cluster', type=int, help="number of this process, it names the log file")
+# Warm standby, see cogs/music/standby.py. Started with --standby, the process waits for the heartbeat
+# of the one running the players to stop and then takes over their queues.
+# With --shard-ids it stands by for the cluster process running the same shards.
+parser.add_argument('--standby', action='store_true', help="wait for the running bot to fail and take over its queues")
+parser.add_argument('--journal-dir', help="directory of the queue journals and the heartbeat, a replica for the standby")
+parser.add_argument('--api-base', help="Discord API to talk to, like a fake one to test failovers against")
+args = parser.parse_args()
+
+shard_ids = None
+if args.shard_ids:
+    first, _, last = args.shard_ids.partition('-')
+    shard_ids = list(range(int(first), int(last or first) + 1))
+
 # Setting up Logger
 logger = logging.getLogger('discord')
 logger.setLevel(logging.INFO)
@@ -12,7 +36,7 @@ logging.getLogger('discord.http').setLevel(logging.ERROR)
 logging.getLogger('discord.gateway').setLevel(logging.INFO)
 
 handler = logging.handlers.RotatingFileHandler(
-    filename='logs/discord.log',
+    filename='logs/discord.log' if args.cluster is None else f'logs/cluster-{args.cluster}.log',
     encoding='utf-8',
     maxBytes=16 * 1024 * 1024,  # 16 MiB
     backupCount=3,  # Rotate through 3 files
@@ -28,10 +52,16 @@ initialExtensions = ['cogs.music.music', 'cogs.basics', 'cogs.gpca']
 with open("txts/token.txt","r") as f:
     token = f.read()
 
+if args.journal_dir:
+    journal.journal_dir = args.journal_dir
+if args.api_base:
+    discord.http.Route.BASE = outbox.api_base = args.api_base
+
 intents = discord.Intents.default()
 intents.message_content = True
 
-client = commands.Bot(command_prefix=commands.when_mentioned_or(";"), intents=intents)
+client = commands.AutoShardedBot(command_prefix=commands.when_mentioned_or(";"), intents=intents,
+                                 shard_ids=shard_ids, shard_count=args.shard_count)
 
 
 @client.command(name="reload")
@@ -40,11 +70,18 @@ async def _reload(ctx: commands.Context, ext: str):
     """Reloads the specified module (Staff only)"""
     
     if ext in ["music", "Music"]:
-        await client.reload_extension('cogs.music.music')
-        await ctx.send("Reloaded the music module!")
-    elif ext in initialExtensions:
+        ext = 'cogs.music.music'
+    elif ext not in initialExtensions:
+        return
+    start = time.perf_counter_ns()
+    client.reloading = ext   # The music cog hands its players over instead of stopping them
+    try:
         await client.reload_extension(ext)
-        await ctx.send(f"Reloaded the {ext} module!")
+    finally:
+        client.reloading = None
+    elapsed = time.perf_counter_ns() - start
+    logger.info(f"Took [{elapsed}] nanoseconds to reload {ext}")
+    await ctx.send(f"Reloaded the {ext.split('.')[-1]} module in {elapsed / 1e6:.1f} ms!")
 
 @client.event
 async def on_ready():
@@ -56,7 +93,13 @@ async def load_extensions():
 
 async def main():
     async with client:
+        if args.standby:
+            client.takeover = await standby.stand_by(shard_ids=shard_ids, shard_count=args.shard_count)   # The music cog restores the queues from it
         await load_extensions()
-        await client.start(token)
+        try:
+            await client.start(token)
+        finally:
+            if getattr(client, 'outbox', None) is not None:
+                await client.outbox.close()
 
 asyncio.run(main())
@@ -0,0 +1,146 @@
+import asyncio
+import random
+from types import SimpleNamespace
+
+from cogs.music.player import Playlist
+from cogs.music.ytdl import BasicMetadata, YTDLMetadata
+
+def song(requester: int, title: str, length: float = 60):
+    return BasicMetadata.restored(requester, 1, f'https://example.com/{title}', title, length)
+
+def titles(playlist: Playlist):
+    return [entry.title for entry in playlist.songs.upcoming()]
+
+def fair_playlist():
+    """Upcoming a1 b1 c1 a2 b2 a3 after queueing a1 a2 a3, then b1 b2, then c1 in fair mode"""
+    playlist = Playlist()
+    playlist.fair_mode = True
+    async def queue():
+        await playlist.push_entry([song(1, 'a1'), song(1, 'a2'), song(1, 'a3')])
+        await playlist.push_entry([song(2, 'b1'), song(2, 'b2')])
+        await playlist.push_entry([song(3, 'c1')])
+    asyncio.run(queue())
+    return playlist
+
+def test_queued_songs_go_in_at_their_turn():
+    playlist = fair_playlist()
+    assert titles(playlist) == ['a1', 'b1', 'c1', 'a2', 'b2', 'a3']
+
+    # A single song through the YTDLMetadata path, c has one song queued so theirs closes the second round
+    ctx = SimpleNamespace(author = SimpleNamespace(id = 3), channel = SimpleNamespace(id = 1))
+    data = {'upload_date': '20200101', 'title': 'c2', 'duration': 60, 'webpage_url': 'https://example.com/c2'}
+    assert asyncio.run(playlist.push_entry(YTDLMetadata(ctx, data))) == 1
+    assert titles(playlist) == ['a1', 'b1', 'c1', 'a2', 'b2', 'c2', 'a3']
+
+def test_turning_fair_mode_on_reorders_the_upcoming_songs():
+    playlist = Playlist()
+    asyncio.run(playlist.push_entry([song(1, 'a1'), song(1, 'a2'), song(2, 'b1'), song(1, 'a3'), song(2, 'b2')]))
+    playlist.fair_mode = True
+    assert titles(playlist) == ['a1', 'b1', 'a2', 'b2', 'a3']
+
+def test_queue_positions_are_the_play_order():
+    playlist = fair_playlist()
+    shown = [entry.title for entry in asyncio.run(playlist.window(0, len(playlist)))]
+    played = [playlist.get_nowait().title for _ in range(len(playlist))]
+    assert played == shown
+
+def test_skipto_plays_the_song_shown_at_that_position():
+    playlist = fair_playlist()
+    playlist.get_nowait()   # a1 plays
+    asyncio.run(playlist.shift_queues_to(5 - 1))   # ;skipto 5 shows b2
+    assert playlist.get_nowait().title == 'b2'
+    assert titles(playlist) == ['a3']
+
+def test_playtop_plays_next():
+    playlist = fair_playlist()
+    playlist.get_nowait()
+    asyncio.run(playlist.push_entry([song(3, 'c99')], pushTopFlag = True))
+    assert playlist.get_nowait().title == 'c99'
+    assert playlist.get_nowait().title == 'b1'
+
+def test_remove_takes_the_shown_position():
+    playlist = fair_playlist()
+    playlist.get_nowait()
+    assert playlist.remove_song(3).title == 'c1'
+    assert playlist.remove_songs([(2, 2), (4, 5)]) == 3
+    assert titles(playlist) == ['a2']
+
+def test_move_takes_the_shown_positions():
+    playlist = fair_playlist()
+    playlist.get_nowait()
+    asyncio.run(playlist.move_song(6, 2))
+    assert titles(playlist) == ['a3', 'b1', 'c1', 'a2', 'b2']
+    asyncio.run(playlist.move_songs([(5, 6)], 2))
+    assert titles(playlist) == ['a2', 'b2', 'a3', 'b1', 'c1']
+    assert [playlist.get_nowait().title for _ in range(5)] == ['a2', 'b2', 'a3', 'b1', 'c1']
+
+def test_eta_follows_the_shown_order():
+    playlist = fair_playlist()
+    playlist.get_nowait()
+    assert playlist.eta(4, elapsed = 20) == 40 + 60 * 2
+    assert playlist.next_eta(3, elapsed = 20) == (3, 40 + 60)
+
+def test_requesters_join_the_round_playing_now():
+    playlist = Playlist()
+    playlist.fair_mode = True
+    asyncio.run(playlist.push_entry([song(1, 'a1')]))
+    asyncio.run(playlist.push_entry([song(2, 'b1'), song(2, 'b2')]))
+    playlist.get_nowait()   # a1 plays, A had their turn in the first round
+    asyncio.run(playlist.push_entry([song(3, 'c1')]))
+    asyncio.run(playlist.push_entry([song(1, 'a2')]))
+    assert titles(playlist) == ['b1', 'c1', 'b2', 'a2']
+
+def test_a_batch_is_one_journal_line_and_one_wakeup():
+    playlist = fair_playlist()
+    wakeups = []
+    playlist.songs.on_upcoming = lambda: wakeups.append(None)
+    lines = []
+    playlist.songs.journal = SimpleNamespace(add_at = lambda positions, entries: lines.append((positions, len(entries))))
+    asyncio.run(playlist.push_entry([song(3, 'c2'), song(3, 'c3'), song(3, 'c4')]))
+    assert titles(playlist) == ['a1', 'b1', 'c1', 'a2', 'b2', 'c2', 'a3', 'c3', 'c4']
+    assert lines == [([5, 7, 8], 3)]
+    assert len(wakeups) == 1
+
+def test_songs_queued_after_a_move_go_after_it():
+    playlist = fair_playlist()
+    asyncio.run(playlist.move_song(6, 1))   # a3 first by hand
+    asyncio.run(playlist.push_entry([song(3, 'c2')]))
+    assert titles(playlist) == ['a3', 'a1', 'b1', 'c1', 'a2', 'b2', 'c2']
+
+def test_fair_slots_match_a_plain_list():
+    """Queue, play and remove at random, the queue must stay in the order of a naive model
+        that sorts (round, time queued) with the same round counters"""
+    rng = random.Random(42)
+    playlist = Playlist()
+    playlist.fair_mode = True
+    model = []      # (round, queued, title) of the upcoming songs
+    counters = {}   # requester -> round of their next song if they have nothing upcoming
+    floor = 0
+    queued = 0
+    for step in range(600):
+        action = rng.random()
+        if action < 0.5:
+            requester = rng.randrange(6)
+            count = rng.choice([1, 1, 2, 5])
+            mine = [r for r, _, title in model if title.startswith(f'{requester}-')]
+            start = max(mine) + 1 if mine else max(floor, counters.get(requester, floor))
+            songs = []
+            for i in range(count):
+                title = f'{requester}-{queued}'
+                model.append((start + i, queued, title))
+                songs.append(song(requester, title))
+                queued += 1
+            asyncio.run(playlist.push_entry(songs))
+        elif action < 0.8 and model:
+            model.sort()
+            r, _, title = model.pop(0)
+            assert playlist.get_nowait().title == title
+            floor = max(floor, r)
+            counters[int(title.split('-')[0])] = r + 1
+        elif model:
+            model.sort()
+            position = rng.randrange(len(model))
+            del model[position]
+            playlist.songs.remove(playlist.songs.cursor + position)
+        model.sort()
+        assert titles(playlist) == [title for _, _, title in model]
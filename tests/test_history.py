@@ -0,0 +1,40 @@
+import asyncio
+import threading
+
+from cogs.music.database import Database
+from cogs.music.history import HistoryStore
+from cogs.music.library import PlaylistLibrary
+
+def record(title: str):
+    return {'u': f'https://example.com/{title}', 't': title, 'd': 60, 'r': 1, 'c': 2}
+
+def test_guilds_share_one_connection_per_database(tmp_path):
+    path = str(tmp_path / 'history.db')
+
+    async def run():
+        first, second = HistoryStore(1, path), HistoryStore(2, path)
+        assert first.db is second.db
+        first.append([record('Never Gonna Give You Up'), record('Take On Me')])
+        second.append([record('Africa')])
+        assert await first.window(0, 10) == [record('Never Gonna Give You Up'), record('Take On Me')]
+        assert await second.record(0) == record('Africa')
+        assert await first.search('take on') == 1
+        assert await second.search('take on') is None
+
+        first.close()
+        assert await second.window(0, 10) == [record('Africa')]     # Still open for the other guild
+        second.close()
+        assert path not in Database._shared
+
+    asyncio.run(run())
+
+def test_library_and_history_run_on_the_same_thread(tmp_path):
+    async def run():
+        history = HistoryStore(1, str(tmp_path / 'history.db'))
+        library = PlaylistLibrary(str(tmp_path / 'playlists.db'))
+        assert await history.db.run(lambda conn: threading.current_thread().name) == \
+               await library.db.run(lambda conn: threading.current_thread().name)
+        history.close()
+        library.close()
+
+    asyncio.run(run())
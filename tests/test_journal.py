@@ -0,0 +1,91 @@
+import os
+import random
+import asyncio
+import threading
+
+from cogs.music import journal as journal_module
+from cogs.music.journal import QueueJournal, after_writes, writer_thread, entry_record
+from cogs.music.player import SongQueue
+from cogs.music.ytdl import BasicMetadata
+
+def song(title: str, requester: int = 1):
+    return BasicMetadata.restored(requester, 2, f'https://example.com/{title}', title, 60)
+
+def test_writes_dont_wait_for_the_disk(tmp_path):
+    async def run():
+        stuck = threading.Event()
+        writer_thread.submit(stuck.wait)    # A disk that hangs
+        journal = QueueJournal(1, tmp_path)
+        journal.add(0, [song('a'), song('b')])
+        journal.seek(1)
+        journal.sync()
+        journal.snapshot([song('a'), song('b')], 1, 12.5, 5, 6)
+        journal.add(2, [song('c')])
+        assert os.listdir(tmp_path) == []
+        stuck.set()
+
+        saved = await after_writes(QueueJournal.load, 1, tmp_path)
+        assert [entry['t'] for entry in saved.entries] == ['a', 'b', 'c']
+        assert (saved.cursor, saved.offset, saved.voice_channel, saved.text_channel) == (1, 12.5, 5, 6)
+        journal.discard()
+        assert await after_writes(QueueJournal.saved_guilds, tmp_path) == []
+
+    asyncio.run(run())
+
+def test_replay_rebuilds_the_live_queue(tmp_path, monkeypatch):
+    monkeypatch.setattr(journal_module, 'compact_after', 25)
+
+    async def run():
+        random.seed(36)
+        songs = SongQueue()
+        songs.journal = QueueJournal(1, tmp_path)
+        titles = iter(range(10 ** 6))
+        def new_songs(count: int):
+            return [song(str(next(titles)), random.randint(1, 3)) for _ in range(count)]
+
+        for step in range(400):
+            size = len(songs)
+            op = random.choice(['extend', 'prepend', 'insert_many', 'insert', 'insert_at', 'remove',
+                                'remove_range', 'seek', 'set', 'shuffle', 'clear_upcoming', 'drop_history', 'replace'])
+            if op == 'extend':
+                songs.extend(new_songs(random.randint(1, 5)))
+            elif op == 'prepend':
+                songs.prepend(new_songs(random.randint(1, 5)))
+            elif op == 'insert_many':
+                songs.insert_many(random.randint(0, size), new_songs(random.randint(1, 5)))
+            elif op == 'insert':
+                songs.insert(random.randint(0, size), new_songs(1)[0])
+            elif op == 'insert_at':
+                items = new_songs(random.randint(1, 4))
+                songs.insert_at(sorted(random.sample(range(size + len(items)), len(items))), items)
+            elif op == 'seek':
+                songs.seek(random.randint(0, size))
+            elif op == 'drop_history':
+                songs.drop_history(random.randint(0, 3))
+            elif op == 'shuffle':
+                songs.shuffle()
+            elif op == 'replace':
+                entries = new_songs(random.randint(0, 10))
+                songs.replace(entries, random.randint(0, len(entries)))
+            elif op == 'clear_upcoming' and random.random() < 0.2:
+                songs.clear_upcoming()
+            elif size == 0:
+                continue
+            elif op == 'remove':
+                songs.remove(random.randrange(size))
+            elif op == 'remove_range':
+                start = random.randrange(size)
+                songs.remove_range(start, start + random.randint(1, 6))
+            elif op == 'set':
+                songs[random.randrange(size)] = new_songs(1)[0]
+
+            if songs.journal.needs_compaction:
+                songs.journal.snapshot(songs, songs.cursor, step / 10, 5, 6)
+            if step % 50 == 49:
+                saved = await after_writes(QueueJournal.load, 1, tmp_path)
+                assert saved.entries == [entry_record(entry) for entry in songs]
+                assert saved.cursor == songs.cursor
+                assert (saved.voice_channel, saved.text_channel) == (5, 6)
+        songs.journal.close()
+
+    asyncio.run(run())
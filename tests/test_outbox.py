@@ -0,0 +1,150 @@
+import time
+import asyncio
+from types import SimpleNamespace
+
+import aiohttp
+import discord
+from aiohttp import web
+
+from cogs.outbox import Outbox, HTTPSender
+from cogs.music.music import Music
+from cogs.music.views import Paginator
+
+class FakeAPI():
+    """Channel messages endpoint with a bucket of `limit` requests per `reset` seconds per channel,
+        it answers 429 past that. Every message is logged as (channel id, title or content)"""
+    def __init__(self, limit: int = 2, reset: float = 0.2):
+        self.limit = limit
+        self.reset = reset
+        self.log = []
+        self.rate_limited = 0
+        self._buckets = {}
+        self._ids = 0
+
+    def _bucket(self, channel_id: int):
+        now = time.monotonic()
+        remaining, reset_at = self._buckets.get(channel_id, (self.limit, now + self.reset))
+        if now >= reset_at:
+            remaining, reset_at = self.limit, now + self.reset
+        return remaining, reset_at, now
+
+    async def message(self, request: web.Request):
+        channel_id = int(request.match_info['channel'])
+        remaining, reset_at, now = self._bucket(channel_id)
+        if remaining <= 0:
+            self.rate_limited += 1
+            return web.json_response({'retry_after': reset_at - now}, status = 429)
+        self._buckets[channel_id] = (remaining - 1, reset_at)
+        payload = await request.json()
+        if 'embeds' in payload:
+            embed = payload['embeds'][0]
+            self.log.append((channel_id, embed.get('title'), embed.get('description')))
+        else:
+            self.log.append((channel_id, None, payload['content']))
+        self._ids += 1
+        headers = {'X-RateLimit-Remaining': str(remaining - 1), 'X-RateLimit-Reset-After': f"{reset_at - now:.3f}"}
+        return web.json_response({'id': str(self._ids)}, headers = headers)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/channels/{channel}/messages', self.message)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+async def outbox_with_api(**kwargs):
+    api = FakeAPI(**kwargs)
+    base = await api.start()
+    return api, Outbox(HTTPSender(lambda: 'token', base), window = 0.05)
+
+def test_bursts_are_merged_and_paced_without_429s():
+    async def run():
+        api, outbox = await outbox_with_api()
+        for i in range(5):
+            outbox.info(1, f"info {i}", title = "Queue")
+        for i in range(6):
+            outbox.info(1, f"error {i}", title = "Error" if i % 2 else "Other")
+        await outbox.flush(1)
+        await outbox.close()
+        await api.stop()
+        return api, outbox
+
+    api, outbox = asyncio.run(run())
+    assert api.log[0] == (1, "Queue", '\n'.join(f"info {i}" for i in range(5)))
+    assert len(api.log) == 7
+    assert outbox.merged == 4
+    assert api.rate_limited == 0 and outbox.rate_limited == 0
+
+def test_player_timeout_is_reported():
+    async def run():
+        api, outbox = await outbox_with_api()
+        disconnected = []
+        async def cancel_task_and_disconnect():
+            disconnected.append(True)
+        cog = SimpleNamespace(outbox = outbox,
+                              voice_states = {1: SimpleNamespace(cancel_task_and_disconnect = cancel_task_and_disconnect)})
+        await Music.cleanup(cog, SimpleNamespace(id = 1), SimpleNamespace(id = 5))
+        await outbox.flush(5)
+        await outbox.close()
+        await api.stop()
+        return api, cog, disconnected
+
+    api, cog, disconnected = asyncio.run(run())
+    assert disconnected and not cog.voice_states
+    assert [(channel, title) for channel, title, _ in api.log] == [(5, "Player Timeout")]
+
+def test_replies_keep_their_order_within_a_channel():
+    async def run():
+        api, outbox = await outbox_with_api()
+        cog = SimpleNamespace(outbox = outbox)
+        ctx = SimpleNamespace(channel = SimpleNamespace(id = 7))
+        async def send(embed = None, view = None, delete_after = None):
+            api.log.append((7, embed.title, 'sent directly'))
+        ctx.send = send
+        async def render(page):
+            return discord.Embed(title = "Queue page"), 1, 1
+
+        await Music.send_info_embed(cog, ctx, "Enqueued a song")
+        await Music.send_embed(cog, ctx, discord.Embed(title = "Now playing").add_field(name = "Duration", value = "3:00"))
+        await Music.send_paginator(cog, ctx, Paginator(render))
+        await Music.send_error_embed(cog, ctx, "Please check the index.")
+        await outbox.flush(7)
+        await outbox.close()
+        await api.stop()
+        return api
+
+    api = asyncio.run(run())
+    assert [title for _, title, _ in api.log] == [None, "Now playing", "Queue page", "Command Error"]
+
+def test_a_failed_request_doesnt_stop_the_channel():
+    class FlakySender():
+        """Drops the connection on the first request"""
+        def __init__(self):
+            self.log = []
+
+        async def request(self, method, path, payload = None):
+            self.log.append(payload['content'])
+            if len(self.log) == 1:
+                raise aiohttp.ClientConnectionError("Connection reset")
+            return 200, {}, {'id': str(len(self.log))}
+
+        async def close(self):
+            pass
+
+    async def run():
+        outbox = Outbox(FlakySender(), window = 0.05)
+        outbox.send(1, "first", merge = False)
+        outbox.send(1, "second", merge = False)
+        outbox.send(1, "third", merge = False)
+        await outbox.flush(1)
+        assert outbox._pending == {} and outbox._drains == {}
+        await outbox.close()
+        return outbox.sender
+
+    assert asyncio.run(run()).log == ["first", "second", "third"]
@@ -0,0 +1,90 @@
+import random
+import asyncio
+from types import SimpleNamespace
+
+from cogs.music import player
+from cogs.music.player import Playlist, VoiceState
+from cogs.music.scheduler import PlayerScheduler
+from cogs.music.ytdl import BasicMetadata
+
+def test_join_without_playing_disconnects_after_the_idle_timeout(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)     # The journal and the history store live in db/
+    monkeypatch.setattr(player, 'idle_timeout', 0.2)
+
+    async def run():
+        cleaned = asyncio.Event()
+        async def cleanup(guild, channel):
+            cleaned.set()
+        cog = SimpleNamespace(scheduler = PlayerScheduler(tick = 0.02), cleanup = cleanup, audio_workers = None)
+        cog.scheduler.start()
+        bot = SimpleNamespace(loop = asyncio.get_running_loop())
+        state = VoiceState(bot, cog, SimpleNamespace(id = 1), SimpleNamespace(id = 2))
+
+        await asyncio.sleep(0.4)
+        assert not cleaned.is_set()     # Not connected, nothing to time out
+
+        state.voice = SimpleNamespace(source = None)    # ;join, and nothing is queued
+        await asyncio.wait_for(cleaned.wait(), 2)
+        assert state.state == 'waiting'
+        cog.scheduler.stop()
+        state.playlist.history.close()
+
+    asyncio.run(run())
+
+def random_ranges(size: int):
+    """Inclusive (first, last) ranges as users type them, in any order and overlapping or past the end"""
+    ranges = []
+    for _ in range(random.randint(1, 3)):
+        first = random.randint(1, size + 2)
+        last = random.randint(max(1, first - 4), first + 4)
+        ranges.append(random.choice([(first, last), (last, first)]))
+    return ranges
+
+def picked(ranges, size: int):
+    """0-based positions the ranges cover, in order"""
+    return sorted({i - 1 for a, b in ranges for i in range(min(a, b), max(a, b) + 1) if 1 <= i <= size})
+
+def test_range_removals_and_moves_match_a_plain_list():
+    random.seed(43)
+
+    async def run():
+        playlist = Playlist()
+        model, cursor = [], 0
+        for step in range(300):
+            op = random.choice(['add', 'seek', 'remove', 'move', 'move'])
+            if op == 'add' or not model:
+                items = [BasicMetadata.restored(random.randint(1, 3), 2, f'https://example.com/{step}.{i}', f'{step}.{i}', 60)
+                         for i in range(random.randint(1, 6))]
+                playlist.songs.extend(items)
+                model.extend(items)
+            elif op == 'seek':
+                cursor = random.randint(0, len(model))
+                await playlist.shift_queues_to(cursor)
+            elif op == 'remove':
+                ranges = random_ranges(len(model))
+                positions = picked(ranges, len(model))
+                assert playlist.remove_songs(ranges) == len(positions)
+                cursor -= sum(1 for i in positions if i < cursor)
+                model = [entry for i, entry in enumerate(model) if i not in positions]
+            elif op == 'move':
+                ranges = random_ranges(len(model))
+                new_idx = random.randint(-1, len(model) + 2)
+                positions = picked(ranges, len(model))
+                nowplaying = model[cursor - 1] if cursor > 0 else None
+                assert await playlist.move_songs(ranges, new_idx) == len(positions)
+                moving = [model[i] for i in positions]
+                model = [entry for i, entry in enumerate(model) if i not in positions]
+                at = min(max(new_idx, 1) - 1, len(model))
+                model[at:at] = moving
+                if nowplaying is not None:     # The nowplaying song stays nowplaying wherever it went
+                    cursor = model.index(nowplaying) + 1
+
+            assert list(playlist.songs) == model
+            assert playlist.songs.cursor == cursor
+            for requester in (1, 2, 3):
+                assert sorted(map(id, playlist.requesters.entries(requester))) == \
+                       sorted(id(entry) for entry in model if entry.requester_id == requester)
+                assert playlist.requesters.upcoming_count(requester) == \
+                       sum(1 for entry in model[cursor:] if entry.requester_id == requester)
+
+    asyncio.run(run())
@@ -0,0 +1,71 @@
+import random
+
+from cogs.music.sequence import BlockList
+
+class SmallBlocks(BlockList):
+    """Blocks of a few entries, so a few hundred operations split, drop and compact plenty of them"""
+    BLOCK_SIZE = 4
+
+class Item():
+    def __init__(self, weight: int):
+        self.weight = weight
+
+def check(blocks: BlockList, model: list):
+    assert len(blocks) == len(model)
+    assert list(blocks) == model
+    assert list(reversed(blocks)) == model[::-1]
+    assert blocks.total_weight == sum(item.weight for item in model)
+    for i, item in enumerate(model):
+        assert blocks[i] is item
+        assert blocks.index(item) == i
+        assert blocks.weight_before(i) == sum(item.weight for item in model[:i])
+    start = random.randint(0, len(model))
+    stop = random.randint(start, len(model))
+    assert blocks[start:stop] == model[start:stop]
+    assert list(blocks.islice(start, stop)) == model[start:stop]
+    assert blocks.weight_between(start, stop) == sum(item.weight for item in model[start:stop])
+
+def test_block_list_matches_a_plain_list():
+    random.seed(30)
+    model = [Item(random.randint(0, 9)) for _ in range(20)]
+    blocks = SmallBlocks(model, weight = lambda item: item.weight)
+    for step in range(800):
+        op = random.choice(['insert', 'insert_many', 'append', 'pop', 'delete_range', 'setitem', 'remove'])
+        index = random.randint(0, len(model))
+        if op == 'insert':
+            item = Item(random.randint(0, 9))
+            blocks.insert(index, item)
+            model.insert(index, item)
+        elif op == 'insert_many':
+            items = [Item(random.randint(0, 9)) for _ in range(random.randint(0, 12))]
+            blocks.insert_many(index, items)
+            model[index:index] = items
+        elif op == 'append':
+            item = Item(random.randint(0, 9))
+            blocks.append(item)
+            model.append(item)
+        elif not model:
+            continue
+        elif op == 'pop':
+            index = random.randrange(len(model))
+            assert blocks.pop(index) is model.pop(index)
+        elif op == 'delete_range':
+            stop = random.randint(index, min(len(model), index + 15))
+            assert blocks.delete_range(index, stop) == model[index:stop]
+            del model[index:stop]
+        elif op == 'setitem':
+            index = random.randrange(len(model))
+            item = Item(random.randint(0, 9))
+            blocks[index] = item
+            model[index] = item
+        elif op == 'remove':
+            item = random.choice(model)
+            blocks.remove(item)
+            model.remove(item)
+        check(blocks, model)
+        assert all(item in blocks for item in model)
+
+    blocks.replace(model[::-1])
+    check(blocks, model[::-1])
+    blocks.clear()
+    check(blocks, [])
@@ -0,0 +1,127 @@
+import os
+import sys
+import time
+import asyncio
+import subprocess
+from types import SimpleNamespace
+
+from cogs.music import standby
+from cogs.music.journal import QueueJournal, after_writes
+from cogs.music.music import Music
+from cogs.music.player import VoiceState
+from cogs.music.scheduler import PlayerScheduler
+from cogs.music.standby import Heartbeat
+from cogs.music.ytdl import BasicMetadata
+
+src = os.path.join(os.path.dirname(__file__), '..', 'src')
+
+# Primary of a shard range in another process: it journals a song to a guild of its range on every beat
+# and exits with code 1 as soon as a beat is refused
+primary = """
+import sys, time
+from types import SimpleNamespace
+from cogs.music.journal import QueueJournal
+from cogs.music.standby import Heartbeat
+directory, shard, guild_id, beats = sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4])
+heartbeat = Heartbeat(directory, [shard])
+journal = QueueJournal(guild_id, directory)
+for i in range(beats):
+    if not heartbeat.beat():
+        sys.exit(1)
+    journal.add(i, [SimpleNamespace(url = f'https://example.com/{i}', title = f'Song {i}', length = 60, requester_id = 1, channel_id = 2)])
+    print('beat', flush = True)
+    time.sleep(0.05)
+"""
+
+def start_primary(directory, shard: int, guild_id: int, beats: int):
+    return subprocess.Popen([sys.executable, '-c', primary, str(directory), str(shard), str(guild_id), str(beats)],
+                            cwd = src, stdout = subprocess.PIPE, text = True)
+
+def guild_on_shard(shard: int, shard_count: int):
+    return (shard + shard_count) << 22
+
+def test_cluster_processes_keep_their_own_heartbeats(tmp_path):
+    other = start_primary(tmp_path, 0, guild_on_shard(0, 2), 20)
+    assert other.stdout.readline() == 'beat\n'
+    heartbeat = Heartbeat(tmp_path, [1])
+    for _ in range(20):
+        assert heartbeat.beat()
+        time.sleep(0.05)
+    assert other.wait(5) == 0
+    assert sorted(os.listdir(tmp_path)) == [f'{guild_on_shard(0, 2)}.journal', 'heartbeat-0-0', 'heartbeat-1-1']
+
+def test_standby_takes_over_the_guilds_of_its_shard_range(tmp_path):
+    ours, theirs = guild_on_shard(0, 2), guild_on_shard(1, 2)
+
+    async def run():
+        other = QueueJournal(theirs, tmp_path)
+        other.voice(5, 6)
+        other.close()
+        assert await after_writes(QueueJournal.saved_guilds, tmp_path) == [theirs]
+        process = start_primary(tmp_path, 0, ours, 1000)
+        assert process.stdout.readline() == 'beat\n'
+        waiting = asyncio.create_task(standby.stand_by(tmp_path, [0], 2))
+        await asyncio.sleep(0.5)
+        assert not waiting.done()
+        process.kill()
+        process.wait()
+        return await asyncio.wait_for(waiting, 2)
+
+    takeover = asyncio.run(run())
+    assert list(takeover.states) == [ours]
+    assert takeover.states[ours].entries == QueueJournal.load(ours, tmp_path).entries
+    assert len(takeover.states[ours].entries) > 1
+
+def test_standby_started_first_waits_for_the_primary(tmp_path, monkeypatch):
+    monkeypatch.setattr(standby, 'startup_grace', 0.3)
+    heartbeat = Heartbeat(tmp_path, [0])
+    assert not heartbeat.lost()     # No heartbeat yet, the primary may still be starting
+
+    primary = Heartbeat(tmp_path, [0])
+    primary.pid = os.getppid()  # Another process that is still running
+    primary.beat()
+    time.sleep(0.4)
+    assert not heartbeat.lost()
+    os.remove(primary.path)     # Once a beat was seen, a missing heartbeat is lost at once
+    assert heartbeat.lost()
+
+    late = Heartbeat(tmp_path, [1])
+    late._started -= 1      # Nobody beat within the grace period
+    assert late.lost()
+
+def test_lost_heartbeat_closes_the_bot_and_leaves_the_queues_to_the_standby(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)     # The journal and the history store live in db/
+
+    async def run():
+        closed = asyncio.Event()
+        async def close():
+            closed.set()
+        bot = SimpleNamespace(loop = asyncio.get_running_loop(), close = close)
+        cog = SimpleNamespace(bot = bot, scheduler = PlayerScheduler(tick = 0.02), audio_workers = None,
+                              _heartbeat = Heartbeat(shard_ids = [0]), heartbeat = SimpleNamespace(stop = lambda: None))
+        cog.abdicate = lambda: Music.abdicate(cog)
+        cog.scheduler.start()
+        state = VoiceState(bot, cog, SimpleNamespace(id = 1), SimpleNamespace(id = 2))
+        state.playlist.songs.extend([BasicMetadata.restored(1, 2, 'https://example.com/1', 'Song', 60)])
+        calls = []
+        async def disconnect(**kwargs):
+            calls.append('disconnect')
+        state.voice = SimpleNamespace(source = None, stop = lambda: calls.append('stop'),
+                                      cleanup = lambda: calls.append('cleanup'), disconnect = disconnect)
+        cog.voice_states = {1: state}
+        saved = (await after_writes(QueueJournal.load, 1)).entries
+
+        assert cog._heartbeat.beat()
+        other = Heartbeat(shard_ids = [0])  # The standby, as another process, took over meanwhile
+        other.pid += 1
+        other.beat()
+        await Music.heartbeat.coro(cog)
+        await asyncio.wait_for(closed.wait(), 2)
+
+        assert cog.voice_states == {}
+        assert 'cleanup' in calls and 'disconnect' not in calls
+        assert state.voice is None
+        assert await after_writes(QueueJournal.saved_guilds) == [1]
+        assert (await after_writes(QueueJournal.load, 1)).entries == saved == [{'u': 'https://example.com/1', 't': 'Song', 'd': 60, 'r': 1, 'c': 2}]
+
+    asyncio.run(run())
@@ -0,0 +1,119 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+
+import discord
+
+from cogs.music import workers
+from cogs.music.fanout import shared_streams
+from cogs.music.player import VoiceState
+from cogs.music.scheduler import PlayerScheduler
+from cogs.music.ytdl import BasicMetadata, YTDLSource
+
+class FakeFFmpeg(discord.AudioSource):
+    """Stands in for FFmpegOpusAudio, counting the processes spawned and cleaned up.
+        AudioSource.__del__ cleans up again, only the first cleanup counts"""
+    spawned = 0
+    cleaned = 0
+
+    def __init__(self, url, **kwargs):
+        FakeFFmpeg.spawned += 1
+        self.frames = 1000
+        self.closed = False
+
+    @staticmethod
+    async def probe(url):
+        return 'opus', 128
+
+    def read(self):
+        if self.frames == 0:
+            return b''
+        self.frames -= 1
+        return b'\0' * 20
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        if not self.closed:
+            self.closed = True
+            FakeFFmpeg.cleaned += 1
+
+async def resolve_info(cls, link, *, loop = None, telemetry = None):
+    return {'id': link, 'extractor_key': 'Fake', 'url': link, 'title': link, 'duration': 60,
+            'upload_date': '20200101', 'webpage_url': link}
+
+def song(title: str):
+    return BasicMetadata.restored(1, 2, f'https://example.com/{title}', title, 60)
+
+def voice_state(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)     # The journal and the history store live in db/
+    monkeypatch.setattr(discord, 'FFmpegOpusAudio', FakeFFmpeg)
+    monkeypatch.setattr(YTDLSource, 'resolve_info', classmethod(resolve_info))
+    monkeypatch.setattr(FakeFFmpeg, 'spawned', 0)
+    monkeypatch.setattr(FakeFFmpeg, 'cleaned', 0)
+    cog = SimpleNamespace(scheduler = PlayerScheduler(), audio_workers = None)
+    bot = SimpleNamespace(loop = asyncio.get_running_loop())
+    return VoiceState(bot, cog, SimpleNamespace(id = 1), SimpleNamespace(id = 2))
+
+def test_info_embeds_dont_open_streams(tmp_path, monkeypatch):
+    async def run():
+        state = voice_state(tmp_path, monkeypatch)
+        state.playlist.songs.extend([song('a'), song('b'), song('c')])
+        state.playlist.songs.seek(2)
+        assert (await state.prev_info_embed()).description == "```css\nhttps://example.com/a\n```"
+        assert (await state.next_info_embed()).description == "```css\nhttps://example.com/c\n```"
+        assert FakeFFmpeg.spawned == 0
+        assert len(shared_streams) == 0
+        state.playlist.history.close()
+
+    asyncio.run(run())
+
+def test_sources_opened_for_a_stopped_player_are_detached(tmp_path, monkeypatch):
+    async def run():
+        state = voice_state(tmp_path, monkeypatch)
+        state.current = song('a')
+
+        state.state = 'stopped'     # Torn down while the stream was opening
+        await state._open_source(state.current, 0, resuming = True)
+
+        state.state = 'loading'
+        state._suspended = True     # Everybody left while the stream was opening
+        state.voice = SimpleNamespace(stop = lambda: None)
+        await state._open_source(state.current, 0, resuming = True)
+
+        assert FakeFFmpeg.spawned == 2
+        assert FakeFFmpeg.cleaned == 2
+        assert len(shared_streams) == 0
+        state.playlist.history.close()
+
+    asyncio.run(run())
+
+class FakeStream(discord.AudioSource):
+    """Stream of the worker side, its frames tell the offset it was opened at"""
+    def __init__(self, offset):
+        self.offset = offset
+        self.frames = 0
+
+    def read(self):
+        self.frames += 1
+        return f'{self.offset}:{self.frames}'.encode()
+
+def test_worker_seek_drops_the_frames_from_before(tmp_path, monkeypatch):
+    opened = []
+    def open_stream(link, offset, info, telemetry):
+        opened.append(offset)
+        return SimpleNamespace(audio_source = FakeStream(offset), data = {'url': link, 'title': link})
+    monkeypatch.setattr(workers, 'open_stream', open_stream)
+
+    worker = workers.AudioWorker(0, tmp_path)
+    with workers.StreamServer(worker.path) as server:
+        threading.Thread(target = server.serve_forever, daemon = True).start()
+        sock, reply = worker.request({'cmd': 'play', 'url': 'https://example.com/a', 'offset': 0, 'info': None})
+        source = workers.WorkerAudioSource(sock)
+        assert source.read() == b'0:1'
+        assert source.seek(30.0)
+        assert source.read() == b'30.0:1'
+        assert opened == [0, 30.0]
+        source.cleanup()
+        server.shutdown()